@@ -0,0 +1,172 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     annotate.py
+# @author   Jian Yang
+# @date     2020-09-21
+
+"""
+annotate trajectory points (see fcd.py) with the context that produced them:
+uid, mode, origin/destination stop and departure of the current trip, and the
+current activity. The context comes from the trip manifest written along with
+the trip files (trip_generator.write_manifest) and optionally the itinerary.
+- persons (p<uid>) are joined as-of the last departure of their trips;
+- vehicles (c_<uid>_<slot>, b_<uid>_<slot>) are joined by their trip id;
+- the activity is the itinerary stop of the time slot of a point, or without
+  an itinerary, the stop a person travels to (or stays at).
+FCD files are processed chunk by chunk, each chunk with sorted merges only.
+"""
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from fcd import (
+    FCD_COLUMNS,
+    CHUNK_SIZE,
+    iter_fcd_chunks
+)
+
+
+CONTEXT_COLUMNS = ["uid", "mode", "src", "dst", "depart", "activity"]
+ANNOTATED_COLUMNS = FCD_COLUMNS + CONTEXT_COLUMNS
+
+
+def read_manifest(
+    file_path: str
+) -> pd.DataFrame:
+    if not Path(file_path).is_file():
+        raise FileNotFoundError("trip manifest not found!")
+    return pd.read_csv(
+        file_path,
+        dtype={"uid": str, "pid": str, "vid": str, "src": str, "dst": str}
+    )
+
+
+class TripIndex():
+    def __init__(
+        self,
+        trips: pd.DataFrame,
+        itin_df: pd.DataFrame = None
+    ):
+        """
+        trips: trip manifest, see read_manifest()
+        itin_df: itinerary (uid, timeslot, stop), optional
+        """
+        trips = trips.assign(uid=trips["uid"].astype(str))
+        # intervals [depart, next depart) of every person, sorted for as-of joins
+        self._persons = trips[["pid", "depart", "uid", "mode", "src", "dst"]] \
+            .sort_values("depart", kind="mergesort").reset_index(drop=True)
+        self._vehicles = trips.loc[
+            trips["vid"].notna(), ["vid", "uid", "mode", "src", "dst", "depart"]
+        ].drop_duplicates("vid").set_index("vid")
+        # stop of a person before its first departure
+        first = trips.sort_values("depart", kind="mergesort").drop_duplicates("pid")  # noqa
+        self._home = pd.Series(first["src"].values, index=first["pid"].values)
+
+        self._itin = None
+        if itin_df is not None:
+            itin = itin_df[itin_df["stop"].notna()]
+            self._itin = pd.DataFrame({
+                "uid": itin["uid"].astype(str).values,
+                "timeslot": itin["timeslot"].astype(np.float64).values,
+                "activity": itin["stop"].values,
+            }).sort_values("timeslot", kind="mergesort")
+
+    def annotate(
+        self,
+        chunk: pd.DataFrame
+    ) -> pd.DataFrame:
+        """
+        attach CONTEXT_COLUMNS to a chunk of trajectory points sorted by time
+        """
+        chunk = chunk.reset_index(drop=True)
+        chunk["_row"] = np.arange(chunk.shape[0])
+        is_person = (chunk["kind"] == "person").values
+
+        persons = pd.merge_asof(
+            chunk[is_person], self._persons,
+            left_on="time", right_on="depart",
+            left_by="id", right_by="pid",
+            direction="backward"
+        ).drop(columns="pid")
+        # before the first departure a person stays at the origin of its trips
+        waiting = persons["uid"].isna().values
+        persons.loc[waiting, "activity"] = persons.loc[waiting, "id"].map(self._home).values  # noqa
+        persons.loc[waiting, "uid"] = persons.loc[waiting, "id"].str[1:].values
+        persons.loc[~waiting, "activity"] = persons.loc[~waiting, "dst"].values
+
+        vehicles = chunk[~is_person].join(self._vehicles, on="id")
+        vehicles["activity"] = vehicles["dst"]
+
+        df = pd.concat([persons, vehicles], axis=0, ignore_index=True)
+        df = df.sort_values("_row", kind="mergesort").drop(columns="_row")
+        if self._itin is not None:
+            df = df.reset_index(drop=True).drop(columns="activity")
+            known = df["uid"].notna().values
+            df.loc[known, "activity"] = pd.merge_asof(
+                df[known].assign(uid=df.loc[known, "uid"].astype(str)),
+                self._itin, left_on="time", right_on="timeslot", by="uid",
+                direction="backward"
+            )["activity"].values
+        return df[ANNOTATED_COLUMNS].reset_index(drop=True)
+
+
+def iter_annotated(
+    fcd_file: str,
+    index: TripIndex,
+    chunk_size: int = CHUNK_SIZE
+):
+    """
+    stream a fcd xml file, yield annotated chunks of at most chunk_size points
+    """
+    for chunk in iter_fcd_chunks(fcd_file, chunk_size):
+        yield index.annotate(chunk)
+
+
+def annotate_fcd(
+    fcd_file: str,
+    manifest_file: str,
+    save_path: str,
+    itinerary_file: str = None,
+    chunk_size: int = CHUNK_SIZE
+) -> int:
+    """
+    annotate a fcd xml file into csv chunk by chunk, return the number of points
+    """
+    itin_df = None
+    if itinerary_file is not None:
+        itin_df = pd.read_csv(itinerary_file, na_values="NULL", dtype={"uid": str})  # noqa
+    index = TripIndex(read_manifest(manifest_file), itin_df)
+
+    n = 0
+    header = True
+    for chunk in iter_annotated(fcd_file, index, chunk_size):
+        chunk.to_csv(save_path, mode="w" if header else "a", header=header, index=False)  # noqa
+        header = False
+        n += chunk.shape[0]
+    if header:
+        pd.DataFrame(columns=ANNOTATED_COLUMNS).to_csv(save_path, index=False)
+    return n
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    wd = Path(__file__).parents[1].absolute()
+    fcd_file = wd.joinpath('output', 'notre_dame.fcd.xml')
+    manifest_file = wd.joinpath('data', 'trips', 'notre_dame_trips.csv')
+    save_path = wd.joinpath('output', 'notre_dame.annotated.csv')
+    annotate_fcd(fcd_file, manifest_file, save_path)
+
+    print(0)
@@ -0,0 +1,394 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     assignment.py
+# @author   Jian Yang
+# @date     2020-10-07
+
+"""
+iterative (dynamic user equilibrium like) route assignment of the car and bike
+trips, in the spirit of sumo's duaIterate.py.
+Vehicles are split into windows (one day by default) by the slot in their id
+(c_<uid>_<slot>, b_<uid>_<slot>). Every iteration of a window
+1. routes its trips with duarouter, starting from the route alternatives
+   (.rou.alt.xml) and the edge travel times of the previous iteration;
+2. simulates the routes in a short sumo run, dumping edge travel times;
+until the relative gap of the route alternatives drops below tol. Windows are
+independent and run in a thread pool. The final routes of all windows are
+merged into one route file with triggered departures, which replaces the car
+and bike trip files of the full simulation.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import subprocess
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+from lazy_import import lazy_module, lazy_sumolib
+
+pd = lazy_module("pandas")
+sumolib = lazy_sumolib()
+
+
+logging.basicConfig(format='assignment:%(levelname)s: %(message)s')
+
+WINDOW = 86400  # length (in seconds) of an assignment window
+SPILL = 7200  # extra simulated time for trips departing late in a window
+MAX_ITER = 20
+MIN_ITER = 2
+TOL = 0.01  # relative gap at which a window has converged
+AGGREGATION = 900  # period (in seconds) of the edge travel time dump
+
+
+def vehicle_slot(vid: str) -> int:
+    """
+    slot of a vehicle id c_<uid>_<slot> or b_<uid>_<slot>
+    """
+    return int(vid.rsplit('_', 1)[1])
+
+
+def _file_hash(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as fd:
+        for block in iter(lambda: fd.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def split_windows(
+    trip_files: List[str],
+    manifest_file: str,
+    work_dir: str,
+    window: int = WINDOW
+) -> Dict[int, str]:
+    """
+    split the car/bike trip files into one trip file per window, the triggered
+    departures are replaced by the depart times of the trip manifest (see
+    trip_generator.write_manifest). return {window: trip file}.
+    """
+    manifest = pd.read_csv(manifest_file, usecols=['vid', 'depart'])
+    manifest = manifest[manifest['vid'].notna()]
+    depart = dict(zip(manifest['vid'].values, manifest['depart'].values))
+
+    trips = {}
+    for trip_file in trip_files:
+        for _, node in ET.iterparse(str(trip_file)):
+            if node.tag != "trip":
+                continue
+            vid = node.get("id")
+            w = vehicle_slot(vid) // window
+            trips.setdefault(w, []).append((
+                float(depart.get(vid, vehicle_slot(vid))), vid,
+                node.get("type"), node.get("from"), node.get("to")
+            ))
+            node.clear()
+
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    files = {}
+    for w, rows in sorted(trips.items()):
+        files[w] = work_dir.joinpath("w%d.trips.xml" % w)
+        with open(files[w], "w") as fd:
+            sumolib.xml.writeHeader(fd, script=None, root="routes", schemaPath="routes_file.xsd")  # noqa
+            for t, vid, v_type, src, dst in sorted(rows):
+                fd.write(
+                    '    <trip id="%s" type="%s" depart="%.2f" from="%s" to="%s"/>\n'  # noqa
+                    % (vid, v_type, t, src, dst)
+                )
+            fd.write("</routes>\n")
+    return files
+
+
+def relative_gap(alt_file: str) -> float:
+    """
+    relative gap of the route alternatives of a .rou.alt.xml file:
+    (sum of expected route costs - sum of best route costs) / sum of best costs
+    """
+    expected, best = 0.0, 0.0
+    for _, node in ET.iterparse(str(alt_file)):
+        if node.tag != "routeDistribution":
+            continue
+        cost, prob = [], []
+        for r in node.iter("route"):
+            if r.get("cost") is not None:
+                cost.append(float(r.get("cost")))
+                prob.append(float(r.get("probability", 1.0)))
+        if len(cost) > 0 and sum(prob) > 0:
+            expected += sum(c * p for c, p in zip(cost, prob)) / sum(prob)
+            best += min(cost)
+        node.clear()
+    return (expected - best) / best if best > 0 else 0.0
+
+
+def _call(cmd: List[str], log_file: str) -> int:
+    with open(log_file, "w") as fd:
+        return subprocess.call([str(c) for c in cmd], stdout=fd, stderr=subprocess.STDOUT)  # noqa
+
+
+class WindowAssignment():
+    def __init__(
+        self,
+        w: int,
+        trip_file: str,
+        net_file: str,
+        add_files: List[str],
+        work_dir: str,
+        window: int = WINDOW,
+        max_iter: int = MAX_ITER,
+        min_iter: int = MIN_ITER,
+        tol: float = TOL,
+        meso: bool = False,
+        routing_threads: int = 1,
+        bindir: str = None
+    ):
+        """
+        assignment of the trips of window w, files of iteration k are written
+        as <work_dir>/w<w>_<k>.*; the routes of the last run are kept as
+        <work_dir>/w<w>.rou.alt.xml and reused as start routes of the next run
+        if the trips of the window did not change
+        """
+        self.w = w
+        self.trip_file = Path(trip_file)
+        self.net_file = net_file
+        self.add_files = [str(f) for f in add_files]
+        self.work_dir = Path(work_dir)
+        self.begin = w * window
+        self.end = (w + 1) * window + SPILL
+        self.max_iter = max_iter
+        self.min_iter = min_iter
+        self.tol = tol
+        self.meso = meso
+        self.routing_threads = routing_threads
+        self.duarouter = sumolib.checkBinary('duarouter', bindir)
+        self.sumo = sumolib.checkBinary('sumo', bindir)
+
+    def _path(self, k: int, suffix: str) -> Path:
+        return self.work_dir.joinpath("w%d_%d.%s" % (self.w, k, suffix))
+
+    def _write_dump(self, k: int) -> Path:
+        add = self._path(k, "dump.add.xml")
+        with open(add, "w") as fd:
+            fd.write(
+                '<additional>\n    <edgeData id="dump" freq="%d" file="%s" excludeEmpty="true"/>\n</additional>\n'  # noqa
+                % (AGGREGATION, self._path(k, "dump.xml").name)
+            )
+        return add
+
+    def route(self, k: int, routes: Path, weights: Path) -> int:
+        cmd = [
+            self.duarouter,
+            "--net-file", self.net_file,
+            "--route-files", routes,
+            "--additional-files", ",".join(self.add_files),
+            "--output-file", self._path(k, "rou.xml"),
+            "--alternatives-output", self._path(k, "rou.alt.xml"),
+            "--begin", self.begin,
+            "--end", self.end,
+            "--routing-threads", self.routing_threads,
+            "--ignore-errors", "true",
+            "--xml-validation", "never",
+            "--no-step-log", "true",
+        ]
+        if weights is not None:
+            cmd += ["--weight-files", weights]
+        return _call(cmd, self._path(k, "duarouter.log"))
+
+    def simulate(self, k: int) -> int:
+        cmd = [
+            self.sumo,
+            "--net-file", self.net_file,
+            "--route-files", self._path(k, "rou.xml"),
+            "--additional-files", ",".join(self.add_files + [str(self._write_dump(k))]),  # noqa
+            "--begin", self.begin,
+            "--end", self.end,
+            "--ignore-route-errors", "true",
+            "--xml-validation", "never",
+            "--no-step-log", "true",
+        ]
+        if self.meso:
+            cmd += ["--mesosim", "true"]
+        return _call(cmd, self._path(k, "sumo.log"))
+
+    def run(self) -> Dict:
+        """
+        iterate until convergence, return the history of the window
+        """
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        trips_hash = _file_hash(self.trip_file)
+        state_file = self.work_dir.joinpath("w%d.json" % self.w)
+        cached = self.work_dir.joinpath("w%d.rou.alt.xml" % self.w)
+        cached_weights = self.work_dir.joinpath("w%d.dump.xml" % self.w)
+        routes, weights = self.trip_file, None
+        if state_file.is_file() and cached.is_file():
+            with open(state_file) as fd:
+                if json.load(fd).get("trips") == trips_hash:
+                    routes = cached
+                    if cached_weights.is_file():
+                        weights = cached_weights
+                    logging.info("window %d: starting from %s" % (self.w, cached))  # noqa
+
+        gaps = []
+        k = 0
+        for k in range(self.max_iter):
+            ret = self.route(k, routes, weights)
+            if ret != 0:
+                raise RuntimeError(
+                    "duarouter failed in window %d, iteration %d, see %s"
+                    % (self.w, k, self._path(k, "duarouter.log"))
+                )
+            # costs of the alternatives are the travel times of the last run
+            if weights is not None:
+                gaps.append(relative_gap(self._path(k, "rou.alt.xml")))
+                logging.info("window %d, iteration %d: gap %.4f" % (self.w, k, gaps[-1]))  # noqa
+                if k + 1 >= self.min_iter and gaps[-1] < self.tol:
+                    break
+            if k + 1 == self.max_iter:
+                break
+            ret = self.simulate(k)
+            if ret != 0:
+                raise RuntimeError(
+                    "sumo failed in window %d, iteration %d, see %s"
+                    % (self.w, k, self._path(k, "sumo.log"))
+                )
+            routes, weights = self._path(k, "rou.alt.xml"), self._path(k, "dump.xml")  # noqa
+
+        shutil.copyfile(self._path(k, "rou.alt.xml"), cached)
+        if weights is not None and weights != cached_weights:
+            shutil.copyfile(weights, cached_weights)
+        with open(state_file, "w") as fd:
+            json.dump({"trips": trips_hash}, fd)
+        return {
+            "window": self.w,
+            "iterations": k + 1,
+            "gaps": gaps,
+            "converged": len(gaps) > 0 and gaps[-1] < self.tol,
+            "routes": str(self._path(k, "rou.xml")),
+        }
+
+
+def write_assigned_routes(
+    route_files: List[str],
+    save_path: str,
+    trip_files: List[str] = ()
+) -> int:
+    """
+    merge the final routes of all windows into one route file, departures are
+    triggered by the persons riding the vehicles again. duarouter skips the
+    trips it cannot route (--ignore-errors), these are written as the trips of
+    trip_files, so that every ride of a person still has its vehicle.
+    return the number of vehicles written.
+    """
+    n = 0
+    routed = set()
+    with open(save_path, "w") as fd:
+        sumolib.xml.writeHeader(fd, script=None, root="routes", schemaPath="routes_file.xsd")  # noqa
+        for route_file in route_files:
+            for _, node in ET.iterparse(str(route_file)):
+                if node.tag != "vehicle":
+                    continue
+                route = node.find("route")
+                if route is not None:
+                    fd.write(
+                        '    <vehicle id="%s" type="%s" depart="triggered">\n'
+                        '        <route edges="%s"/>\n'
+                        '    </vehicle>\n'
+                        % (node.get("id"), node.get("type"), route.get("edges"))  # noqa
+                    )
+                    routed.add(node.get("id"))
+                    n += 1
+                node.clear()
+        unrouted = 0
+        for trip_file in trip_files:
+            for _, node in ET.iterparse(str(trip_file)):
+                if node.tag != "trip":
+                    continue
+                if node.get("id") not in routed:
+                    fd.write(
+                        '    <trip id="%s" type="%s" depart="triggered" from="%s" to="%s"/>\n'  # noqa
+                        % (node.get("id"), node.get("type"), node.get("from"), node.get("to"))  # noqa
+                    )
+                    unrouted += 1
+                node.clear()
+        fd.write("</routes>\n")
+    if unrouted > 0:
+        logging.warning(
+            "%d vehicles could not be routed, kept as trips in %s"
+            % (unrouted, save_path)
+        )
+    return n + unrouted
+
+
+def assign(
+    net_file: str,
+    trip_files: List[str],
+    manifest_file: str,
+    add_files: List[str],
+    work_dir: str,
+    save_path: str,
+    workers: int = None,
+    window: int = WINDOW,
+    **kwargs
+) -> Dict:
+    """
+    assign the routes of the car/bike trip files window by window, see
+    WindowAssignment for kwargs. windows run in a pool of workers threads
+    (one duarouter/sumo process each). the merged routes are written to
+    save_path, return the history of all windows.
+    """
+    files = split_windows(trip_files, manifest_file, work_dir, window)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    jobs = [
+        WindowAssignment(w, f, net_file, add_files, work_dir, window, **kwargs)
+        for w, f in files.items()
+    ]
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as pool:  # noqa
+        history = list(pool.map(lambda job: job.run(), jobs))
+    n = write_assigned_routes([h["routes"] for h in history], save_path, trip_files)  # noqa
+    for h in history:
+        if not h["converged"]:
+            logging.warning(
+                "window %d did not converge after %d iterations"
+                % (h["window"], h["iterations"])
+            )
+    return {"vehicles": n, "windows": history}
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    logging.getLogger().setLevel(logging.INFO)
+    wd = Path(__file__).parents[1].absolute()
+    trip_dir = wd.joinpath('data', 'trips')
+    history = assign(
+        net_file=wd.joinpath('data', 'map', 'notre_dame.net.xml'),
+        trip_files=[
+            trip_dir.joinpath('notre_dame_cars.trips.xml'),
+            trip_dir.joinpath('notre_dame_bikes.trips.xml')
+        ],
+        manifest_file=trip_dir.joinpath('notre_dame_trips.csv'),
+        add_files=[trip_dir.joinpath('vtypes.add.xml')],
+        work_dir=wd.joinpath('output', 'assignment'),
+        save_path=trip_dir.joinpath('notre_dame_vehicles.rou.xml')
+    )
+    print(json.dumps(history, indent=2))
+
+    print(0)
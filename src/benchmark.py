@@ -0,0 +1,259 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     benchmark.py
+# @author   Jian Yang
+# @date     2020-09-10
+
+"""
+benchmark suite of the pipeline stages on synthetic inputs (see synthetic.py):
+read_raw_schedule, generate_itinerary, get_stop_edges, fill_null_stop,
+generate_trips and fcd post-processing. Each population size is timed with the
+StageProfiler, results are written as json and optionally compared against a
+baseline json, the exit code is 1 if any stage regressed beyond the tolerance.
+
+Usage:
+    python benchmark.py --users 1000,10000 -o bench.json
+    python benchmark.py --users 1000,10000 -o new.json --baseline bench.json
+"""
+
+from __future__ import annotations
+
+import sys
+import json
+import time
+import platform
+import optparse
+import tempfile
+import numpy as np
+from pathlib import Path
+from typing import Dict, List
+from get_taz import (
+    read_loc_dict_file,
+    get_stop_edges
+)
+from scheduler import (
+    read_raw_schedule,
+    generate_itinerary
+)
+from trip_generator import (
+    fill_null_stop,
+    generate_trips
+)
+from fcd import fcd_to_csv
+from profiler import StageProfiler
+from lazy_import import lazy_module, lazy_sumolib
+from synthetic import (
+    synthetic_loc_dict,
+    synthetic_schedule,
+    grid_bbox,
+    write_grid_net,
+    write_fcd
+)
+
+
+pd = lazy_module("pandas")
+sumolib = lazy_sumolib()
+
+STAGES = [
+    "read_raw_schedule", "generate_itinerary", "get_stop_edges",
+    "fill_null_stop", "generate_trips", "fcd"
+]
+T = 7200
+R = 100
+
+optParser = optparse.OptionParser()
+optParser.add_option(
+    "-u", "--users", default="1000",
+    help="comma-separated population sizes, e.g., 1000,10000,1000000"
+)
+optParser.add_option("--stops", type="int", default=50, help="number of synthetic stops")  # noqa
+optParser.add_option("--grid", type="int", default=20, help="grid size of the synthetic net")  # noqa
+optParser.add_option(
+    "--stages", default=",".join(STAGES),
+    help="comma-separated subset of stages to run"
+)
+optParser.add_option(
+    "--fcd-steps", type="int", default=600,
+    help="simulated seconds of the synthetic fcd file (agents = users)"
+)
+optParser.add_option("-o", "--output", default="bench.json", help="result json file")  # noqa
+optParser.add_option("--baseline", default=None, help="baseline json to compare with")  # noqa
+optParser.add_option(
+    "--tolerance", type="float", default=0.2,
+    help="allowed relative slow-down of a stage before it counts as regression"
+)
+optParser.add_option(
+    "--min-delta", type="float", default=0.05,
+    help="slow-downs below this many seconds are treated as noise"
+)
+optParser.add_option("--seed", type="int", default=0, help="random seed")
+optParser.add_option("-d", "--work-dir", default=None, help="keep generated inputs here")  # noqa
+
+
+def bench_scale(
+    n_users: int,
+    stages: List[str],
+    work_dir: Path,
+    n_stops: int = 50,
+    grid: int = 20,
+    fcd_steps: int = 600,
+    seed: int = 0
+) -> Dict:
+    """
+    run the selected stages for one population size, return the stage records
+    """
+    np.random.seed(seed)
+    profiler = StageProfiler("bench_%d" % n_users)
+    loc_df = synthetic_loc_dict(n_stops, bbox=grid_bbox(grid, grid), seed=seed)
+    loc_file = work_dir.joinpath("loc_dict.csv")
+    loc_df.to_csv(loc_file, index=False)
+    sch_file = work_dir.joinpath("u%d.raw.csv" % n_users)
+    synthetic_schedule(n_users, loc_df["loc"].tolist(), seed=seed).to_csv(sch_file, index=False)  # noqa
+    net_file = work_dir.joinpath("grid%d.net.xml" % grid)
+    if not net_file.is_file():
+        write_grid_net(str(net_file), grid, grid)
+
+    # every stage depends on the previous ones, which run untimed if deselected
+    with profiler.stage("read_raw_schedule") as st:
+        raw_sch = read_raw_schedule(file_path=sch_file)
+        st.count(rows=raw_sch.shape[0])
+    with profiler.stage("generate_itinerary") as st:
+        itin_df, stop_distr = generate_itinerary(raw_sch=raw_sch, win_t=T)
+        st.count(users=len(stop_distr), slots=itin_df.shape[0])
+
+    net = None
+    stop2edges = None
+    if "get_stop_edges" in stages or "generate_trips" in stages:
+        net = sumolib.net.readNet(str(net_file))
+        loc_dict = read_loc_dict_file(file_path=loc_file)
+        with profiler.stage("get_stop_edges") as st:
+            stop2edges = get_stop_edges(net, loc_dict, R)
+            st.count(stops=len(stop2edges), edges=len(net.getEdges()))
+
+    if "fill_null_stop" in stages:
+        with profiler.stage("fill_null_stop") as st:
+            for uid, itin in itin_df.groupby('uid'):
+                itin = itin.drop(['uid', 'duration'], axis=1).set_index('timeslot')
+                fill_null_stop(df=itin, stop_distr=stop_distr[uid], eta=2)
+            st.count(users=len(stop_distr), slots=itin_df.shape[0])
+
+    if "generate_trips" in stages:
+        with profiler.stage("generate_trips") as st:
+            n_trips = generate_trips(
+                itin_df=itin_df,
+                stop_distr=stop_distr,
+                net=net,
+                stop2edges=stop2edges,
+                save_dir=work_dir,
+                prefix="u%d" % n_users
+            )
+            st.count(users=len(stop_distr), trips=n_trips)
+
+    if "fcd" in stages:
+        fcd_file = work_dir.joinpath("u%d.fcd.xml" % n_users)
+        n_points = write_fcd(str(fcd_file), n_users, fcd_steps, seed=seed)
+        with profiler.stage("fcd") as st:
+            fcd_to_csv(fcd_file, work_dir.joinpath("u%d.fcd.csv" % n_users))
+            st.count(points=n_points)
+
+    return {
+        st.name: st.to_dict() for st in profiler.stages if st.name in stages
+    }
+
+
+def compare(
+    results: Dict,
+    baseline: Dict,
+    tolerance: float,
+    min_delta: float = 0.05
+) -> List[str]:
+    """
+    compare wall times per (scale, stage), return a list of regressions
+    """
+    regressions = []
+    for scale, stages in results["results"].items():
+        base_stages = baseline.get("results", {}).get(scale, {})
+        for stage, rec in stages.items():
+            if stage not in base_stages:
+                continue
+            base_t = base_stages[stage]["wall_time"]
+            ratio = rec["wall_time"] / base_t if base_t > 0 else 1.0
+            flag = ""
+            if ratio > 1.0 + tolerance and rec["wall_time"] - base_t > min_delta:
+                flag = "REGRESSION"
+                regressions.append("%s/%s" % (scale, stage))
+            print("%10s %-20s %10.3fs %10.3fs %7.2fx %s" % (
+                scale, stage, base_t, rec["wall_time"], ratio, flag
+            ))
+    return regressions
+
+
+def main(args=None) -> int:
+    options, args = optParser.parse_args(args=args)
+    stages = options.stages.split(",")
+    for s in stages:
+        if s not in STAGES:
+            optParser.error("unknown stage: " + s)
+
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "stops": options.stops,
+            "grid": options.grid,
+            "seed": options.seed,
+        },
+        "results": {},
+    }
+    tmp = None
+    if options.work_dir:
+        work_dir = Path(options.work_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+    else:
+        tmp = tempfile.TemporaryDirectory(prefix="contrag_bench_")
+        work_dir = Path(tmp.name)
+
+    for n_users in [int(u) for u in options.users.split(",")]:
+        results["results"][str(n_users)] = bench_scale(
+            n_users, stages, work_dir,
+            n_stops=options.stops, grid=options.grid,
+            fcd_steps=options.fcd_steps, seed=options.seed
+        )
+        for stage, rec in results["results"][str(n_users)].items():
+            print("%10d %-20s %10.3fs wall %10.3fs cpu %s" % (
+                n_users, stage, rec["wall_time"], rec["cpu_time"], rec["counts"]
+            ))
+
+    with open(options.output, "w") as fd:
+        json.dump(results, fd, indent=2)
+    if tmp is not None:
+        tmp.cleanup()
+
+    if options.baseline:
+        with open(options.baseline) as fd:
+            baseline = json.load(fd)
+        regressions = compare(
+            results, baseline, options.tolerance, options.min_delta
+        )
+        if len(regressions) > 0:
+            print("regressions: " + ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
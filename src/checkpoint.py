@@ -0,0 +1,218 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     checkpoint.py
+# @author   Jian Yang
+# @date     2020-10-09
+
+"""
+checkpoints of long running stages, so that an interrupted run resumes from the
+last completed checkpoint instead of starting over.
+- trip generation: every chunk of users is a shard, its files are finalized
+  atomically (written as .part and renamed) and recorded in progress.json of
+  the checkpoint directory (see trip_generator.generate_trips_stream);
+- simulation: sumo saves its state every period seconds of simulation time,
+  a restarted run loads the latest complete state (see run.run_sumo).
+"""
+
+import os
+import re
+import gzip
+import json
+import shutil
+import logging
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+
+logging.basicConfig(format='checkpoint:%(levelname)s: %(message)s')
+
+PART = ".part"
+STATE_PREFIX = "state"
+STATE_SUFFIX = ".xml.gz"
+
+
+@contextmanager
+def atomic_open(path: str, mode: str = "w"):
+    """
+    open path for writing through <path>.part, which replaces path only if
+    the block completes
+    """
+    tmp = str(path) + PART
+    fd = open(tmp, mode)
+    try:
+        yield fd
+        fd.flush()
+        os.fsync(fd.fileno())
+        fd.close()
+        os.replace(tmp, path)
+    except BaseException:
+        fd.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def concat_files(
+    paths: List[str],
+    save_path: str,
+    header: str = "",
+    footer: str = ""
+) -> None:
+    """
+    atomically write header, the content of paths and footer into save_path
+    """
+    with atomic_open(save_path) as fd:
+        fd.write(header)
+        for p in paths:
+            with open(p) as src:
+                shutil.copyfileobj(src, fd)
+        fd.write(footer)
+
+
+class ShardCheckpoint():
+    def __init__(self, ckpt_dir: str):
+        """
+        progress of a sharded stage, shard files live in ckpt_dir and are named
+        <shard>.<name>
+        """
+        self.ckpt_dir = Path(ckpt_dir)
+        self.ckpt_dir.mkdir(parents=True, exist_ok=True)
+        self.progress_file = self.ckpt_dir.joinpath("progress.json")
+        self.shards = {}
+        if self.progress_file.is_file():
+            with open(self.progress_file) as fd:
+                self.shards = {int(k): v for k, v in json.load(fd)["shards"].items()}  # noqa
+            logging.info(
+                "resuming from %d completed shards in %s" % (len(self.shards), self.ckpt_dir)  # noqa
+            )
+
+    def done(self, k: int) -> Dict:
+        """
+        info of shard k if it was completed, else None
+        """
+        return self.shards.get(k)
+
+    def path(self, k: int, name: str) -> Path:
+        return self.ckpt_dir.joinpath("%06d.%s" % (k, name))
+
+    def commit(self, k: int, info: Dict) -> None:
+        """
+        mark shard k as completed, all its files have to be written already
+        """
+        self.shards[k] = info
+        with atomic_open(self.progress_file) as fd:
+            json.dump({"shards": self.shards}, fd, indent=1)
+
+    def paths(self, name: str) -> List[Path]:
+        """
+        files called name of all completed shards in order
+        """
+        return [self.path(k, name) for k in sorted(self.shards)]
+
+    def clear(self) -> None:
+        shutil.rmtree(self.ckpt_dir, ignore_errors=True)
+
+
+def _state_time(path: Path, prefix: str) -> float:
+    m = re.match(
+        re.escape(prefix) + r"_(\d+(?:\.\d+)?)" + re.escape(STATE_SUFFIX) + "$", path.name  # noqa
+    )
+    return None if m is None else float(m.group(1))
+
+
+def _state_complete(path: Path) -> bool:
+    # a state written while sumo was killed ends in a truncated gzip stream
+    try:
+        with gzip.open(path, "rb") as fd:
+            while fd.read(1 << 20):
+                pass
+        return True
+    except (OSError, EOFError):
+        return False
+
+
+def latest_state(
+    state_dir: str,
+    prefix: str = STATE_PREFIX
+) -> Tuple[float, Path]:
+    """
+    (time, path) of the latest complete sumo state in state_dir, None if there
+    is none
+    """
+    if state_dir is None or not Path(state_dir).is_dir():
+        return None
+    states = []
+    for p in Path(state_dir).iterdir():
+        t = _state_time(p, prefix)
+        if t is not None:
+            states.append((t, p))
+    for t, p in sorted(states, reverse=True):
+        if _state_complete(p):
+            return t, p
+        logging.warning("skipping incomplete state: %s" % p)
+    return None
+
+
+def _cfg_value(cfg_file: str, option: str) -> str:
+    for node in ET.parse(str(cfg_file)).getroot().iter(option):
+        return node.get("value")
+    return None
+
+
+def sumo_state_args(
+    state_dir: str,
+    period: float,
+    cfg_file: str = None,
+    prefix: str = STATE_PREFIX
+) -> List[str]:
+    """
+    sumo options saving the state every period seconds into state_dir, and
+    loading the latest complete state there if any. on resume, the fcd output
+    of cfg_file is redirected to <fcd-output stem>.from<time>.xml so that the
+    output written before the interruption is kept.
+    """
+    Path(state_dir).mkdir(parents=True, exist_ok=True)
+    args = [
+        "--save-state.period", str(period),
+        "--save-state.prefix", str(Path(state_dir).joinpath(prefix)),
+        "--save-state.suffix", STATE_SUFFIX,
+        "--save-state.rng", "true",
+    ]
+    state = latest_state(state_dir, prefix)
+    if state is None:
+        return args
+    t, path = state
+    logging.info("resuming the simulation at %.2f from %s" % (t, path))
+    args += ["--load-state", str(path), "--begin", "%.2f" % t]
+    fcd = None if cfg_file is None else _cfg_value(cfg_file, "fcd-output")
+    if fcd is not None:
+        fcd = Path(cfg_file).parent.joinpath(fcd)
+        name = fcd.name[:-len(".xml")] if fcd.name.endswith(".xml") else fcd.name  # noqa
+        args += ["--fcd-output", str(fcd.with_name("%s.from%d.xml" % (name, t)))]  # noqa
+    return args
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    wd = Path(__file__).parents[1].absolute()
+    print(sumo_state_args(
+        wd.joinpath('output', 'state'), 3600,
+        cfg_file=wd.joinpath('exp', 'notre_dame.sumocfg')
+    ))
+
+    print(0)
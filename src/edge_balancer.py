@@ -0,0 +1,201 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     edge_balancer.py
+# @author   Jian Yang
+# @date     2020-10-19
+
+"""
+load-balanced departure edges of the triggered cars and bikes.
+Drawing a car edge of a stop uniformly (see trip_generator._draw_edges) puts
+the departures of a popular stop, e.g., the dorms at 8am, on the same few
+edges, and sumo has to delay their insertion. EdgeBalancer counts departures
+per edge and time window, and gives each departure the candidate edge of its
+stop with the least departures per lane in its window (ties are random).
+"""
+
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Tuple
+from get_taz import (
+    read_loc_dict_file,
+    get_stop_edges
+)
+from checkpoint import atomic_open
+from lazy_import import lazy_sumolib
+
+sumolib = lazy_sumolib()
+
+
+WINDOW = 300  # in seconds, departures in the same window compete for lanes
+VCLASSES = ("passenger", "bicycle")  # lanes counted as departure capacity
+
+
+class EdgeBalancer():
+    def __init__(
+        self,
+        net,
+        stop2edges: Dict,
+        window: float = WINDOW
+    ):
+        """
+        departure edges of a stop are its car (or bike) edges, or its ped
+        edges if it has none (same pools as trip_generator._draw_edges)
+        """
+        self.net = net
+        self.stop2edges = stop2edges
+        self.window = window
+        self.usage = {}  # (window, edge) -> number of departures
+        self.capacity = {}  # edge -> lanes
+        self._pools = {}
+
+    def _pool(self, stop: str, kind: str = "car_edges") -> Tuple:
+        """
+        (edges, lane capacity) of the departure edges of stop, kind is
+        car_edges or bike_edges (car edges if the stop has no bike_edges)
+        """
+        pool = self._pools.get((stop, kind))
+        if pool is not None:
+            return pool
+        if stop not in self.stop2edges:
+            raise KeyError("taz " + str(stop) + " not found in taz files.")
+        edges = self.stop2edges[stop]['car_edges']
+        edges = list(self.stop2edges[stop].get(kind, edges))
+        if len(edges) == 0:
+            edges = list(self.stop2edges[stop]['ped_edges'])
+        capacity = np.array([
+            max(1, sum(1 for lane in self.net.getEdge(e).getLanes() if any(lane.allows(v) for v in VCLASSES)))  # noqa
+            for e in edges
+        ], dtype=np.float64)
+        self.capacity.update(zip(edges, capacity))
+        pool = (edges, capacity)
+        self._pools[(stop, kind)] = pool
+        return pool
+
+    def _allocate(
+        self,
+        stop: str,
+        win: int,
+        m: int,
+        kind: str = "car_edges"
+    ) -> List[str]:
+        """
+        m departures from stop in window win, one at a time to the edge with
+        the least departures per lane after taking it
+        """
+        edges, capacity = self._pool(stop, kind)
+        if len(edges) == 0:
+            return [None] * m
+        load = np.array([self.usage.get((win, e), 0) for e in edges], dtype=np.float64)  # noqa
+        picks = []
+        for _ in range(m):
+            cost = (load + 1) / capacity
+            best = np.flatnonzero(cost == cost.min())
+            j = best[np.random.randint(len(best))] if len(best) > 1 else best[0]  # noqa
+            load[j] += 1
+            picks.append(edges[j])
+        for j, e in enumerate(edges):
+            if load[j] > 0:
+                self.usage[(win, e)] = int(load[j])
+        return picks
+
+    def draw(
+        self,
+        stops: np.array,
+        times: np.array,
+        kind: str = "car_edges"
+    ) -> np.array:
+        """
+        bulk departure edges of stops at times from their kind edges (see
+        _pool), None if a stop has no edge
+        """
+        edges = np.full(len(stops), None, dtype=object)
+        if len(stops) == 0:
+            return edges
+        win = np.floor(np.asarray(times, dtype=np.float64) / self.window).astype(np.int64)  # noqa
+        stops = np.asarray(stops, dtype=object)
+        # groups of departures of the same stop and window
+        order = np.lexsort((win, stops.astype(str)))
+        s, w = stops[order], win[order]
+        cut = np.flatnonzero((s[1:] != s[:-1]) | (w[1:] != w[:-1])) + 1
+        for lo, hi in zip(np.r_[0, cut], np.r_[cut, len(order)]):
+            picks = self._allocate(s[lo], int(w[lo]), hi - lo, kind)
+            # which of the departures gets which edge is random
+            edges[order[lo:hi]] = np.random.permutation(np.array(picks, dtype=object))  # noqa
+        return edges
+
+    def release(
+        self,
+        edges: np.array,
+        times: np.array
+    ) -> None:
+        """
+        undo departures of draw() at times, e.g., of trips dropped afterwards
+        """
+        win = np.floor(np.asarray(times, dtype=np.float64) / self.window).astype(np.int64)  # noqa
+        for w, e in zip(win, edges):
+            if e is None:
+                continue
+            n = self.usage.get((int(w), e), 0) - 1
+            if n > 0:
+                self.usage[(int(w), e)] = n
+            else:
+                self.usage.pop((int(w), e), None)
+
+    def peak(self) -> float:
+        """
+        max. departures per lane of an edge within a window
+        """
+        if len(self.usage) == 0:
+            return 0.0
+        return max(
+            n / self.capacity.get(e, 1.0) for (_, e), n in self.usage.items()
+        )
+
+    def save(self, path: str) -> None:
+        """
+        atomically write the departure counts, see load()
+        """
+        keys = list(self.usage)
+        with atomic_open(path, "wb") as fd:
+            np.savez(
+                fd,
+                window=np.array([k[0] for k in keys], dtype=np.int64),
+                edge=np.array([k[1] for k in keys], dtype=str),
+                count=np.array([self.usage[k] for k in keys], dtype=np.int64)
+            )
+
+    def load(self, path: str) -> None:
+        """
+        replace the departure counts with those written by save()
+        """
+        with np.load(str(path)) as data:
+            self.usage = {
+                (int(w), str(e)): int(n)
+                for w, e, n in zip(data["window"], data["edge"], data["count"])
+            }
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    wd = Path(__file__).parents[1].absolute()
+    net = sumolib.net.readNet(str(wd.joinpath('data', 'map', 'notre_dame.net.xml')))  # noqa
+    loc_dict = read_loc_dict_file(wd.joinpath('data', 'map', 'notre_dame_loc_dict.csv'))  # noqa
+    balancer = EdgeBalancer(net, get_stop_edges(net, loc_dict, 100))
+    stops = np.array([next(iter(balancer.stop2edges))] * 20, dtype=object)
+    print(balancer.draw(stops, np.full(20, 8 * 3600.0)))
+    print(balancer.usage, balancer.peak())
+
+    print(0)
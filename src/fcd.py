@@ -0,0 +1,135 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     fcd.py
+# @author   Jian Yang
+# @date     2020-09-09
+
+"""
+convert sumo fcd output (with fcd-output.geo) into columnar trajectory data.
+The file is streamed and returned in chunks of rows, so that week-long outputs
+never have to fit into memory. Columns of a chunk (FCD_COLUMNS):
+    time, id, kind (person/vehicle), type, x (lng), y (lat), angle, speed, pos, edge
+"""
+
+from __future__ import annotations
+
+import xml.etree.ElementTree as ET
+import numpy as np
+from pathlib import Path
+from typing import Iterator
+from lazy_import import lazy_module
+
+pd = lazy_module("pandas")
+
+
+FCD_COLUMNS = ["time", "id", "kind", "type", "x", "y", "angle", "speed", "pos", "edge"]
+FCD_DTYPES = {
+    "time": np.float64,
+    "x": np.float64,
+    "y": np.float64,
+    "angle": np.float32,
+    "speed": np.float32,
+    "pos": np.float32,
+}
+CHUNK_SIZE = 1000000
+
+
+def _to_frame(cols: dict) -> pd.DataFrame:
+    df = pd.DataFrame(cols, columns=FCD_COLUMNS)
+    return df.astype(FCD_DTYPES)
+
+
+def iter_fcd_chunks(
+    fcd_file: str,
+    chunk_size: int = CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    """
+    stream a fcd xml file, yield DataFrames of at most chunk_size points
+    """
+    cols = {c: [] for c in FCD_COLUMNS}
+    n = 0
+    t = None
+    root = None
+    context = ET.iterparse(str(fcd_file), events=("start", "end"))
+    for event, elem in context:
+        tag = elem.tag
+        if event == "start":
+            if root is None:
+                root = elem
+            elif tag == "timestep":
+                t = float(elem.get("time"))
+            continue
+        if tag == "person" or tag == "vehicle":
+            a = elem.attrib
+            cols["time"].append(t)
+            cols["id"].append(a["id"])
+            cols["kind"].append(tag)
+            cols["type"].append(a.get("type", ""))
+            cols["x"].append(a["x"])
+            cols["y"].append(a["y"])
+            cols["angle"].append(a.get("angle", 0))
+            cols["speed"].append(a.get("speed", 0))
+            cols["pos"].append(a.get("pos", 0))
+            if "edge" in a:
+                cols["edge"].append(a["edge"])
+            else:
+                lane = a.get("lane", "")
+                cols["edge"].append(lane[:lane.rfind("_")])
+            n += 1
+            if n >= chunk_size:
+                yield _to_frame(cols)
+                cols = {c: [] for c in FCD_COLUMNS}
+                n = 0
+        elif tag == "timestep":
+            # the points are consumed, release the timestep and its children
+            root.clear()
+    if n > 0:
+        yield _to_frame(cols)
+
+
+def read_fcd(
+    fcd_file: str
+) -> pd.DataFrame:
+    chunks = list(iter_fcd_chunks(fcd_file))
+    if len(chunks) == 0:
+        return _to_frame({c: [] for c in FCD_COLUMNS})
+    return pd.concat(chunks, axis=0, ignore_index=True)
+
+
+def fcd_to_csv(
+    fcd_file: str,
+    save_path: str,
+    chunk_size: int = CHUNK_SIZE
+) -> int:
+    """
+    convert a fcd xml file into csv chunk by chunk, return the number of points
+    """
+    n = 0
+    header = True
+    for chunk in iter_fcd_chunks(fcd_file, chunk_size):
+        chunk.to_csv(save_path, mode="w" if header else "a", header=header, index=False)  # noqa
+        header = False
+        n += chunk.shape[0]
+    if header:
+        _to_frame({c: [] for c in FCD_COLUMNS}).to_csv(save_path, index=False)
+    return n
+
+
+if __name__ == "__main__":
+    wd = Path(__file__).parents[1].absolute()
+    fcd_file = wd.joinpath('output', 'notre_dame.fcd.xml')
+    save_path = wd.joinpath('output', 'notre_dame.fcd.csv')
+    fcd_to_csv(fcd_file, save_path)
+
+    print(0)
@@ -15,19 +15,18 @@
 # @author   Jian Yang
 # @date     2020-07-01
 
+from __future__ import annotations
+
 MAX_NEIGHBOR = 8
 
 import os, sys
 import csv
 import logging
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-else:
-    sys.exit("please declare environment variable 'SUMO_HOME'")
-import sumolib
 from typing import Tuple, List, Dict, TextIO
 from pathlib import Path
+from lazy_import import lazy_sumolib
+
+sumolib = lazy_sumolib()
 
 logging.basicConfig(format='get_taz:%(levelname)s: %(message)s')
 
@@ -0,0 +1,215 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     gps_noise.py
+# @author   Jian Yang
+# @date     2020-09-23
+
+"""
+degrade perfect fcd positions into GPS-like traces (see fcd.py for the chunk
+columns). A DeviceModel applies, per agent:
+- resampling: one point every interval seconds, with a per-device phase;
+- dropouts: signal gaps of dropout_len seconds with probability dropout_rate;
+- positional noise: gaussian with sigma meters per axis;
+- clock error: a per-device offset plus gaussian jitter of the timestamps.
+All random numbers are hashed from (seed, agent id, time), so results do not
+depend on how the fcd file is split into chunks.
+"""
+
+import zlib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Iterator
+from fcd import (
+    FCD_COLUMNS,
+    CHUNK_SIZE,
+    iter_fcd_chunks
+)
+
+
+EARTH_R = 6371000.0
+SIGMA = 5.0  # positional noise (in meters) per axis
+INTERVAL = 5.0  # sampling interval (in seconds) of a device
+CLOCK_OFFSET = 1.0  # std. of the per-device clock offset (in seconds)
+JITTER = 0.2  # std. of the per-sample clock jitter (in seconds)
+DROPOUT_RATE = 0.02  # probability that a dropout window has no signal
+DROPOUT_LEN = 120.0  # length (in seconds) of a dropout window
+
+_M1 = np.uint64(0xbf58476d1ce4e5b9)
+_M2 = np.uint64(0x94d049bb133111eb)
+_GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+
+
+def _mix(h: np.array) -> np.array:
+    """
+    splitmix64 finalizer, maps uint64 to well distributed uint64
+    """
+    h = h ^ (h >> np.uint64(30))
+    h = h * _M1
+    h = h ^ (h >> np.uint64(27))
+    h = h * _M2
+    return h ^ (h >> np.uint64(31))
+
+
+def _uniform(
+    agent: np.array,
+    key: np.array,
+    stream: int
+) -> np.array:
+    """
+    uniform (0, 1) numbers hashed from an agent hash, a key and a stream id
+    """
+    with np.errstate(over="ignore"):
+        h = _mix(agent ^ (np.uint64(stream) * _GOLDEN))
+        h = _mix(h + key.astype(np.int64).astype(np.uint64) * _GOLDEN)
+    return ((h >> np.uint64(11)).astype(np.float64) + 0.5) / float(1 << 53)
+
+
+def _normal(
+    agent: np.array,
+    key: np.array,
+    stream: int
+) -> np.array:
+    # Box-Muller from two hashed uniforms
+    u1 = _uniform(agent, key, stream)
+    u2 = _uniform(agent, key, stream + 1)
+    return np.sqrt(-2.0 * np.log(u1)) * np.cos(2.0 * np.pi * u2)
+
+
+class DeviceModel():
+    def __init__(
+        self,
+        sigma: float = SIGMA,
+        interval: float = INTERVAL,
+        step: float = 1.0,
+        clock_offset: float = CLOCK_OFFSET,
+        jitter: float = JITTER,
+        dropout_rate: float = DROPOUT_RATE,
+        dropout_len: float = DROPOUT_LEN,
+        geo: bool = True,
+        seed: int = 0
+    ):
+        """
+        step: time step (in seconds) of the fcd output
+        geo: x/y are lng/lat (fcd-output.geo), else meters
+        """
+        if interval < step:
+            raise ValueError("interval must not be smaller than the fcd step!")
+        self.sigma = sigma
+        self.interval = interval
+        self.step = step
+        self.clock_offset = clock_offset
+        self.jitter = jitter
+        self.dropout_rate = dropout_rate
+        self.dropout_len = dropout_len
+        self.geo = geo
+        self.seed = seed
+
+    def agent_hash(
+        self,
+        ids: np.array
+    ) -> np.array:
+        codes, uniq = pd.factorize(ids)
+        h = np.array(
+            [zlib.crc32(str(a).encode()) for a in uniq], dtype=np.uint64
+        )
+        with np.errstate(over="ignore"):
+            h = _mix(h ^ (np.uint64(self.seed) * _GOLDEN))
+        return h[codes]
+
+    def apply(
+        self,
+        chunk: pd.DataFrame
+    ) -> pd.DataFrame:
+        """
+        degrade a chunk of fcd points, return the remaining points
+        """
+        agent = self.agent_hash(chunk["id"].values)
+        t = chunk["time"].values
+        tick = np.round(t / self.step).astype(np.int64)
+        dev = np.zeros(t.size, dtype=np.int64)
+
+        # resampling, every device starts at its own phase
+        phase = np.floor(_uniform(agent, dev, 0) * self.interval / self.step) * self.step  # noqa
+        keep = np.mod(t - phase, self.interval) < self.step - 1e-9
+        # dropouts
+        if self.dropout_rate > 0:
+            window = np.floor(t / self.dropout_len).astype(np.int64)
+            keep &= _uniform(agent, window, 2) >= self.dropout_rate
+
+        agent, t, tick, dev = agent[keep], t[keep], tick[keep], dev[keep]
+        df = chunk[keep].copy()
+
+        # positional noise
+        dx = _normal(agent, tick, 4) * self.sigma
+        dy = _normal(agent, tick, 6) * self.sigma
+        if self.geo:
+            lat = df["y"].values
+            df["y"] = lat + np.degrees(dy / EARTH_R)
+            df["x"] = df["x"].values + np.degrees(dx / EARTH_R / np.cos(np.radians(lat)))  # noqa
+        else:
+            df["x"] = df["x"].values + dx
+            df["y"] = df["y"].values + dy
+
+        # clock error
+        df["time"] = t + _normal(agent, dev, 8) * self.clock_offset \
+            + _normal(agent, tick, 10) * self.jitter
+        return df
+
+
+def iter_noisy(
+    fcd_file: str,
+    model: DeviceModel,
+    chunk_size: int = CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    """
+    stream a fcd xml file, yield degraded chunks
+    """
+    for chunk in iter_fcd_chunks(fcd_file, chunk_size):
+        yield model.apply(chunk)
+
+
+def degrade_fcd(
+    fcd_file: str,
+    save_path: str,
+    model: DeviceModel = None,
+    chunk_size: int = CHUNK_SIZE
+) -> int:
+    """
+    write a degraded fcd xml file as csv chunk by chunk, return the number of
+    points written
+    """
+    if model is None:
+        model = DeviceModel()
+    n = 0
+    header = True
+    for chunk in iter_noisy(fcd_file, model, chunk_size):
+        chunk.to_csv(save_path, mode="w" if header else "a", header=header, index=False)  # noqa
+        header = False
+        n += chunk.shape[0]
+    if header:
+        pd.DataFrame(columns=FCD_COLUMNS).to_csv(save_path, index=False)
+    return n
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    wd = Path(__file__).parents[1].absolute()
+    fcd_file = wd.joinpath('output', 'notre_dame.fcd.xml')
+    save_path = wd.joinpath('output', 'notre_dame.gps.csv')
+    degrade_fcd(fcd_file, save_path, DeviceModel(seed=0))
+
+    print(0)
@@ -0,0 +1,121 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     lazy_import.py
+# @author   Jian Yang
+# @date     2020-10-12
+
+"""
+lazy imports of heavy dependencies (pandas, sumolib).
+A lazy module is a placeholder imported on first attribute access, so modules
+only pay for pandas or sumolib on the code paths that use them, and the parts
+not using sumolib work without SUMO_HOME (which is not needed either if
+sumolib is installed as a package). Modules using a lazy module declare
+`from __future__ import annotations`, so that annotations such as pd.DataFrame
+do not trigger the import.
+
+Usage:
+    pd = lazy_module("pandas")
+    sumolib = lazy_sumolib()
+"""
+
+import os
+import sys
+import importlib
+import threading
+import types
+
+
+_lock = threading.Lock()
+
+
+def sumo_tools() -> str:
+    """
+    add $SUMO_HOME/tools to sys.path, return it
+    """
+    if 'SUMO_HOME' not in os.environ:
+        raise ImportError("please declare environment variable 'SUMO_HOME'")
+    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
+    with _lock:
+        if tools not in sys.path:
+            sys.path.append(tools)
+    return tools
+
+
+def import_sumo(name: str = "sumolib") -> types.ModuleType:
+    """
+    import a sumo python module, e.g., sumolib or traci: an installed package
+    (pip install eclipse-sumo), else the one of $SUMO_HOME/tools
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        pass
+    sumo_tools()
+    return importlib.import_module(name)
+
+
+class LazyModule(types.ModuleType):
+    def __init__(self, name: str, loader=importlib.import_module):
+        super().__init__(name)
+        self.__dict__["_loader"] = loader
+        self.__dict__["_module"] = None
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__["_module"]
+        if module is None:
+            module = self.__dict__["_loader"](self.__name__)
+            # later lookups are served from __dict__ without __getattr__
+            self.__dict__.update(module.__dict__)
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"  # noqa
+        return "<lazy module '%s' (%s)>" % (self.__name__, state)
+
+
+def lazy_module(name: str) -> LazyModule:
+    """
+    return the module if it was imported already, else a lazy placeholder
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+def lazy_sumolib(name: str = "sumolib") -> LazyModule:
+    """
+    lazy import_sumo(), ImportError on first use if sumolib is neither
+    installed nor found in $SUMO_HOME/tools
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name, loader=import_sumo)
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    pd = lazy_module("pandas")
+    print(pd, "pandas" in sys.modules)
+    print(pd.DataFrame({"a": [1]}).shape, pd)
+
+    print(0)
@@ -0,0 +1,313 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     loc_index.py
+# @author   Jian Yang
+# @date     2020-09-17
+
+"""
+spatial index over the locations of a loc_dict, to map coordinates (e.g., stay
+points of GPS traces) to the named stops understood by stop2edges.
+Locations (GeoPoint, or GeoPoly by their vertices and area) are projected into
+local metric coordinates and bucketed into a uniform grid, all queries take
+arrays of coordinates:
+- nearest(): nearest location and its distance for each coordinate;
+- within(): all locations within a radius of each coordinate;
+- match(): nearest location, or OTHER_STOP if farther than max_dist.
+nearest() searches ring by ring of cells around each query, until the nearest
+location found is closer than the unsearched cells, or all cells within the
+bound are searched. Queries are evaluated in batches of at most MAX_PAIRS
+(query, point) pairs.
+A LocationIndex can be used as loc_mapper of scheduler.extract_schedule().
+"""
+
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Tuple
+from get_taz import (
+    GeoPoly,
+    read_loc_dict_file
+)
+
+
+EARTH_R = 6371000.0
+CELL_SIZE = 200.0  # in meters, without max_dist
+OTHER_STOP = "other"
+MAX_PAIRS = 1 << 20  # (query, point) distances computed at once
+
+
+class LocationIndex():
+    def __init__(
+        self,
+        loc_dict: Dict,
+        cell: float = None,
+        max_dist: float = None,
+        other: str = OTHER_STOP
+    ):
+        """
+        loc_dict: {loc: GeoPoint or GeoPoly}
+        cell: grid cell size in meters, defaults to max_dist (match() then
+        searches 3x3 cells), or CELL_SIZE
+        max_dist: default threshold (in meters) of match()
+        """
+        if len(loc_dict) == 0:
+            raise ValueError("empty location dict!")
+        if cell is None:
+            cell = CELL_SIZE if max_dist is None else max_dist
+        self.cell = float(cell)
+        self.max_dist = max_dist
+        self.other = other
+        self.names = np.array(list(loc_dict.keys()), dtype=object)
+
+        lat, lng, owner = [], [], []
+        self._polys = []  # (loc index, x array, y array)
+        for i, loc in enumerate(loc_dict.values()):
+            if isinstance(loc, GeoPoly):
+                if len(loc.vertices) == 0:
+                    raise ValueError("not a valid polygon!")
+                lat += [v.lat for v in loc.vertices]
+                lng += [v.lng for v in loc.vertices]
+                owner += [i] * len(loc.vertices)
+            else:
+                lat.append(loc.lat)
+                lng.append(loc.lng)
+                owner.append(i)
+        lat, lng = np.array(lat), np.array(lng)
+        # local equirectangular projection around the center of all locations
+        self._lat0 = np.radians(lat.mean())
+        self._lng0 = np.radians(lng.mean())
+        self._x, self._y = self.project(lat, lng)
+        self._owner = np.array(owner, dtype=np.int64)
+        for i, loc in enumerate(loc_dict.values()):
+            if isinstance(loc, GeoPoly) and len(loc.vertices) >= 3:
+                px, py = self._x[self._owner == i], self._y[self._owner == i]
+                self._polys.append((i, px, py))
+
+        cx, cy = self._cell_of(self._x, self._y)
+        keys = self._key(cx, cy)
+        order = np.argsort(keys, kind="mergesort")
+        self._keys = keys[order]
+        self._pt = order
+        # the same points sorted by rows, so that the cells of a row are one
+        # range of keys too
+        keys = self._key(cy, cx)
+        order = np.argsort(keys, kind="mergesort")
+        self._rkeys = keys[order]
+        self._rpt = order
+        self._bbox = (cx.min(), cx.max(), cy.min(), cy.max())
+
+    def project(self, lat, lng) -> Tuple[np.array]:
+        lat, lng = np.radians(np.asarray(lat, dtype=np.float64)), np.radians(np.asarray(lng, dtype=np.float64))  # noqa
+        x = (lng - self._lng0) * np.cos(self._lat0) * EARTH_R
+        y = (lat - self._lat0) * EARTH_R
+        return x, y
+
+    def _cell_of(self, x, y):
+        return np.floor(x / self.cell).astype(np.int64), np.floor(y / self.cell).astype(np.int64)  # noqa
+
+    @staticmethod
+    def _key(cx, cy):
+        return (cx + (1 << 31)) * (1 << 32) + (cy + (1 << 31))
+
+    def _candidates(self, x, y, rings: int) -> Tuple[np.array]:
+        """
+        (query index, point index) pairs of all points in the (2*rings+1)^2
+        cells around each query
+        """
+        cx, cy = self._cell_of(x, y)
+        q_all, p_all = [], []
+        for dx in range(-rings, rings + 1):
+            for dy in range(-rings, rings + 1):
+                keys = self._key(cx + dx, cy + dy)
+                lo = np.searchsorted(self._keys, keys, side="left")
+                hi = np.searchsorted(self._keys, keys, side="right")
+                cnt = hi - lo
+                if cnt.sum() == 0:
+                    continue
+                q = np.repeat(np.arange(x.size), cnt)
+                # positions lo[q] + 0..cnt[q]-1
+                offs = np.arange(q.size) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+                q_all.append(q)
+                p_all.append(self._pt[np.repeat(lo, cnt) + offs])
+        if len(q_all) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(q_all), np.concatenate(p_all)
+
+    def _ring(self, cx, cy, r) -> List[Tuple[np.array]]:
+        """
+        (points, first position, count) of the cells at distance r (in cells)
+        around each query cell, as the two columns and the two rows of the
+        ring, each a range of the sorted keys
+        """
+        sides = []
+        for keys, pt, lo, hi in (
+            (self._keys, self._pt, self._key(cx - r, cy - r), self._key(cx - r, cy + r)),  # noqa
+            (self._keys, self._pt, self._key(cx + r, cy - r), self._key(cx + r, cy + r)),  # noqa
+            (self._rkeys, self._rpt, self._key(cy - r, cx - r + 1), self._key(cy - r, cx + r - 1)),  # noqa
+            (self._rkeys, self._rpt, self._key(cy + r, cx - r + 1), self._key(cy + r, cx + r - 1)),  # noqa
+        ):
+            lo_i = np.searchsorted(keys, lo, side="left")
+            cnt = np.maximum(np.searchsorted(keys, hi, side="right") - lo_i, 0)
+            sides.append((pt, lo_i, cnt))
+        # ring 0 is the query cell alone, only its first column
+        sides[1][2][r == 0] = 0
+        return sides
+
+    def _scan_ring(self, x, y, q, r, best_d, best_p) -> None:
+        """
+        update best_d and best_p of queries q with the points of their ring r,
+        in batches of at most MAX_PAIRS pairs (or a single query)
+        """
+        cx, cy = self._cell_of(x[q], y[q])
+        sides = self._ring(cx, cy, r)
+        total = sum(cnt for _, _, cnt in sides)
+        batch = (np.cumsum(total) - total) // MAX_PAIRS
+        cut = np.r_[0, np.flatnonzero(batch[1:] != batch[:-1]) + 1, q.size]
+        for a, b in zip(cut[:-1], cut[1:]):
+            if total[a:b].sum() == 0:
+                continue
+            qq, pp = [], []
+            for pt, lo, cnt in sides:
+                c = cnt[a:b]
+                k = np.repeat(np.arange(a, b), c)
+                # positions lo + 0..cnt-1
+                offs = np.arange(k.size) - np.repeat(np.cumsum(c) - c, c)
+                qq.append(q[k])
+                pp.append(pt[np.repeat(lo[a:b], c) + offs])
+            qq, pp = np.concatenate(qq), np.concatenate(pp)
+            d = np.hypot(x[qq] - self._x[pp], y[qq] - self._y[pp])
+            order = np.lexsort((d, qq))
+            qq, pp, d = qq[order], pp[order], d[order]
+            first = np.r_[True, qq[1:] != qq[:-1]]
+            qq, pp, d = qq[first], pp[first], d[first]
+            better = d < best_d[qq]
+            best_d[qq[better]] = d[better]
+            best_p[qq[better]] = pp[better]
+
+    def _inside_polys(self, x, y) -> Tuple[np.array]:
+        """
+        (query index, loc index) pairs of queries inside a polygon location
+        """
+        q_all, l_all = [], []
+        for i, px, py in self._polys:
+            cand = np.flatnonzero(
+                (x >= px.min()) & (x <= px.max()) & (y >= py.min()) & (y <= py.max())
+            )
+            if cand.size == 0:
+                continue
+            qx, qy = x[cand][:, None], y[cand][:, None]
+            x1, y1 = px[None, :], py[None, :]
+            x2, y2 = np.roll(px, -1)[None, :], np.roll(py, -1)[None, :]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                cross = ((y1 > qy) != (y2 > qy)) \
+                    & (qx < (x2 - x1) * (qy - y1) / (y2 - y1) + x1)
+            inside = cand[np.mod(cross.sum(axis=1), 2) == 1]
+            q_all.append(inside)
+            l_all.append(np.full(inside.size, i, dtype=np.int64))
+        if len(q_all) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(q_all), np.concatenate(l_all)
+
+    def nearest(self, lat, lng, bound: float = None) -> Tuple[np.array]:
+        """
+        nearest location name and distance (in meters) of each coordinate.
+        bound: if given, locations farther than bound need not be exact, and
+        coordinates without a location within bound get the "other" stop and
+        an infinite distance
+        """
+        x, y = self.project(np.atleast_1d(lat), np.atleast_1d(lng))
+        n = x.size
+        best_d = np.full(n, np.inf)
+        best_p = np.full(n, -1, dtype=np.int64)
+
+        # rings (in cells) to the nearest and the farthest cell of the grid
+        cx, cy = self._cell_of(x, y)
+        x0, x1, y0, y1 = self._bbox
+        zero = np.zeros(n, dtype=np.int64)
+        r = np.maximum.reduce([x0 - cx, cx - x1, y0 - cy, cy - y1, zero])
+        r_max = np.maximum.reduce([cx - x0, x1 - cx, cy - y0, y1 - cy, zero])
+        q = np.arange(n)
+        if bound is not None:
+            # points of ring r are farther than (r - 1) cells
+            q = q[(r - 1) * self.cell < bound]
+        while q.size > 0:
+            self._scan_ring(x, y, q, r[q], best_d, best_p)
+            # points beyond ring r are farther than r cells
+            done = (best_d[q] <= r[q] * self.cell) | (r[q] >= r_max[q])
+            if bound is not None:
+                done |= r[q] * self.cell >= bound
+            q = q[~done]
+            r[q] += 1
+
+        names = np.where(best_p >= 0, self.names[self._owner[best_p]], self.other)  # noqa
+        qi, li = self._inside_polys(x, y)
+        best_d[qi] = 0.0
+        names[qi] = self.names[li]
+        return names, best_d
+
+    def within(self, lat, lng, radius: float) -> Tuple[np.array]:
+        """
+        all locations within radius (in meters) of each coordinate, returned as
+        flat arrays (query index, location name, distance) sorted by query
+        """
+        x, y = self.project(np.atleast_1d(lat), np.atleast_1d(lng))
+        rings = int(np.ceil(radius / self.cell))
+        q, p = self._candidates(x, y, rings)
+        d = np.hypot(x[q] - self._x[p], y[q] - self._y[p])
+        loc = self._owner[p]
+        qi, li = self._inside_polys(x, y)
+        q = np.r_[q, qi]
+        loc = np.r_[loc, li]
+        d = np.r_[d, np.zeros(qi.size)]
+        keep = d <= radius
+        q, loc, d = q[keep], loc[keep], d[keep]
+        # one row per (query, location) with the smallest distance
+        order = np.lexsort((d, loc, q))
+        q, loc, d = q[order], loc[order], d[order]
+        first = np.r_[True, (q[1:] != q[:-1]) | (loc[1:] != loc[:-1])]
+        q, loc, d = q[first], loc[first], d[first]
+        order = np.lexsort((d, q))
+        return q[order], self.names[loc[order]], d[order]
+
+    def match(self, lat, lng, max_dist: float = None) -> np.array:
+        """
+        nearest location of each coordinate, or the "other" stop if it is
+        farther than max_dist (defaults to the max_dist of the index)
+        """
+        if max_dist is None:
+            max_dist = self.max_dist
+        names, dist = self.nearest(lat, lng, bound=max_dist)
+        if max_dist is not None:
+            names = np.where(dist > max_dist, self.other, names)
+        return names
+
+    def __call__(self, lat, lng) -> np.array:
+        return self.match(lat, lng)
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    wd = Path(__file__).parents[1].absolute()
+    loc_dict_file = wd.joinpath('data', 'map', 'notre_dame_loc_dict.csv')
+    loc_dict = read_loc_dict_file(file_path=loc_dict_file)
+
+    index = LocationIndex(loc_dict, max_dist=150)
+    lat = np.random.uniform(41.69, 41.71, 10)
+    lng = np.random.uniform(-86.25, -86.23, 10)
+    print(index.nearest(lat, lng))
+    print(index.match(lat, lng))
+    print(index.within(lat, lng, 300))
+
+    print(0)
@@ -23,8 +23,13 @@ If no options offered, the main program will extract and convert the map of Notr
 Indiana, USA.
 
 Functions below can be imported separately outside this script:
-- get_osm(): download osm data by bounding box;
-- build_osm(): use netconvert and polyconvert to build SUMO readable network.
+- get_osm(): download osm data by bounding box, large boxes can be fetched in
+  tiles (--tile-size) by a pool of workers with a tile cache on disk. Requests
+  time out, and are retried with exponential backoff (or the Retry-After of the
+  server) on 429/5xx responses and connection errors;
+- build_osm(): use netconvert and polyconvert to build SUMO readable network,
+  skipped if nothing changed since the last build; with --parallel-build both
+  converters run concurrently (see build_parallel()).
 
 Outputs:
 - $PREFIX$_bbox.osm.xml: raw map data
@@ -32,17 +37,26 @@ Outputs:
 - $PREFIX$.netccfg: re-usable config file that generates the .net.xml file
 - $PREFIX$.poly.xml: sumo readable polygon file for buildings and other polygons
 - $PREFIX$.polycfg: re-usable config file that generates the .poly.xml file
+- $PREFIX$.build.sha1: hash of the inputs and options of the last build
 """
 
 from __future__ import absolute_import
 from __future__ import print_function
 
 import os
+import re
 import sys
+import math
+import time
+import zlib
+import hashlib
 import optparse
 import logging
 import base64
 import subprocess
+import xml.etree.ElementTree as ET
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import httplib
@@ -52,12 +66,9 @@ except ImportError:
     import http.client as httplib
     import urllib.parse as urlparse
 
-SUMO_HOME = os.environ.get("SUMO_HOME")
-if SUMO_HOME is None:
-    raise TypeError('sumo not installed or $SUMO_HOME not found!')
-tools_path = os.path.join(SUMO_HOME, 'tools')
-sys.path.insert(0, tools_path)
-import sumolib  # noqa
+from lazy_import import lazy_sumolib  # noqa
+
+sumolib = lazy_sumolib()
 
 
 # A full list of options @ https://sumo.dlr.de/docs/NETCONVERT.html
@@ -71,6 +82,8 @@ DEFAULT_BUILD_OPTS = (
     + "--output.original-names,--output.street-names"  # output
 )
 
+# sumo itself is only needed to build, see build()
+SUMO_HOME = os.environ.get("SUMO_HOME", "")
 TYEPMAP_DIR = os.path.join(SUMO_HOME, "data", "typemap")
 TYPEMAPS = {
     "net": os.path.join(TYEPMAP_DIR, "osmNetconvert.typ.xml"),
@@ -80,6 +93,29 @@ TYPEMAPS = {
     "poly": os.path.join(TYEPMAP_DIR, "osmPolyconvert.typ.xml"),
 }
 
+OVERPASS_URL = "https://www.overpass-api.de/api/interpreter"
+OVERPASS_QUERY = """
+        <osm-script timeout="240" element-limit="1073741824">
+        <union>
+            %s
+            <recurse type="node-relation" into="rels"/>
+            <recurse type="node-way"/>
+            <recurse type="way-relation"/>
+        </union>
+        <union>
+            <item/>
+            <recurse type="way-node"/>
+        </union>
+        <print mode="body"/>
+        </osm-script>"""
+READ_CHUNK = 1 << 20  # bytes per read when streaming responses to disk
+TIMEOUT = 300  # socket timeout in seconds, above the timeout of the query
+RETRIES = 5
+BACKOFF = 2.0  # seconds before the first retry, doubled after each
+MAX_WAIT = 600  # max. seconds to wait for a retry
+RETRY_STATUS = {429, 500, 502, 503, 504}
+WORKERS = 2  # overpass-api.de serves 2 concurrent requests per client
+
 logging.basicConfig(format='map_builder:%(levelname)s: %(message)s')
 
 optParser = optparse.OptionParser()
@@ -94,6 +130,31 @@ optParser.add_option(
     "-d", "--output_dir", default=os.getcwd(),
     help="optional output directory (must already exist)"
 )
+# osm extraction options
+optParser.add_option(
+    "--url", default=OVERPASS_URL,
+    help="overpass interpreter url, e.g., a local server for testing"
+)
+optParser.add_option(
+    "--tile-size", type="float", default=None,
+    help="fetch the bbox in tiles of this size (in degrees) instead of one request"
+)
+optParser.add_option(
+    "--workers", type="int", default=WORKERS,
+    help="max. number of concurrent tile requests"
+)
+optParser.add_option(
+    "--timeout", type="float", default=TIMEOUT,
+    help="socket timeout of a request in seconds"
+)
+optParser.add_option(
+    "--retries", type="int", default=RETRIES,
+    help="max. number of retries of a failed request"
+)
+optParser.add_option(
+    "--cache-dir", default=None,
+    help="directory of cached tiles (default: $OUTPUT_DIR/osm_tiles)"
+)
 # type map & options for netconvert
 optParser.add_option(
     "--netconvert-typemap", default=None,
@@ -116,31 +177,214 @@ optParser.add_option(
     "--polyconvert-options", default="-v,--osm.keep-full-type",
     help="comma-separated options for polyconvert"
 )
+# build mode
+optParser.add_option(
+    "--parallel-build", action="store_true", default=False,
+    help="run netconvert and polyconvert concurrently, once each"
+)
+optParser.add_option(
+    "--force", action="store_true", default=False,
+    help="rebuild even if osm input, typemaps and options are unchanged"
+)
+
+
+def get_connection(url, timeout=TIMEOUT):
+    """
+    open a http(s) connection to the server of url, honoring $https_proxy
+    """
+    if url.scheme == "http":
+        return httplib.HTTPConnection(url.hostname, url.port, timeout=timeout)
+    if os.environ.get("https_proxy") is not None:
+        headers = {}
+        proxy_url = urlparse.urlparse(os.environ.get("https_proxy"))
+        if proxy_url.username and proxy_url.password:
+            auth = '%s:%s' % (proxy_url.username, proxy_url.password)
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(auth.encode()).decode()  # noqa
+        conn = httplib.HTTPSConnection(proxy_url.hostname, proxy_url.port, timeout=timeout)  # noqa
+        conn.set_tunnel(url.hostname, 443, headers)
+    else:
+        conn = httplib.HTTPSConnection(url.hostname, url.port, timeout=timeout)
+    return conn
 
 
 def read_compressed(conn, urlpath, query, filename):
+    """
+    post the query asking for a gzip response, and stream the (decompressed)
+    response to filename chunk by chunk. The file only appears once complete.
+    Return the response, its status tells whether filename was written.
+    """
     conn.request(
-        "POST", "/" + urlpath, """
-        <osm-script timeout="240" element-limit="1073741824">
-        <union>
-            %s
-            <recurse type="node-relation" into="rels"/>
-            <recurse type="node-way"/>
-            <recurse type="way-relation"/>
-        </union>
-        <union>
-            <item/>
-            <recurse type="way-node"/>
-        </union>
-        <print mode="body"/>
-        </osm-script>""" % query
+        "POST", "/" + urlpath.lstrip("/"), OVERPASS_QUERY % query,
+        headers={"Accept-Encoding": "gzip"}
     )
     response = conn.getresponse()
-    print(response.status, response.reason)
-    if response.status == 200:
-        out = open(os.path.join(os.getcwd(), filename), "wb")
-        out.write(response.read())
-        out.close()
+    logging.info("%s %s %s" % (filename, response.status, response.reason))
+    if response.status != 200:
+        logging.warning(
+            "request failed for %s: %s %s" % (filename, response.status, response.reason)  # noqa
+        )
+        response.read()
+        return response
+
+    decomp = None
+    if response.getheader("Content-Encoding", "") == "gzip":
+        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    tmp_file = filename + ".part"
+    out = open(os.path.join(os.getcwd(), tmp_file), "wb")
+    while True:
+        chunk = response.read(READ_CHUNK)
+        if not chunk:
+            break
+        out.write(decomp.decompress(chunk) if decomp else chunk)
+    if decomp:
+        out.write(decomp.flush())
+    out.close()
+    os.replace(os.path.join(os.getcwd(), tmp_file), os.path.join(os.getcwd(), filename))  # noqa
+    return response
+
+
+def _retry_after(response):
+    """
+    seconds to wait given by the Retry-After header (seconds or a date), or None
+    """
+    value = response.getheader("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def fetch(url, query, filename, timeout=TIMEOUT, retries=RETRIES):
+    """
+    read_compressed() on a new connection per attempt. Timeouts, connection
+    errors and 429/5xx responses are retried up to retries times, waiting the
+    Retry-After of the response if given, else BACKOFF seconds doubled after
+    each attempt. Return True if filename was written.
+    """
+    delay = BACKOFF
+    for attempt in range(retries + 1):
+        wait = delay
+        conn = get_connection(url, timeout)
+        try:
+            response = read_compressed(conn, url.path, query, filename)
+            if response.status == 200:
+                return True
+            if response.status not in RETRY_STATUS:
+                return False
+            after = _retry_after(response)
+            if after is not None:
+                wait = after
+        except (OSError, httplib.HTTPException) as e:
+            logging.warning("request failed for %s: %s" % (filename, e))
+        finally:
+            conn.close()
+        if attempt == retries:
+            break
+        wait = min(wait, MAX_WAIT)
+        logging.info("retrying %s in %.1fs" % (filename, wait))
+        time.sleep(wait)
+        delay *= 2
+    return False
+
+
+def split_bbox(west, south, east, north, tile_size):
+    """
+    split a bbox into tiles of at most tile_size degrees, returns WSEN tuples
+    """
+    def steps(lo, hi):
+        n = max(1, int(math.ceil((hi - lo) / tile_size - 1e-9)))
+        d = (hi - lo) / n
+        return [(lo + i * d, lo + (i + 1) * d) for i in range(n)]
+
+    return [
+        (w, s, e, n)
+        for (s, n) in steps(south, north)
+        for (w, e) in steps(west, east)
+    ]
+
+
+def bbox_query(west, south, east, north):
+    return '<bbox-query n="%s" s="%s" w="%s" e="%s"/>' % (north, south, west, east)
+
+
+def fetch_tile(url, tile, cache_dir, timeout=TIMEOUT, retries=RETRIES):
+    """
+    fetch one tile into the cache (if not yet cached), return the tile file
+    """
+    key = "%s|%.7f,%.7f,%.7f,%.7f|%s" % ((url.geturl(),) + tuple(tile) + (OVERPASS_QUERY,))  # noqa
+    tile_file = os.path.join(
+        cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".osm.xml"
+    )
+    if os.path.isfile(tile_file):
+        return tile_file
+    if not fetch(url, bbox_query(*tile), tile_file, timeout, retries):
+        raise IOError("failed to fetch tile %s" % (tile,))
+    return tile_file
+
+
+def merge_osm(tile_files, filename):
+    """
+    merge osm files into one, written as all nodes, then ways, then relations.
+    Elements shared by several tiles are written once.
+    """
+    out = open(filename, "wb")
+    out.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="map_builder">\n')  # noqa
+    for tag in ("node", "way", "relation"):
+        seen = set()
+        for tile_file in tile_files:
+            root = None
+            for event, elem in ET.iterparse(tile_file, events=("start", "end")):
+                if event == "start":
+                    if root is None:
+                        root = elem
+                    continue
+                if elem.tag == tag:
+                    if elem.get("id") not in seen:
+                        seen.add(elem.get("id"))
+                        out.write(b"  " + ET.tostring(elem).strip() + b"\n")
+                    root.clear()
+                elif elem.tag in ("node", "way", "relation"):
+                    root.clear()
+    out.write(b"</osm>\n")
+    out.close()
+
+
+def get_osm_tiles(
+    url, bbox, tile_size, filename, cache_dir, workers=WORKERS,
+    timeout=TIMEOUT, retries=RETRIES
+):
+    """
+    fetch a bbox as tiles by a bounded pool of workers and merge them.
+    A failed tile does not stop the others, they are cached and a rerun only
+    fetches the failed tiles.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    tiles = split_bbox(*bbox, tile_size)
+    logging.info("fetching %d tiles with %d workers" % (len(tiles), workers))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(fetch_tile, url, t, cache_dir, timeout, retries)
+            for t in tiles
+        ]
+    tile_files, failed = [], []
+    for tile, future in zip(tiles, futures):
+        try:
+            tile_files.append(future.result())
+        except IOError as e:
+            logging.error(str(e))
+            failed.append(tile)
+    if len(failed) > 0:
+        raise IOError(
+            "failed to fetch %d of %d tiles, rerun to fetch the missing tiles"
+            % (len(failed), len(tiles))
+        )
+    merge_osm(tile_files, filename)
 
 
 def get_osm(args=None):
@@ -165,25 +409,21 @@ def get_osm(args=None):
     if options.output_dir:
         options.prefix = os.path.join(options.output_dir, options.prefix)
 
-    url = urlparse.urlparse("https://www.overpass-api.de/api/interpreter")
-    if os.environ.get("https_proxy") is not None:
-        headers = {}
-        proxy_url = urlparse.urlparse(os.environ.get("https_proxy"))
-        if proxy_url.username and proxy_url.password:
-            auth = '%s:%s' % (proxy_url.username, proxy_url.password)
-            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(auth)
-        conn = httplib.HTTPSConnection(proxy_url.hostname, proxy_url.port)
-        conn.set_tunnel(url.hostname, 443, headers)
-    else:
-        conn = httplib.HTTPSConnection(url.hostname, url.port)
+    url = urlparse.urlparse(options.url)
+    if options.tile_size:
+        cache_dir = options.cache_dir
+        if not cache_dir:
+            cache_dir = os.path.join(options.output_dir or os.getcwd(), "osm_tiles")
+        get_osm_tiles(
+            url, (west, south, east, north), options.tile_size,
+            options.prefix + "_bbox.osm.xml", cache_dir, options.workers,
+            options.timeout, options.retries
+        )
+        return
 
-    read_compressed(
-        conn,
-        url.path,
-        '<bbox-query n="%s" s="%s" w="%s" e="%s"/>' % (north, south, west, east),
-        options.prefix + "_bbox.osm.xml"
-    )
-    conn.close()
+    filename = options.prefix + "_bbox.osm.xml"
+    if not fetch(url, bbox_query(west, south, east, north), filename, options.timeout, options.retries):  # noqa
+        raise IOError("failed to fetch %s" % filename)
 
 
 def getRelative(dirname, option):
@@ -194,6 +434,134 @@ def getRelative(dirname, option):
         return option
 
 
+def _hash_file(h, file_path):
+    with open(file_path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(READ_CHUNK), b""):
+            h.update(chunk)
+
+
+def build_stamp(cwd, opts_list, input_opts):
+    """
+    sha1 over the converter options and the content of their input files
+    (osm files, typemaps), used to skip builds with nothing changed
+    """
+    h = hashlib.sha1()
+    for opts in opts_list:
+        h.update("\0".join(opts).encode())
+        for i, o in enumerate(opts[:-1]):
+            if o not in input_opts:
+                continue
+            for f in opts[i + 1].split(','):
+                f = os.path.join(cwd, f)
+                if os.path.isfile(f):
+                    _hash_file(h, f)
+    return h.hexdigest()
+
+
+def read_location(net_file):
+    """
+    return the <location .../> element of a net (or poly) file, None if absent
+    """
+    if not os.path.isfile(net_file):
+        return None
+    with open(net_file) as fd:
+        head = fd.read(1 << 16)
+    m = re.search(r"<location [^>]*/>", head)
+    return m.group(0) if m else None
+
+
+def _loc_attr(location, attr):
+    return re.search(attr + r'="([^"]*)"', location).group(1)
+
+
+def shift_poly_file(utm_file, net_file, poly_file):
+    """
+    move polygons from a --proj.utm polyconvert output into the net coordinates.
+    returns False if both files are not in the same utm projection.
+    """
+    net_loc = read_location(net_file)
+    poly_loc = read_location(utm_file)
+    if net_loc is None or poly_loc is None:
+        return False
+    if _loc_attr(net_loc, "projParameter") != _loc_attr(poly_loc, "projParameter"):
+        return False
+    dx, dy = [float(v) for v in _loc_attr(net_loc, "netOffset").split(",")]
+
+    def shift_shape(m):
+        pts = []
+        for p in m.group(1).split():
+            c = p.split(",")
+            pts.append(",".join(
+                ["%.2f" % (float(c[0]) + dx), "%.2f" % (float(c[1]) + dy)] + c[2:]
+            ))
+        return 'shape="%s"' % " ".join(pts)
+
+    re_shape = re.compile(r'shape="([^"]*)"')
+    re_x = re.compile(r' x="([^"]*)"')
+    re_y = re.compile(r' y="([^"]*)"')
+    tmp_file = poly_file + ".part"
+    with open(utm_file) as src, open(tmp_file, "w") as dst:
+        for line in src:
+            if "<location " in line:
+                line = line[:line.index("<location ")] + net_loc + "\n"
+            elif "<poly " in line:
+                line = re_shape.sub(shift_shape, line, count=1)
+            elif "<poi " in line:
+                line = re_x.sub(lambda m: ' x="%.2f"' % (float(m.group(1)) + dx), line, count=1)  # noqa
+                line = re_y.sub(lambda m: ' y="%.2f"' % (float(m.group(1)) + dy), line, count=1)  # noqa
+            dst.write(line)
+    os.replace(tmp_file, poly_file)
+    return True
+
+
+def build_parallel(
+    netconvert, polyconvert, netconvertOpts, polyconvertOpts,
+    net_cfg, poly_cfg, net_file, poly_file, cwd
+):
+    """
+    netconvert and polyconvert run concurrently, each exactly once.
+    polyconvert needs the net only for its projection, so it runs in two phases:
+    polygons are converted into plain utm coordinates while netconvert builds the
+    net, then shifted by the net offset. If the utm zones differ, polyconvert is
+    re-run against the finished net.
+    """
+    # save the re-usable configs (no conversion is done with --save-configuration)
+    procs = [
+        subprocess.Popen(netconvertOpts, cwd=cwd),
+        subprocess.Popen(polyconvertOpts, cwd=cwd),
+    ]
+    for p in procs:
+        p.wait()
+
+    utm_file = poly_file + ".utm.xml"
+    polyDirect = []
+    skip = False
+    for o in polyconvertOpts:
+        if skip:
+            skip = False
+        elif o in ("--save-configuration", "-n", "--net-file"):
+            skip = True
+        elif o == "--output-file":
+            polyDirect += [o, getRelative(cwd, utm_file)]
+            skip = True
+        else:
+            polyDirect.append(o)
+    polyDirect += ["--proj.utm", "true"]
+
+    net_proc = subprocess.Popen([netconvert, "-c", net_cfg], cwd=os.getcwd())
+    poly_proc = subprocess.Popen(polyDirect, cwd=cwd)
+    ret = net_proc.wait()
+    poly_ret = poly_proc.wait()
+    if ret != 0:
+        return ret
+    if poly_ret != 0 or not shift_poly_file(utm_file, net_file, poly_file):
+        logging.warning("utm polygons not usable, re-run polyconvert on the net")
+        poly_ret = subprocess.call([polyconvert, "-c", poly_cfg], cwd=os.getcwd())
+    if os.path.isfile(utm_file):
+        os.remove(utm_file)
+    return poly_ret
+
+
 def build_osm(args=None, bindir=None):
     (options, args) = optParser.parse_args(args=args)
 
@@ -214,6 +582,7 @@ def build_osm(args=None, bindir=None):
     net_cfg = options.prefix + ".netccfg"
     poly_file = options.prefix + ".poly.xml"
     poly_cfg = options.prefix + ".polycfg"
+    stamp_file = options.prefix + ".build.sha1"
 
     # NETCONVERT
     netconvertOpts = [netconvert]
@@ -234,9 +603,6 @@ def build_osm(args=None, bindir=None):
         netconvertOpts += ["--lefthand"]
     netconvertOpts += options.netconvert_options.split(',')
     netconvertOpts = [getRelative(options.output_dir, o) for o in netconvertOpts]
-    print(netconvertOpts)
-    subprocess.call(netconvertOpts, cwd=options.output_dir)
-    subprocess.call([netconvert, "-c", net_cfg], cwd=os.getcwd())
 
     # POLYCONVERT
     polyconvertOpts = [polyconvert]
@@ -254,9 +620,35 @@ def build_osm(args=None, bindir=None):
     if options.polyconvert_options:
         polyconvertOpts += options.polyconvert_options.split(',')
     polyconvertOpts = [getRelative(options.output_dir, o) for o in polyconvertOpts]
-    print(polyconvertOpts)
-    subprocess.call(polyconvertOpts, cwd=options.output_dir)
-    subprocess.call([polyconvert, "-c", poly_cfg], cwd=os.getcwd())
+
+    stamp = build_stamp(
+        options.output_dir, [netconvertOpts, polyconvertOpts],
+        ("--osm-files", "--type-files", "--type-file")
+    )
+    outputs = (net_file, poly_file)
+    if not options.force and all(os.path.isfile(f) for f in outputs) \
+            and os.path.isfile(stamp_file) and open(stamp_file).read().strip() == stamp:
+        logging.warning("inputs unchanged since the last build, skip " + options.prefix)
+        return
+    if os.path.isfile(stamp_file):
+        os.remove(stamp_file)
+
+    logging.info(netconvertOpts)
+    logging.info(polyconvertOpts)
+    if options.parallel_build:
+        ret = build_parallel(
+            netconvert, polyconvert, netconvertOpts, polyconvertOpts,
+            net_cfg, poly_cfg, net_file, poly_file, options.output_dir
+        )
+    else:
+        subprocess.call(netconvertOpts, cwd=options.output_dir)
+        subprocess.call([netconvert, "-c", net_cfg], cwd=os.getcwd())
+        subprocess.call(polyconvertOpts, cwd=options.output_dir)
+        ret = subprocess.call([polyconvert, "-c", poly_cfg], cwd=os.getcwd())
+
+    if ret == 0 and all(os.path.isfile(f) for f in outputs):
+        with open(stamp_file, "w") as fd:
+            fd.write(stamp + "\n")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,400 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     net_loader.py
+# @author   Jian Yang
+# @date     2020-09-14
+
+"""
+load only the region of interest (ROI) of a large .net.xml file.
+The ROI is the bounding box of the stops in a loc_dict (or a given geo bbox) plus
+a margin, which also covers the corridors between the stops. The net file is
+streamed, and only edges, lanes and connections inside the ROI are kept in a
+lightweight NetView. NetView offers the subset of the sumolib.net.Net interface
+used by get_taz.get_stop_edges() and the trip generator, e.g.:
+    net = read_net_roi(net_file, loc_dict=loc_dict, margin=500)
+    stop2edges = get_stop_edges(net, loc_dict, R)
+"""
+
+from __future__ import annotations
+
+import math
+import logging
+import xml.etree.ElementTree as ET
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Tuple
+from lazy_import import lazy_sumolib
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+sumolib = lazy_sumolib()
+
+logging.basicConfig(format='net_loader:%(levelname)s: %(message)s')
+
+ROI_MARGIN = 500.0  # in meters
+CELL_SIZE = 100.0  # in meters, grid cell of the edge index
+
+
+def _parse_shape(shape: str) -> List[Tuple[float]]:
+    return [tuple(float(c) for c in p.split(",")[:2]) for p in shape.split()]
+
+
+class LaneView():
+    __slots__ = ("_id", "_index", "_speed", "_length", "_width", "_allowed", "_shape")
+
+    def __init__(self, attrs: Dict):
+        self._id = attrs["id"]
+        self._index = int(attrs["index"])
+        self._speed = float(attrs["speed"])
+        self._length = float(attrs["length"])
+        self._width = float(attrs.get("width", 3.2))
+        self._allowed = frozenset(sumolib.net.lane.get_allowed(attrs.get("allow"), attrs.get("disallow")))  # noqa
+        self._shape = _parse_shape(attrs.get("shape", ""))
+
+    def getID(self):
+        return self._id
+
+    def getIndex(self):
+        return self._index
+
+    def getSpeed(self):
+        return self._speed
+
+    def getLength(self):
+        return self._length
+
+    def getWidth(self):
+        return self._width
+
+    def getPermissions(self):
+        return self._allowed
+
+    def allows(self, vClass):
+        return vClass in self._allowed
+
+    def getShape(self, includeJunctions=False):
+        return self._shape
+
+
+class EdgeView():
+    __slots__ = (
+        "_id", "_from", "_to", "_priority", "_lanes", "_shape",
+        "_from_xy", "_to_xy", "_outgoing", "_incoming"
+    )
+
+    def __init__(self, attrs: Dict):
+        self._id = attrs["id"]
+        self._from = attrs.get("from")
+        self._to = attrs.get("to")
+        self._priority = int(attrs.get("priority", -1))
+        self._lanes = []
+        self._shape = None
+        self._from_xy = None
+        self._to_xy = None
+        self._outgoing = {}
+        self._incoming = {}
+
+    def __repr__(self):
+        return '<edge id="%s" from="%s" to="%s"/>' % (self._id, self._from, self._to)
+
+    def getID(self):
+        return self._id
+
+    def getFromNode(self):
+        return self._from
+
+    def getToNode(self):
+        return self._to
+
+    def getPriority(self):
+        return self._priority
+
+    def getLanes(self):
+        return self._lanes
+
+    def getLane(self, idx):
+        return self._lanes[idx]
+
+    def getLaneNumber(self):
+        return len(self._lanes)
+
+    def getLength(self):
+        return self._lanes[0].getLength()
+
+    def getSpeed(self):
+        return self._lanes[0].getSpeed()
+
+    def allows(self, vClass):
+        for lane in self._lanes:
+            if lane.allows(vClass):
+                return True
+        return False
+
+    def getShape(self, includeJunctions=False):
+        """
+        same as sumolib: the middle lane, or the mean of the two middle lanes
+        """
+        if self._shape is None:
+            n = len(self._lanes)
+            if n % 2 == 1:
+                self._shape = self._lanes[n // 2].getShape()
+            else:
+                shapes = [lane.getShape() for lane in self._lanes]
+                m = min(len(sh) for sh in shapes)
+                self._shape = [
+                    (sum(sh[i][0] for sh in shapes) / n, sum(sh[i][1] for sh in shapes) / n)  # noqa
+                    for i in range(m)
+                ]
+        if not includeJunctions:
+            return self._shape
+        shape = list(self._shape)
+        if self._from_xy is not None and (len(shape) == 0 or shape[0] != self._from_xy):  # noqa
+            shape.insert(0, self._from_xy)
+        if self._to_xy is not None and shape[-1] != self._to_xy:
+            shape.append(self._to_xy)
+        return shape
+
+    def getOutgoing(self):
+        return self._outgoing
+
+    def getIncoming(self):
+        return self._incoming
+
+
+class NetView():
+    def __init__(self, location: Dict, roi: Tuple[float] = None):
+        self._location = location
+        self._roi = roi
+        self._edges = []
+        self._id2edge = {}
+        self._proj = None
+        self._index = {True: None, False: None}
+        x, y = location.get("netOffset", "0,0").split(",")
+        self._offset = (float(x), float(y))
+
+    # --- building
+
+    def addEdge(self, edge: EdgeView) -> None:
+        self._edges.append(edge)
+        self._id2edge[edge.getID()] = edge
+
+    def addConnection(self, from_id: str, to_id: str, from_lane: int, to_lane: int) -> bool:  # noqa
+        fe = self._id2edge.get(from_id)
+        te = self._id2edge.get(to_id)
+        if fe is None or te is None:
+            return False
+        conn = (from_lane, to_lane)
+        fe._outgoing.setdefault(te, []).append(conn)
+        te._incoming.setdefault(fe, []).append(conn)
+        return True
+
+    # --- sumolib.net.Net like interface
+
+    def getEdges(self) -> List[EdgeView]:
+        return self._edges
+
+    def getEdge(self, edge_id: str) -> EdgeView:
+        return self._id2edge[edge_id]
+
+    def hasEdge(self, edge_id: str) -> bool:
+        return edge_id in self._id2edge
+
+    def getLocationOffset(self) -> Tuple[float]:
+        return self._offset
+
+    def getROI(self) -> Tuple[float]:
+        return self._roi
+
+    def getGeoProj(self):
+        if pyproj is None:
+            raise RuntimeError("pyproj not installed.")
+        if self._proj is None:
+            self._proj = pyproj.Proj(projparams=self._location["projParameter"])
+        return self._proj
+
+    def convertLonLat2XY(self, lon, lat):
+        x, y = self.getGeoProj()(lon, lat)
+        return x + self._offset[0], y + self._offset[1]
+
+    def convertXY2LonLat(self, x, y):
+        return self.getGeoProj()(x - self._offset[0], y - self._offset[1], inverse=True)  # noqa
+
+    def _build_index(self, includeJunctions: bool) -> None:
+        """
+        grid index over all edge segments
+        """
+        segs = []
+        for i, e in enumerate(self._edges):
+            shape = e.getShape(includeJunctions)
+            for (x1, y1), (x2, y2) in zip(shape[:-1], shape[1:]):
+                segs.append((x1, y1, x2, y2, i))
+            if len(shape) == 1:
+                segs.append(shape[0] + shape[0] + (i,))
+        segs = np.array(segs, dtype=np.float64).reshape(-1, 5)
+        cells = {}
+        lo_x = np.floor(np.minimum(segs[:, 0], segs[:, 2]) / CELL_SIZE).astype(int)
+        hi_x = np.floor(np.maximum(segs[:, 0], segs[:, 2]) / CELL_SIZE).astype(int)
+        lo_y = np.floor(np.minimum(segs[:, 1], segs[:, 3]) / CELL_SIZE).astype(int)
+        hi_y = np.floor(np.maximum(segs[:, 1], segs[:, 3]) / CELL_SIZE).astype(int)
+        for k in range(segs.shape[0]):
+            for cx in range(lo_x[k], hi_x[k] + 1):
+                for cy in range(lo_y[k], hi_y[k] + 1):
+                    cells.setdefault((cx, cy), []).append(k)
+        self._index[includeJunctions] = (
+            segs, {c: np.array(v, dtype=np.int64) for c, v in cells.items()}
+        )
+
+    def getNeighboringEdges(self, x, y, r=0.1, includeJunctions=True):
+        """
+        edges within distance r of (x, y), returned as (edge, distance) pairs
+        """
+        if self._index[includeJunctions] is None:
+            self._build_index(includeJunctions)
+        segs, index = self._index[includeJunctions]
+        cand = [
+            index[(cx, cy)]
+            for cx in range(int(math.floor((x - r) / CELL_SIZE)), int(math.floor((x + r) / CELL_SIZE)) + 1)  # noqa
+            for cy in range(int(math.floor((y - r) / CELL_SIZE)), int(math.floor((y + r) / CELL_SIZE)) + 1)  # noqa
+            if (cx, cy) in index
+        ]
+        if len(cand) == 0:
+            return []
+        segs = segs[np.unique(np.concatenate(cand))]
+        dist = point_segment_distance(x, y, segs[:, 0], segs[:, 1], segs[:, 2], segs[:, 3])  # noqa
+        edge_idx = segs[:, 4].astype(np.int64)
+        best = {}
+        for i, d in zip(edge_idx[dist < r], dist[dist < r]):
+            if i not in best or d < best[i]:
+                best[i] = d
+        return [(self._edges[i], float(d)) for i, d in best.items()]
+
+
+def point_segment_distance(px, py, x1, y1, x2, y2) -> np.array:
+    """
+    vectorized distance of a point to line segments
+    """
+    dx, dy = x2 - x1, y2 - y1
+    seg_len2 = dx * dx + dy * dy
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.where(seg_len2 > 0, ((px - x1) * dx + (py - y1) * dy) / seg_len2, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(px - (x1 + t * dx), py - (y1 + t * dy))
+
+
+def _shape_in_roi(shape: List[Tuple[float]], roi: Tuple[float]) -> bool:
+    if roi is None:
+        return True
+    xs = [p[0] for p in shape]
+    ys = [p[1] for p in shape]
+    return not (max(xs) < roi[0] or min(xs) > roi[2] or max(ys) < roi[1] or min(ys) > roi[3])  # noqa
+
+
+def read_net_roi(
+    net_file: str,
+    loc_dict: Dict = None,
+    bbox: Tuple[float] = None,
+    margin: float = ROI_MARGIN
+) -> NetView:
+    """
+    stream net_file and keep the edges inside the ROI.
+    loc_dict: {loc: GeoPoint}, the ROI is the bbox of all stops
+    bbox: geo bbox "west, south, east, north" used if no loc_dict is given
+    margin: in meters, added on each side of the ROI
+    If neither loc_dict nor bbox is given, the whole net is loaded.
+    """
+    if not Path(net_file).is_file():
+        raise FileNotFoundError("not a valid network file")
+    if loc_dict is not None and len(loc_dict) == 0:
+        raise ValueError("empty location dict, no ROI to load")
+
+    net = None
+    roi = None
+    edge = None
+    n_seen = 0
+    root = None
+    nodes = {}
+    for event, elem in ET.iterparse(str(net_file), events=("start", "end")):
+        tag = elem.tag
+        if event == "start":
+            if root is None:
+                root = elem
+            elif tag == "location":
+                net = NetView(dict(elem.attrib))
+                if loc_dict is not None:
+                    pts = [net.convertLonLat2XY(p.lng, p.lat) for p in loc_dict.values()]  # noqa
+                elif bbox is not None:
+                    west, south, east, north = bbox
+                    pts = [
+                        net.convertLonLat2XY(lng, lat)
+                        for lng in (west, east) for lat in (south, north)
+                    ]
+                else:
+                    pts = None
+                if pts is not None:
+                    xs = [p[0] for p in pts]
+                    ys = [p[1] for p in pts]
+                    roi = (min(xs) - margin, min(ys) - margin, max(xs) + margin, max(ys) + margin)  # noqa
+                    net._roi = roi
+            elif tag == "edge":
+                edge = None
+                if elem.get("function", "") == "":
+                    edge = EdgeView(elem.attrib)
+            elif tag == "junction":
+                nodes[elem.get("id")] = (float(elem.get("x")), float(elem.get("y")))  # noqa
+            continue
+
+        # end events
+        if tag == "lane":
+            if edge is not None:
+                edge._lanes.append(LaneView(elem.attrib))
+        elif tag == "edge":
+            if edge is not None:
+                n_seen += 1
+                if len(edge._lanes) > 0 and _shape_in_roi(edge.getShape(), roi):
+                    net.addEdge(edge)
+            edge = None
+            root.clear()
+        elif tag == "connection":
+            a = elem.attrib
+            if a["from"][0] != ":":
+                net.addConnection(a["from"], a["to"], int(a["fromLane"]), int(a["toLane"]))  # noqa
+            root.clear()
+        elif tag in ("junction", "tlLogic", "type", "roundabout"):
+            root.clear()
+
+    if net is None:
+        raise ValueError("no location found in network file")
+    for e in net.getEdges():
+        e._from_xy = nodes.get(e.getFromNode())
+        e._to_xy = nodes.get(e.getToNode())
+    logging.info("kept %d of %d edges in ROI %s" % (len(net.getEdges()), n_seen, roi))  # noqa
+    return net
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    from get_taz import read_loc_dict_file, get_stop_edges
+    wd = Path(__file__).parents[1].absolute()
+    net_file = wd.joinpath('data', 'map', 'notre_dame.net.xml')
+    loc_dict_file = wd.joinpath('data', 'map', 'notre_dame_loc_dict.csv')
+
+    loc_dict = read_loc_dict_file(file_path=loc_dict_file)
+    net = read_net_roi(net_file, loc_dict=loc_dict)
+    stop2edges = get_stop_edges(net, loc_dict, 100)
+
+    print(0)
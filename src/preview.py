@@ -0,0 +1,521 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     preview.py
+# @author   Jian Yang
+# @date     2020-10-16
+
+"""
+preview trajectories of the generated trips without duarouter and sumo, for a
+fast turnaround while designing profiles. There is no car-following: every
+walk and ride of the person trip file is routed on the net (Dijkstra over the
+free flow travel times of the mode) and positions are interpolated along the
+edge shapes at the mode speed, capped by the speed limits. A person stays at
+its destination until the departure of its next trip (the stop of the trip
+file, i.e., the itinerary).
+Points come in chunks of FCD_COLUMNS (see fcd.py), so that the preview is a
+drop-in replacement of the converted sumo fcd output (e.g., for annotate.py).
+Each chunk covers a batch of persons and is sorted by time.
+"""
+
+from __future__ import annotations
+
+import math
+import heapq
+import logging
+import xml.etree.ElementTree as ET
+import numpy as np
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+from lazy_import import lazy_module, lazy_sumolib
+from fcd import FCD_COLUMNS, FCD_DTYPES
+try:
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra
+except ImportError:
+    csr_matrix = None
+
+pd = lazy_module("pandas")
+sumolib = lazy_sumolib()
+
+logging.basicConfig(format='preview:%(levelname)s: %(message)s')
+
+PERIOD = 10.0  # in seconds, between two points of an agent
+# in m/s, None: the speed limit of the edge
+SPEED = {"walk": 1.39, "bike": 5.56, "car": None}
+VCLASS = {"walk": "pedestrian", "bike": "bicycle", "car": "passenger"}
+MIN_TIME = 0.01  # in seconds, travel time of zero-length edges
+CHUNK_PERSONS = 1000
+TREE_CACHE_MB = 256  # memory of the shortest path trees kept per mode
+
+
+def _node_id(node) -> str:
+    return node if isinstance(node, str) else node.getID()
+
+
+def _out_edges(edge, vclass: str):
+    """
+    edges reached by a lane connection allowed for vclass on both lanes
+    """
+    lanes = edge.getLanes()
+    for to_edge, conns in edge.getOutgoing().items():
+        to_lanes = to_edge.getLanes()
+        for c in conns:
+            if isinstance(c, tuple):
+                fl, tl = c
+            else:
+                fl, tl = c.getFromLane().getIndex(), c.getToLane().getIndex()
+            if lanes[fl].allows(vclass) and to_lanes[tl].allows(vclass):
+                yield to_edge
+                break
+
+
+def _dijkstra(
+    arcs: List[List[Tuple]],
+    sources: List[int]
+) -> Tuple[np.array]:
+    """
+    (dist, pred) of a multi-source Dijkstra, arcs[u] lists (w, weight) of the
+    arcs leaving u, pred is -1 at the sources and unreached vertices
+    """
+    n = len(arcs)
+    dist = [math.inf] * n
+    pred = [-1] * n
+    heap = []
+    for s in sources:
+        dist[s] = 0.0
+        heap.append((0.0, s))
+    heapq.heapify(heap)
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        for w, c in arcs[u]:
+            dw = d + c
+            if dw < dist[w]:
+                dist[w] = dw
+                pred[w] = u
+                heapq.heappush(heap, (dw, w))
+    return np.array(dist), np.array(pred, dtype=np.int64)
+
+
+class RouteGraph():
+    def __init__(
+        self,
+        net,
+        mode: str,
+        speed: float = None
+    ):
+        """
+        moves of a mode on net: a vertex is an edge driven forward or, when
+        walking, in either direction. Arcs follow the lane connections (any
+        edge at the same junction when walking) and cost the free flow time of
+        the entered edge at speed, capped by its speed limit.
+        """
+        self.mode = mode
+        vclass = VCLASS[mode]
+        edges = [e for e in net.getEdges() if e.allows(vclass)]
+        directions = [False, True] if mode == "walk" else [False]
+        self.edges = edges
+        self.edge_ids = np.array([e.getID() for e in edges], dtype=object)
+        # vertex v is edges[v // k] driven backward if v % k == 1
+        self._k = len(directions)
+        self.vertices = {
+            e.getID(): [i * self._k + d for d in range(self._k)]
+            for i, e in enumerate(edges)
+        }
+        n = len(edges) * self._k
+        length = np.array([e.getLength() for e in edges], dtype=np.float64)
+        limit = np.array([e.getSpeed() for e in edges], dtype=np.float64)
+        v = limit if speed is None else np.minimum(limit, speed)
+        self.length = np.repeat(length, self._k)
+        self.speed = np.repeat(v, self._k)
+        self.time = np.maximum(self.length / self.speed, MIN_TIME)
+
+        src, dst = [], []
+        if mode == "walk":
+            # forward moves start at the from node and end at the to node
+            starts = {}
+            for i, e in enumerate(edges):
+                starts.setdefault(_node_id(e.getFromNode()), []).append(i * 2)
+                starts.setdefault(_node_id(e.getToNode()), []).append(i * 2 + 1)  # noqa
+            for i, e in enumerate(edges):
+                for u, node in ((i * 2, e.getToNode()), (i * 2 + 1, e.getFromNode())):  # noqa
+                    for w in starts.get(_node_id(node), []):
+                        if w // 2 != i:
+                            src.append(u)
+                            dst.append(w)
+        else:
+            pos = {e.getID(): i for i, e in enumerate(edges)}
+            for i, e in enumerate(edges):
+                for to_edge in _out_edges(e, vclass):
+                    j = pos.get(to_edge.getID())
+                    if j is not None:
+                        src.append(i)
+                        dst.append(j)
+        src, dst = np.array(src, dtype=np.int64), np.array(dst, dtype=np.int64)
+        order = np.argsort(src, kind="mergesort")
+        self.ptr = np.r_[0, np.cumsum(np.bincount(src, minlength=n))].astype(np.int64)  # noqa
+        self.adj = dst[order]
+        self._matrix = None
+        self._arcs = None
+        if csr_matrix is not None:
+            self._matrix = csr_matrix(
+                (self.time[self.adj], self.adj, self.ptr), shape=(n, n)
+            )
+        else:
+            ptr, adj, time = self.ptr.tolist(), self.adj.tolist(), self.time.tolist()  # noqa
+            self._arcs = [
+                [(w, time[w]) for w in adj[ptr[u]:ptr[u + 1]]] for u in range(n)  # noqa
+            ]
+        # a tree takes 8 bytes per vertex
+        self._max_trees = max(1, TREE_CACHE_MB * (1 << 20) // max(1, 8 * n))
+        self._trees = OrderedDict()
+        self._routes = {}
+        self._geometry = {}
+
+    def tree(self, edge_id: str) -> Tuple[np.array]:
+        """
+        (dist, pred) of the shortest path tree from edge_id, LRU cached
+        """
+        tree = self._trees.get(edge_id)
+        if tree is not None:
+            self._trees.move_to_end(edge_id)
+            return tree
+        sources = self.vertices[edge_id]
+        if self._matrix is not None:
+            dist, pred = dijkstra(
+                self._matrix, indices=sources, min_only=True,
+                return_predecessors=True
+            )
+            pred[pred < 0] = -1
+        else:
+            dist, pred = _dijkstra(self._arcs, sources)
+        tree = (dist.astype(np.float32), pred.astype(np.int32))
+        self._trees[edge_id] = tree
+        if len(self._trees) > self._max_trees:
+            self._trees.popitem(last=False)
+        return tree
+
+    def route(
+        self,
+        from_edge: str,
+        to_edge: str
+    ) -> Dict:
+        """
+        the fastest route as vertices, offsets of their start times, travel
+        times, shape points with their time offsets and the duration, None if
+        there is none. cached per (from_edge, to_edge)
+        """
+        key = (from_edge, to_edge)
+        if key in self._routes:
+            return self._routes[key]
+        route = None
+        if from_edge in self.vertices and to_edge in self.vertices:
+            if from_edge == to_edge:
+                route = self.vertices[from_edge][:1]
+            else:
+                dist, pred = self.tree(from_edge)
+                targets = self.vertices[to_edge]
+                v = min(targets, key=lambda t: dist[t])
+                if np.isfinite(dist[v]):
+                    route = [v]
+                    while pred[v] >= 0:
+                        v = int(pred[v])
+                        route.append(v)
+                    route = route[::-1]
+        if route is not None:
+            route = np.array(route, dtype=np.int64)
+            time = self.time[route]
+            start = np.r_[0.0, np.cumsum(time[:-1])]
+            geoms = [self.geometry(v) for v in route]
+            route = {
+                "vertices": route,
+                "start": start,
+                "time": time,
+                "pts": np.concatenate([g[0] for g in geoms]),
+                "pt_time": np.concatenate([s + g[1] * d for g, s, d in zip(geoms, start, time)]),  # noqa
+                "duration": float(time.sum()),
+            }
+        self._routes[key] = route
+        return route
+
+    def geometry(self, v: int) -> Tuple[np.array]:
+        """
+        (points, fraction of the way at every point) of vertex v
+        """
+        geom = self._geometry.get(v)
+        if geom is not None:
+            return geom
+        shape = np.array(self.edges[v // self._k].getShape(), dtype=np.float64)[:, :2]  # noqa
+        if shape.shape[0] == 1:
+            shape = np.repeat(shape, 2, axis=0)
+        cum = np.r_[0.0, np.cumsum(np.hypot(*np.diff(shape, axis=0).T))]
+        if cum[-1] > 0:
+            frac = cum / cum[-1]
+        else:
+            frac = np.linspace(0.0, 1.0, shape.shape[0])
+        if v % self._k == 1:
+            shape, frac = shape[::-1], 1.0 - frac[::-1]
+        geom = (shape, frac)
+        self._geometry[v] = geom
+        return geom
+
+
+def _sample_times(
+    t0: float,
+    t1: float,
+    period: float
+) -> np.array:
+    # points are aligned to multiples of period, as sumo's device.fcd.period
+    return np.arange(math.ceil(t0 / period), math.floor(t1 / period) + 1) * period  # noqa
+
+
+def interpolate(
+    graph: RouteGraph,
+    route: Dict,
+    t0: float,
+    period: float = PERIOD
+) -> Tuple[Dict, float]:
+    """
+    points of a route (see RouteGraph.route) started at t0, as columns time,
+    x, y, angle, speed, pos and edge, and the arrival time
+    """
+    t1 = t0 + route["duration"]
+    ts = _sample_times(t0, t1, period)
+    rel = ts - t0
+    start, time, pts, pt_time = route["start"], route["time"], route["pts"], route["pt_time"]  # noqa
+    # vertex and shape segment of every point
+    k = np.clip(np.searchsorted(start, rel, side="right") - 1, 0, len(start) - 1)  # noqa
+    j = np.clip(np.searchsorted(pt_time, rel, side="right") - 1, 0, len(pt_time) - 2)  # noqa
+    d = pts[j + 1] - pts[j]
+    v = route["vertices"][k]
+    done = np.clip((rel - start[k]) / time[k], 0.0, 1.0)
+    backward = (v % graph._k) == 1
+    cols = {
+        "time": ts,
+        "x": np.interp(rel, pt_time, pts[:, 0]),
+        "y": np.interp(rel, pt_time, pts[:, 1]),
+        "angle": np.degrees(np.arctan2(d[:, 0], d[:, 1])) % 360.0,
+        "speed": graph.speed[v],
+        "pos": np.where(backward, 1.0 - done, done) * graph.length[v],
+        "edge": graph.edge_ids[v // graph._k],
+    }
+    return cols, t1
+
+
+def _stay(
+    last: Dict,
+    t0: float,
+    t1: float,
+    period: float
+) -> Dict:
+    """
+    points of an agent standing at the last point of last within (t0, t1)
+    """
+    ts = _sample_times(t0, t1, period)
+    ts = ts[(ts > t0) & (ts < t1)]
+    n = len(ts)
+    return {
+        "time": ts,
+        "x": np.full(n, last["x"]),
+        "y": np.full(n, last["y"]),
+        "angle": np.full(n, last["angle"]),
+        "speed": np.zeros(n),
+        "pos": np.full(n, last["pos"]),
+        "edge": np.full(n, last["edge"], dtype=object),
+    }
+
+
+def read_vehicle_types(
+    trip_files: List[str]
+) -> Dict:
+    """
+    type of every vehicle of the car and bike trip files
+    """
+    types = {}
+    for trip_file in trip_files:
+        for _, elem in ET.iterparse(str(trip_file)):
+            if elem.tag in ("trip", "vehicle"):
+                types[elem.get("id")] = elem.get("type", "")
+                elem.clear()
+    return types
+
+
+def iter_person_plans(
+    person_file: str
+) -> Iterator[Tuple]:
+    """
+    yield (person id, type, depart, plan) of a person trip file, where plan is
+    a list of (stage, from edge, to edge, vehicle id or until)
+    """
+    for _, elem in ET.iterparse(str(person_file)):
+        if elem.tag != "person":
+            continue
+        plan = []
+        for stage in elem:
+            if stage.tag == "stop":
+                plan.append(("stop", None, None, float(stage.get("until"))))
+            elif stage.tag in ("walk", "ride"):
+                plan.append((stage.tag, stage.get("from"), stage.get("to"), stage.get("lines")))  # noqa
+        yield elem.get("id"), elem.get("type", ""), float(elem.get("depart")), plan  # noqa
+        elem.clear()
+
+
+class _Points():
+    """
+    columns of the points of a chunk, collected per run of one agent
+    """
+    def __init__(self):
+        self.cols = {c: [] for c in ["time", "x", "y", "angle", "speed", "pos", "edge"]}  # noqa
+        self.ids, self.kinds, self.types, self.counts = [], [], [], []
+
+    def add(self, cols: Dict, agent: str, kind: str, vtype: str) -> None:
+        n = len(cols["time"])
+        if n == 0:
+            return
+        for c, v in cols.items():
+            self.cols[c].append(v)
+        self.ids.append(agent)
+        self.kinds.append(kind)
+        self.types.append(vtype)
+        self.counts.append(n)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def frame(self) -> pd.DataFrame:
+        cols = {c: np.concatenate(v) for c, v in self.cols.items()}
+        counts = np.array(self.counts, dtype=np.int64)
+        cols["id"] = np.repeat(np.array(self.ids, dtype=object), counts)
+        cols["kind"] = np.repeat(np.array(self.kinds, dtype=object), counts)
+        cols["type"] = np.repeat(np.array(self.types, dtype=object), counts)
+        return pd.DataFrame(cols, columns=FCD_COLUMNS).astype(FCD_DTYPES)
+
+
+def _to_geo(
+    net,
+    df: pd.DataFrame
+) -> pd.DataFrame:
+    # sumolib shifts the given arrays in place
+    lng, lat = net.convertXY2LonLat(df["x"].values.copy(), df["y"].values.copy())  # noqa
+    return df.assign(x=np.asarray(lng, dtype=np.float64), y=np.asarray(lat, dtype=np.float64))  # noqa
+
+
+def iter_preview_chunks(
+    net,
+    person_file: str,
+    vehicle_files: List[str] = (),
+    period: float = PERIOD,
+    speed: Dict = None,
+    dwell: bool = False,
+    geo: bool = True,
+    chunk_persons: int = CHUNK_PERSONS
+) -> Iterator[pd.DataFrame]:
+    """
+    yield preview points of the persons of person_file and the vehicles they
+    ride (types from vehicle_files), chunk_persons persons per chunk.
+    speed: mode speeds overriding SPEED
+    dwell: also write persons standing at their stops (as sumo does)
+    geo: x, y as lng, lat (as fcd-output.geo), else net coordinates
+    """
+    speeds = dict(SPEED)
+    if speed is not None:
+        speeds.update(speed)
+    graphs = {}
+    vtypes = read_vehicle_types(vehicle_files)
+
+    def graph(mode):
+        if mode not in graphs:
+            graphs[mode] = RouteGraph(net, mode, speeds[mode])
+        return graphs[mode]
+
+    points = _Points()
+    n_persons = 0
+    n_unrouted = 0
+    for pid, ptype, t, plan in iter_person_plans(person_file):
+        last = None
+        for stage, from_edge, to_edge, arg in plan:
+            if stage == "stop":
+                if dwell and last is not None:
+                    points.add(_stay(last, t, arg, period), pid, "person", ptype)  # noqa
+                t = max(t, arg)
+                continue
+            if stage == "walk":
+                mode = "walk"
+            else:
+                mode = "car" if arg.startswith("c_") else "bike"
+            route = graph(mode).route(from_edge, to_edge)
+            if route is None:
+                # sumo would not insert the agent, it appears at its next stop
+                n_unrouted += 1
+                continue
+            cols, t = interpolate(graph(mode), route, t, period)
+            points.add(cols, pid, "person", ptype)
+            if stage == "ride":
+                points.add(cols, arg, "vehicle", vtypes.get(arg, ""))
+            if len(cols["time"]) > 0:
+                last = {c: v[-1] for c, v in cols.items()}
+        n_persons += 1
+        if n_persons % chunk_persons == 0 and len(points) > 0:
+            df = points.frame().sort_values("time", kind="mergesort").reset_index(drop=True)  # noqa
+            yield _to_geo(net, df) if geo else df
+            points = _Points()
+    if len(points) > 0:
+        df = points.frame().sort_values("time", kind="mergesort").reset_index(drop=True)  # noqa
+        yield _to_geo(net, df) if geo else df
+    if n_unrouted > 0:
+        logging.warning("%d walks or rides without a route were skipped" % n_unrouted)  # noqa
+
+
+def preview_to_csv(
+    net,
+    person_file: str,
+    save_path: str,
+    vehicle_files: List[str] = (),
+    **kwargs
+) -> int:
+    """
+    write preview points (see iter_preview_chunks) as csv of FCD_COLUMNS,
+    return the number of points
+    """
+    n = 0
+    header = True
+    for chunk in iter_preview_chunks(net, person_file, vehicle_files, **kwargs):  # noqa
+        chunk.to_csv(save_path, mode="w" if header else "a", header=header, index=False)  # noqa
+        header = False
+        n += chunk.shape[0]
+    if header:
+        pd.DataFrame(columns=FCD_COLUMNS).to_csv(save_path, index=False)
+    return n
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    wd = Path(__file__).parents[1].absolute()
+    trip_dir = wd.joinpath('data', 'trips')
+    net = sumolib.net.readNet(str(wd.joinpath('data', 'map', 'notre_dame.net.xml')))  # noqa
+    preview_to_csv(
+        net,
+        trip_dir.joinpath('notre_dame_persons.trips.xml'),
+        wd.joinpath('output', 'notre_dame.preview.csv'),
+        vehicle_files=[
+            trip_dir.joinpath('notre_dame_cars.trips.xml'),
+            trip_dir.joinpath('notre_dame_bikes.trips.xml')
+        ]
+    )
+
+    print(0)
@@ -0,0 +1,297 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     profiler.py
+# @author   Jian Yang
+# @date     2020-09-07
+
+"""
+stage-level instrumentation for the ConTraG pipeline.
+Each stage (itinerary, stop edges, trips, routing, simulation) records wall time,
+cpu time, peak rss and item counts. The peak rss of a stage is its own, sampled
+from /proc/self/statm by a thread while the stage runs (linux only), next to the
+cumulative peak of the process so far; hot paths (e.g., one user in generate_trips)
+can be sampled. Results are exported as a json or csv run report, and an optional
+cProfile dump is written per stage.
+
+Usage:
+    profiler = StageProfiler("notre_dame", profile_dir="output/prof")
+    with profiler.stage("generate_itinerary") as st:
+        itin_df, stop_distr = generate_itinerary(raw_sch)
+        st.count(users=len(stop_distr), slots=itin_df.shape[0])
+    profiler.write_report("output/notre_dame.report.json")
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import random
+import logging
+import threading
+import cProfile
+from contextlib import contextmanager
+from typing import Dict
+try:
+    import resource
+except ImportError:
+    # not available on windows, rss is reported as None
+    resource = None
+
+logging.basicConfig(format='profiler:%(levelname)s: %(message)s')
+
+
+RSS_INTERVAL = 0.05  # seconds between rss samples of a stage
+STATM = "/proc/self/statm"
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def process_peak_rss_mb(children: bool = False) -> float:
+    """
+    peak resident set size (in MB) of this process or its waited-for children
+    since they started, i.e., cumulative over all stages so far
+    """
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    if sys.platform == "darwin":
+        return rss / 1024.0 / 1024.0
+    return rss / 1024.0
+
+
+def current_rss_mb() -> float:
+    """
+    resident set size (in MB) of this process now, None without /proc
+    """
+    try:
+        with open(STATM) as fd:
+            return int(fd.read().split()[1]) * PAGE_SIZE / 1024.0 / 1024.0
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RssSampler():
+    def __init__(self, interval: float = RSS_INTERVAL):
+        """
+        peak rss of this process between start() and stop(), sampled every
+        interval seconds by a daemon thread
+        """
+        self.interval = interval
+        self.peak = None
+        self._done = threading.Event()
+        self._thread = None
+
+    def _update(self) -> None:
+        rss = current_rss_mb()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def _run(self) -> None:
+        while not self._done.wait(self.interval):
+            self._update()
+
+    def start(self) -> "RssSampler":
+        self._update()
+        if self.peak is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> float:
+        self._done.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._update()
+        return self.peak
+
+
+class StageRecord():
+    def __init__(self, name: str):
+        self.name = name
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_rss_mb = None  # of this stage
+        self.process_peak_rss_mb = None  # of the process so far
+        self.children_peak_rss_mb = None
+        self.counts = {}
+        self.extra = {}
+
+    def count(self, **counts) -> None:
+        """
+        set item counts of the stage, e.g., users, slots, trips, edges
+        """
+        self.counts.update(counts)
+
+    def to_dict(self) -> Dict:
+        return {
+            "stage": self.name,
+            "wall_time": round(self.wall_time, 6),
+            "cpu_time": round(self.cpu_time, 6),
+            "peak_rss_mb": self.peak_rss_mb,
+            "process_peak_rss_mb": self.process_peak_rss_mb,
+            "children_peak_rss_mb": self.children_peak_rss_mb,
+            "counts": dict(self.counts),
+            "extra": dict(self.extra),
+        }
+
+
+class StageProfiler():
+    def __init__(
+        self,
+        name: str = "run",
+        sample_rate: float = 0.0,
+        profile_dir: str = None,
+        seed: int = None,
+        enabled: bool = True
+    ):
+        """
+        sample_rate: fraction of hot-path calls (e.g., users) being timed
+        profile_dir: if given, dump a cProfile file for every stage
+        enabled: a disabled profiler accepts all calls and records nothing
+        """
+        self.name = name
+        self.sample_rate = sample_rate
+        self.profile_dir = profile_dir
+        self.enabled = enabled
+        self.stages = []
+        self.samples = {}
+        self._rng = random.Random(seed)
+        self._t0 = time.time()
+
+    def get_stage(self, name: str) -> StageRecord:
+        for st in reversed(self.stages):
+            if st.name == name:
+                return st
+        raise KeyError("stage " + name + " not profiled.")
+
+    @contextmanager
+    def stage(self, name: str, **counts):
+        """
+        time a pipeline stage, yields the StageRecord to attach counts to
+        """
+        st = StageRecord(name)
+        st.count(**counts)
+        if not self.enabled:
+            yield st
+            return
+
+        prof = None
+        if self.profile_dir:
+            prof = cProfile.Profile()
+        rss = RssSampler().start()
+        wall_s, cpu_s = time.perf_counter(), time.process_time()
+        if prof is not None:
+            prof.enable()
+        try:
+            yield st
+        finally:
+            if prof is not None:
+                prof.disable()
+            st.wall_time = time.perf_counter() - wall_s
+            st.cpu_time = time.process_time() - cpu_s
+            st.peak_rss_mb = rss.stop()
+            st.process_peak_rss_mb = process_peak_rss_mb()
+            st.children_peak_rss_mb = process_peak_rss_mb(children=True)
+            self.stages.append(st)
+            if prof is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                prof.dump_stats(os.path.join(
+                    self.profile_dir, "%s.%s.prof" % (self.name, name)
+                ))
+            logging.info(
+                "%s: %.3fs wall, %.3fs cpu, %s" % (name, st.wall_time, st.cpu_time, st.counts)  # noqa
+            )
+
+    @contextmanager
+    def sample(self, stage: str, key: str):
+        """
+        time one hot-path call (e.g., one user) with probability sample_rate
+        """
+        if not self.enabled or self.sample_rate <= 0 \
+                or self._rng.random() >= self.sample_rate:
+            yield
+            return
+        wall_s = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(stage, []).append(
+                (str(key), time.perf_counter() - wall_s)
+            )
+
+    def sample_summary(self, stage: str) -> Dict:
+        t = sorted(x[1] for x in self.samples.get(stage, []))
+        if len(t) == 0:
+            return {"n": 0}
+        return {
+            "n": len(t),
+            "mean": sum(t) / len(t),
+            "p50": t[len(t) // 2],
+            "p95": t[min(len(t) - 1, int(len(t) * 0.95))],
+            "max": t[-1],
+        }
+
+    def report(self) -> Dict:
+        return {
+            "name": self.name,
+            "started": self._t0,
+            "total_wall_time": sum(st.wall_time for st in self.stages),
+            "stages": [st.to_dict() for st in self.stages],
+            "samples": {
+                stage: {
+                    "summary": self.sample_summary(stage),
+                    "calls": [{"key": k, "wall_time": t} for k, t in calls],
+                }
+                for stage, calls in self.samples.items()
+            },
+        }
+
+    def write_report(self, save_path: str) -> None:
+        """
+        write the run report, the format (json/csv) follows the file suffix
+        """
+        save_path = str(save_path)
+        if save_path.endswith(".csv"):
+            rows = [st.to_dict() for st in self.stages]
+            count_keys = sorted({k for r in rows for k in r["counts"]})
+            with open(save_path, "w", newline="") as fd:
+                writer = csv.writer(fd)
+                writer.writerow(
+                    ["stage", "wall_time", "cpu_time", "peak_rss_mb", "process_peak_rss_mb", "children_peak_rss_mb"]  # noqa
+                    + count_keys
+                )
+                for r in rows:
+                    writer.writerow(
+                        [r["stage"], r["wall_time"], r["cpu_time"], r["peak_rss_mb"], r["process_peak_rss_mb"], r["children_peak_rss_mb"]]  # noqa
+                        + [r["counts"].get(k, "") for k in count_keys]
+                    )
+        else:
+            with open(save_path, "w") as fd:
+                json.dump(self.report(), fd, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    logging.getLogger().setLevel(logging.INFO)
+    profiler = StageProfiler("debug", sample_rate=1.0)
+    with profiler.stage("loop") as st:
+        for i in range(10):
+            with profiler.sample("loop", i):
+                sum(range(100000))
+        st.count(items=10)
+    print(json.dumps(profiler.report()["stages"], indent=2))
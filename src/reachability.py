@@ -0,0 +1,323 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     reachability.py
+# @author   Jian Yang
+# @date     2020-10-02
+
+"""
+pre-simulation reachability check of the edges in stop2edges.
+Per vClass, the edges allowing it are split into strongly connected components
+(SCC) over the lane connections of the net (iterative Tarjan). Pedestrians may
+walk both directions and cross at any junction, so their components are the
+connected components of the edges joined at their nodes. Every pair of edges in
+the same component is mutually reachable, filter_stop2edges() keeps only edges
+of the largest (giant) component and reports the stops left without edges.
+Components are cached by the sha1 of the net file (and the ROI of a NetView).
+"""
+
+import os
+import hashlib
+import logging
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+
+logging.basicConfig(format='reachability:%(levelname)s: %(message)s')
+
+VCLASSES = ["pedestrian", "passenger", "bicycle"]
+UNDIRECTED = {"pedestrian"}
+# stop2edges lists and the vClass their edges are used with
+EDGE_KINDS = {
+    "ped_edges": "pedestrian",
+    "car_edges": "passenger",
+    "bike_edges": "bicycle",
+}
+
+
+def _node_id(node) -> str:
+    return node if isinstance(node, str) else node.getID()
+
+
+def _lane_index(lane) -> int:
+    return lane if isinstance(lane, int) else lane.getIndex()
+
+
+def _connections(edge):
+    """
+    (to edge, from lane index, to lane index) of all outgoing connections, for
+    sumolib.net.Net and net_loader.NetView
+    """
+    for to_edge, conns in edge.getOutgoing().items():
+        for c in conns:
+            if isinstance(c, tuple):
+                yield to_edge, c[0], c[1]
+            else:
+                yield to_edge, _lane_index(c.getFromLane()), _lane_index(c.getToLane())  # noqa
+
+
+def tarjan_scc(
+    n: int,
+    ptr: np.array,
+    adj: np.array
+) -> np.array:
+    """
+    iterative Tarjan over a CSR graph, returns the component label per vertex
+    """
+    index = np.full(n, -1, dtype=np.int64)
+    low = np.zeros(n, dtype=np.int64)
+    on_stack = np.zeros(n, dtype=bool)
+    label = np.full(n, -1, dtype=np.int64)
+    ptr, adj = ptr.tolist(), adj.tolist()
+    stack = []
+    counter = 0
+    n_comp = 0
+    for root in range(n):
+        if index[root] >= 0:
+            continue
+        # call stack of (vertex, position in its adjacency list)
+        work = [(root, ptr[root])]
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        while work:
+            v, pos = work[-1]
+            if pos < ptr[v + 1]:
+                work[-1] = (v, pos + 1)
+                w = adj[pos]
+                if index[w] < 0:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = True
+                    work.append((w, ptr[w]))
+                elif on_stack[w] and index[w] < low[v]:
+                    low[v] = index[w]
+                continue
+            work.pop()
+            if work:
+                u = work[-1][0]
+                if low[v] < low[u]:
+                    low[u] = low[v]
+            if low[v] == index[v]:
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    label[w] = n_comp
+                    if w == v:
+                        break
+                n_comp += 1
+    return label
+
+
+def _union_find_labels(
+    n_nodes: int,
+    a: np.array,
+    b: np.array
+) -> np.array:
+    """
+    connected components of an undirected graph given as node pairs (a, b)
+    """
+    parent = list(range(n_nodes))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(a.tolist(), b.tolist()):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[ri] = rj
+    return np.array([find(i) for i in range(n_nodes)], dtype=np.int64)
+
+
+def edge_components(
+    net,
+    vclass: str
+) -> np.array:
+    """
+    component label of every edge of net.getEdges() for vclass, -1 if the edge
+    does not allow vclass
+    """
+    edges = net.getEdges()
+    pos = {e.getID(): i for i, e in enumerate(edges)}
+    allowed = np.array([e.allows(vclass) for e in edges], dtype=bool)
+    label = np.full(len(edges), -1, dtype=np.int64)
+
+    if vclass in UNDIRECTED:
+        nodes = {}
+        a, b = [], []
+        for i in np.flatnonzero(allowed):
+            e = edges[i]
+            a.append(nodes.setdefault(_node_id(e.getFromNode()), len(nodes)))
+            b.append(nodes.setdefault(_node_id(e.getToNode()), len(nodes)))
+        a, b = np.array(a, dtype=np.int64), np.array(b, dtype=np.int64)
+        if a.size > 0:
+            roots = _union_find_labels(len(nodes), a, b)[a]
+            label[allowed] = np.unique(roots, return_inverse=True)[1]
+        return label
+
+    # directed graph over the allowed edges, arcs are lane connections allowed
+    # on both lanes
+    sub = np.full(len(edges), -1, dtype=np.int64)
+    sub[allowed] = np.arange(allowed.sum())
+    src, dst = [], []
+    for i in np.flatnonzero(allowed):
+        e = edges[i]
+        lanes = e.getLanes()
+        for to_edge, fl, tl in _connections(e):
+            j = pos.get(to_edge.getID())
+            if j is None or sub[j] < 0:
+                continue
+            if lanes[fl].allows(vclass) and to_edge.getLanes()[tl].allows(vclass):
+                src.append(sub[i])
+                dst.append(sub[j])
+    n = int(allowed.sum())
+    src, dst = np.array(src, dtype=np.int64), np.array(dst, dtype=np.int64)
+    order = np.argsort(src, kind="mergesort")
+    ptr = np.r_[0, np.cumsum(np.bincount(src, minlength=n))].astype(np.int64)
+    label[allowed] = tarjan_scc(n, ptr, dst[order])
+    return label
+
+
+def net_hash(
+    net_file: str,
+    roi: Tuple[float] = None
+) -> str:
+    h = hashlib.sha1()
+    with open(net_file, "rb") as fd:
+        for block in iter(lambda: fd.read(1 << 20), b""):
+            h.update(block)
+    if roi is not None:
+        h.update(repr(tuple(roi)).encode())
+    return h.hexdigest()
+
+
+class Reachability():
+    def __init__(
+        self,
+        net,
+        vclasses: List[str] = VCLASSES,
+        net_file: str = None,
+        cache_dir: str = None
+    ):
+        """
+        components of the net edges per vclass. With net_file and cache_dir,
+        components are cached as <cache_dir>/<net sha1>.scc.npz
+        """
+        self._edges = {e.getID(): i for i, e in enumerate(net.getEdges())}
+        self.labels = {}
+        cache = None
+        if net_file is not None and cache_dir is not None:
+            roi = net.getROI() if hasattr(net, "getROI") else None
+            cache = Path(cache_dir).joinpath(net_hash(net_file, roi) + ".scc.npz")
+            if cache.is_file():
+                with np.load(cache) as stored:
+                    self.labels = {
+                        c: stored[c] for c in stored.files
+                        if stored[c].size == len(self._edges)
+                    }
+        missing = [c for c in vclasses if c not in self.labels]
+        for c in missing:
+            self.labels[c] = edge_components(net, c)
+        if cache is not None and len(missing) > 0:
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            tmp = str(cache) + ".part.npz"
+            np.savez(tmp, **self.labels)
+            os.replace(tmp, cache)
+        self.giant = {}
+        for c, lab in self.labels.items():
+            lab = lab[lab >= 0]
+            self.giant[c] = int(np.bincount(lab).argmax()) if lab.size > 0 else -1
+
+    def component(self, edge_id: str, vclass: str) -> int:
+        i = self._edges.get(edge_id)
+        return -1 if i is None else int(self.labels[vclass][i])
+
+    def in_giant(self, edge_id: str, vclass: str) -> bool:
+        c = self.component(edge_id, vclass)
+        return c >= 0 and c == self.giant[vclass]
+
+    def reachable(self, from_edge: str, to_edge: str, vclass: str) -> bool:
+        """
+        True if both edges are mutually reachable for vclass
+        """
+        c = self.component(from_edge, vclass)
+        return c >= 0 and c == self.component(to_edge, vclass)
+
+    def summary(self) -> Dict:
+        out = {}
+        for c, lab in self.labels.items():
+            lab = lab[lab >= 0]
+            sizes = np.bincount(lab) if lab.size > 0 else np.zeros(0, dtype=np.int64)  # noqa
+            out[c] = {
+                "edges": int(lab.size),
+                "components": int(sizes.size),
+                "giant": int(sizes.max()) if sizes.size > 0 else 0,
+            }
+        return out
+
+
+def filter_stop2edges(
+    stop2edges: Dict,
+    reach: Reachability
+) -> Tuple[Dict]:
+    """
+    keep the edges of every stop in the giant component of their vclass (see
+    EDGE_KINDS), so that all from/to pairs drawn from stop2edges are mutually
+    reachable. Bikes depart from the car edges of a stop, a stop without
+    bike_edges gets its car edges in the giant bicycle component. Return the
+    filtered stop2edges and the unreachable stops as
+    {stop: [edge kinds left empty]}.
+    """
+    filtered = {}
+    unreachable = {}
+    for stop, kinds in stop2edges.items():
+        filtered[stop] = {}
+        if "bike_edges" not in kinds and "car_edges" in kinds:
+            kinds = dict(kinds, bike_edges=kinds["car_edges"])
+        for kind, edges in kinds.items():
+            vclass = EDGE_KINDS.get(kind)
+            if vclass is None:
+                filtered[stop][kind] = edges
+                continue
+            kept = [e for e in edges if reach.in_giant(e, vclass)]
+            filtered[stop][kind] = kept
+            if len(kept) == 0 and len(edges) > 0:
+                unreachable.setdefault(stop, []).append(kind)
+    for stop, kinds in unreachable.items():
+        logging.warning("no reachable %s for stop: %s" % (" or ".join(kinds), stop))  # noqa
+    return filtered, unreachable
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    import sumolib
+    from get_taz import read_loc_dict_file, get_stop_edges
+    wd = Path(__file__).parents[1].absolute()
+    net_file = wd.joinpath('data', 'map', 'notre_dame.net.xml')
+    loc_dict_file = wd.joinpath('data', 'map', 'notre_dame_loc_dict.csv')
+    net = sumolib.net.readNet(str(net_file))
+    reach = Reachability(net, net_file=net_file, cache_dir=net_file.parent)
+    print(reach.summary())
+    stop2edges = get_stop_edges(net, read_loc_dict_file(loc_dict_file), 100)
+    stop2edges, unreachable = filter_stop2edges(stop2edges, reach)
+    print(len(unreachable))
+
+    print(0)
@@ -19,16 +19,11 @@
 """
 generate sumoconfig file, and execute sumo program
 """
+
+from __future__ import annotations
+
 import os, sys
-import pandas as pd
-import numpy as np
 import subprocess
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-else:
-    sys.exit("please declare environment variable 'SUMO_HOME'")
-import sumolib
 from pathlib import Path
 from typing import Dict
 from get_taz import (
@@ -37,18 +32,202 @@ from get_taz import (
 )
 from scheduler import (
     read_raw_schedule,
-    generate_itinerary
+    generate_itinerary,
+    iter_raw_schedule,
+    iter_itinerary
 )
 from trip_generator import (
-    generate_trips
+    generate_trips,
+    generate_trips_stream
+)
+from net_loader import read_net_roi
+from shared_tables import get_stop_edges_parallel
+from reachability import Reachability, filter_stop2edges
+from edge_balancer import EdgeBalancer, WINDOW
+from profiler import StageProfiler
+from telemetry import SumoMonitor, INTERVAL
+from assignment import assign
+from checkpoint import sumo_state_args
+from preview import preview_to_csv
+from sim_config import (
+    get_profile,
+    departure_range,
+    write_sumocfg,
+    write_duarcfg
 )
+from lazy_import import lazy_sumolib
 
 
+sumolib = lazy_sumolib()
+
 T = 7200
 R = 100
+STATE_PERIOD = 3600  # simulated seconds between two saved sumo states
+
+
+def run_duarouter(
+    cfg_file: str,
+    profiler: StageProfiler = None,
+    bindir: str = None
+) -> int:
+    """
+    compute route files for cars and bikes with duarouter -c xxxx.duarcfg
+    """
+    if profiler is None:
+        profiler = StageProfiler(enabled=False)
+    duarouter = sumolib.checkBinary('duarouter', bindir)
+    with profiler.stage("duarouter") as st:
+        ret = subprocess.call([duarouter, "-c", str(cfg_file)])
+        st.extra["returncode"] = ret
+    return ret
+
+
+def run_assignment(
+    net_file: str,
+    trip_dir: str,
+    prefix: str,
+    work_dir: str,
+    profiler: StageProfiler = None,
+    workers: int = None,
+    **kwargs
+) -> Dict:
+    """
+    iterative route assignment of the car and bike trips (see assignment.py),
+    writes <trip_dir>/<prefix>_vehicles.rou.xml to be used by sumo instead of
+    the car and bike trip files
+    """
+    if profiler is None:
+        profiler = StageProfiler(enabled=False)
+    trip_dir = Path(trip_dir)
+    with profiler.stage("assignment") as st:
+        history = assign(
+            net_file=net_file,
+            trip_files=[
+                trip_dir.joinpath(prefix + '_cars.trips.xml'),
+                trip_dir.joinpath(prefix + '_bikes.trips.xml')
+            ],
+            manifest_file=trip_dir.joinpath(prefix + '_trips.csv'),
+            add_files=[trip_dir.joinpath('vtypes.add.xml')],
+            work_dir=work_dir,
+            save_path=trip_dir.joinpath(prefix + '_vehicles.rou.xml'),
+            workers=workers,
+            **kwargs
+        )
+        st.count(
+            vehicles=history["vehicles"],
+            windows=len(history["windows"]),
+            iterations=sum(h["iterations"] for h in history["windows"])
+        )
+        st.extra["windows"] = history["windows"]
+    return history
+
+
+def run_preview(
+    net_file: str,
+    trip_dir: str,
+    prefix: str,
+    save_path: str,
+    profiler: StageProfiler = None,
+    **kwargs
+) -> int:
+    """
+    preview trajectories of the trips without duarouter and sumo (see
+    preview.py), written as csv of fcd.FCD_COLUMNS to save_path
+    """
+    if profiler is None:
+        profiler = StageProfiler(enabled=False)
+    trip_dir = Path(trip_dir)
+    with profiler.stage("preview") as st:
+        net = sumolib.net.readNet(str(net_file))
+        n = preview_to_csv(
+            net,
+            trip_dir.joinpath(prefix + '_persons.trips.xml'),
+            save_path,
+            vehicle_files=[
+                trip_dir.joinpath(prefix + '_cars.trips.xml'),
+                trip_dir.joinpath(prefix + '_bikes.trips.xml')
+            ],
+            **kwargs
+        )
+        st.count(points=n)
+    return n
+
+
+def run_sumo(
+    cfg_file: str,
+    profiler: StageProfiler = None,
+    bindir: str = None,
+    metrics_file: str = None,
+    interval: float = INTERVAL,
+    time_budget: float = None,
+    state_dir: str = None,
+    state_period: float = STATE_PERIOD
+) -> int:
+    """
+    execute sumo with the given .sumocfg file. progress is sampled every
+    interval seconds into metrics_file (see telemetry.SumoMonitor) and the end
+    of run summary is added to the "sumo" stage of the run report.
+    state_dir: if given, the simulation state is saved there every state_period
+    seconds and a rerun resumes from the latest state (see checkpoint.py)
+    """
+    if profiler is None:
+        profiler = StageProfiler(enabled=False)
+    sumo = sumolib.checkBinary('sumo', bindir)
+    with profiler.stage("sumo") as st:
+        cmd = [sumo, "-c", str(cfg_file)]
+        if state_dir is not None:
+            cmd += sumo_state_args(state_dir, state_period, cfg_file=cfg_file)
+            if "--load-state" in cmd:
+                st.extra["resumed_from"] = cmd[cmd.index("--load-state") + 1]
+        monitor = SumoMonitor(
+            cmd,
+            metrics_file=metrics_file,
+            interval=interval,
+            time_budget=time_budget
+        )
+        monitor.start()
+        monitor.wait()
+        summary = monitor.summary()
+        st.extra["returncode"] = summary["returncode"]
+        st.extra["telemetry"] = summary
+        st.count(
+            vehicles=summary["vehicles"] or 0,
+            teleports=summary["teleports"]
+        )
+    return summary["returncode"]
 
 
-def run():
+def run(
+    profiler: StageProfiler = None,
+    roi_margin: float = None,
+    chunk_users: int = None,
+    workers: int = None,
+    checkpoint_dir: str = None,
+    seed: int = None,
+    balance_window: float = WINDOW,
+    profile: str = 'micro',
+    assign_routes: bool = False,
+    **profile_overrides
+) -> StageProfiler:
+    """
+    roi_margin: if given, only load the net around the stops (see net_loader)
+    chunk_users: if given, schedules are streamed into the trip files in chunks
+    of users (see generate_trips_stream) instead of being held in memory
+    workers: if given, stop edges are searched by this many processes sharing
+    the net (see shared_tables), and as many assignment windows run at once
+    checkpoint_dir, seed: with chunk_users, trips are written in shards to
+    checkpoint_dir and a rerun resumes after the last completed shard
+    balance_window: car and bike departures are spread over the edges of their
+    stop per window of this many seconds (see edge_balancer), None to draw the
+    edges uniformly
+    profile, profile_overrides: settings of the generated sumo and duarouter
+    configs (see sim_config.get_profile)
+    assign_routes: if True, the car and bike routes are assigned iteratively
+    (see run_assignment), else all trips are routed once by duarouter (see
+    run_duarouter); sumo runs the resulting routes instead of the trips
+    """
+    if profiler is None:
+        profiler = StageProfiler('notre_dame')
     wd = Path(__file__).parents[1].absolute()
     schedule_file = wd.joinpath('data', 'profiles', 'notre_dame_schedule.raw.csv')
     net_file = wd.joinpath('data', 'map', 'notre_dame.net.xml')
@@ -61,17 +240,42 @@ def run():
 
     # get itinerary
     # itin_df = read_intinerary(file_path=itinerary_path)
-    raw_sch = read_raw_schedule(file_path=schedule_file)
-    itin_df, stop_distr = generate_itinerary(raw_sch=raw_sch, win_t=T)
-
-    # read net
-    net = sumolib.net.readNet(str(net_file))
+    if chunk_users is None:
+        with profiler.stage("read_raw_schedule") as st:
+            raw_sch = read_raw_schedule(file_path=schedule_file)
+            st.count(rows=raw_sch.shape[0])
+        with profiler.stage("generate_itinerary") as st:
+            itin_df, stop_distr = generate_itinerary(raw_sch=raw_sch, win_t=T)
+            st.count(users=len(stop_distr), slots=itin_df.shape[0])
 
     # read loc_dict
     loc_dict = read_loc_dict_file(file_path=loc_dict_file)
 
+    # read net
+    with profiler.stage("read_net") as st:
+        if roi_margin is None:
+            net = sumolib.net.readNet(str(net_file))
+        else:
+            net = read_net_roi(net_file, loc_dict=loc_dict, margin=roi_margin)
+        st.count(edges=len(net.getEdges()))
+
     # get stop to edges mapping
-    stop2edges = get_stop_edges(net, loc_dict, R)
+    with profiler.stage("get_stop_edges") as st:
+        if workers is None:
+            stop2edges = get_stop_edges(net, loc_dict, R)
+        else:
+            stop2edges = get_stop_edges_parallel(net, loc_dict, R, workers=workers)  # noqa
+        st.count(
+            stops=len(stop2edges),
+            edges=sum(len(v["ped_edges"]) + len(v["car_edges"]) for v in stop2edges.values())  # noqa
+        )
+
+    # keep only stop edges that are mutually reachable, components are cached
+    # next to the net file
+    with profiler.stage("reachability") as st:
+        reach = Reachability(net, net_file=net_file, cache_dir=net_file.parent)
+        stop2edges, unreachable = filter_stop2edges(stop2edges, reach)
+        st.count(unreachable_stops=len(unreachable))
 
     # call scheduler to format the schedule (from raw schedule or sample)
     
@@ -80,23 +284,123 @@ def run():
 
     # call trip_generator to get the trip definition
     # TODO: needs to update get_mode on mode distr
-    generate_trips(
-        itin_df=itin_df,
-        stop_distr=stop_distr,
-        net=net,
-        stop2edges=stop2edges,
-        save_dir=trip_save_dir,
-        prefix='notre_dame'
-    )
+    balancer = None
+    if balance_window is not None:
+        balancer = EdgeBalancer(net, stop2edges, window=balance_window)
+    with profiler.stage("generate_trips") as st:
+        if chunk_users is None:
+            n_trips = generate_trips(
+                itin_df=itin_df,
+                stop_distr=stop_distr,
+                net=net,
+                stop2edges=stop2edges,
+                save_dir=trip_save_dir,
+                prefix='notre_dame',
+                profiler=profiler,
+                reach=reach,
+                balancer=balancer
+            )
+            st.count(users=len(stop_distr), trips=n_trips)
+        else:
+            # reading schedules and itineraries overlaps with writing trips
+            itin_chunks = iter_itinerary(
+                iter_raw_schedule(schedule_file, chunk_users), win_t=T
+            )
+            n_trips = generate_trips_stream(
+                itin_chunks,
+                net=net,
+                stop2edges=stop2edges,
+                save_dir=trip_save_dir,
+                prefix='notre_dame',
+                profiler=profiler,
+                reach=reach,
+                checkpoint_dir=checkpoint_dir,
+                seed=seed,
+                balancer=balancer
+            )
+            st.count(trips=n_trips)
+        if balancer is not None:
+            st.extra["departure_peak"] = balancer.peak()
+
+    sim_profile = get_profile(profile, **profile_overrides)
+    if assign_routes:
+        run_assignment(
+            net_file,
+            trip_save_dir,
+            'notre_dame',
+            wd.joinpath('output', 'assignment'),
+            profiler,
+            workers,
+            meso=sim_profile["meso"],
+            routing_threads=sim_profile["routing_threads"]
+        )
+
+    # write the duarouter and sumo configs, the simulated time window spans
+    # the generated departures
+    with profiler.stage("configs") as st:
+        begin, end = departure_range(trip_save_dir.joinpath('notre_dame_trips.csv'), margin=T)  # noqa
+        trip_files = [
+            trip_save_dir.joinpath('notre_dame_' + k + '.trips.xml')
+            for k in ('persons', 'cars', 'bikes')
+        ]
+        vtypes_file = trip_save_dir.joinpath('vtypes.add.xml')
+        if assign_routes:
+            # the assigned routes replace the car and bike trips
+            route_files = [trip_files[0], trip_save_dir.joinpath('notre_dame_vehicles.rou.xml')]  # noqa
+        else:
+            # all trips are routed once by duarouter, see below
+            route_files = [trip_save_dir.joinpath('notre_dame_all.rou.xml')]
+            write_duarcfg(
+                trip_save_dir.joinpath('notre_dame.duarcfg'),
+                net_file=net_file,
+                route_files=trip_files,
+                add_files=[vtypes_file],
+                output_file=route_files[0],
+                profile=sim_profile
+            )
+        write_sumocfg(
+            wd.joinpath('exp', 'notre_dame.sumocfg'),
+            net_file=net_file,
+            route_files=route_files,
+            add_files=[
+                wd.joinpath('data', 'map', 'notre_dame.poly.xml'),
+                vtypes_file
+            ],
+            begin=begin,
+            end=end,
+            fcd_file=wd.joinpath('output', 'notre_dame.fcd.xml'),
+            profile=sim_profile,
+            gui_settings=wd.joinpath('exp', 'notre_dame.view.xml')
+        )
+        st.extra["profile"] = profile
+        st.extra["assigned_routes"] = assign_routes
+        st.extra["begin"] = begin
+        st.extra["end"] = end
 
     # call duarouter -c xxxx.duarcfg to compute route files for cars and bike
+    if not assign_routes:
+        ret = run_duarouter(trip_save_dir.joinpath('notre_dame.duarcfg'), profiler)  # noqa
+        if ret != 0:
+            raise RuntimeError("duarouter failed with return code %d" % ret)
 
-    # write sumo config file and run sumo
+    # run sumo
 
     # processing output
-    print(0)
+    return profiler
 
 
 if __name__ == "__main__":
-    run()
-    os.system("/usr/share/sumo-dev/bin/sumo -c /home/jerry/Documents/Projects/ConTraG/exp/notre_dame.sumocfg")
+    wd = Path(__file__).parents[1].absolute()
+    profiler = StageProfiler(
+        'notre_dame',
+        sample_rate=0.1,
+        profile_dir=None  # e.g., wd.joinpath('output', 'prof') for cProfile dumps
+    )
+    run(profiler)
+    run_sumo(
+        wd.joinpath('exp', 'notre_dame.sumocfg'),
+        profiler,
+        metrics_file=wd.joinpath('output', 'notre_dame.metrics.jsonl')
+    )
+    profiler.write_report(wd.joinpath('output', 'notre_dame.report.json'))
+    profiler.write_report(wd.joinpath('output', 'notre_dame.report.csv'))
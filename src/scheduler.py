@@ -18,20 +18,39 @@
 """
 Two major features are realized in this python script
 1) translate a raw schedule into formatted itinerary
-2) extract key info. from sample trajectory data and generate itinerary
+2) extract key info. from sample trajectory data and generate itinerary,
+   i.e., stay points of GeoLife users as a raw schedule (extract_schedule)
+Both the raw schedule and the itinerary can also be streamed in chunks of
+users (iter_raw_schedule, iter_itinerary).
 """
 
+from __future__ import annotations
+
+import os
 import datetime
-import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
+from lazy_import import lazy_module
 
+pd = lazy_module("pandas")
 
 TIME_S = 0
 TIME_E = 432000
 T = 7200
 
+# GeoLife .plt files: 6 header lines, then
+# lat, lng, 0, altitude (feet), days since 1899-12-30, date, time
+PLT_HEADER = 6
+PLT_COLUMNS = ["lat", "lng", "zero", "alt", "days", "date", "time"]
+PLT_DTYPES = {"lat": np.float64, "lng": np.float64, "days": np.float64}
+DAYS_TO_EPOCH = 25569  # days from 1899-12-30 to 1970-01-01
+EARTH_R = 6371000.0
+STAY_TIME = 20 * 60  # min. duration (in seconds) of a stay point
+MAX_GAP = 3600  # a signal gap longer than this (in seconds) ends a stay
+CHUNK_USERS = 1000  # users per chunk of the streaming readers
+
 
 def convert24(str_t: str) -> datetime.time:
     """
@@ -160,11 +179,197 @@ def rm_itin_duplicates(
     return ret_df
 
 
+def read_plt(
+    file_path: str
+) -> pd.DataFrame:
+    """
+    read one GeoLife .plt file, returns lat, lng and t (unix time, GMT)
+    """
+    df = pd.read_csv(
+        file_path, skiprows=PLT_HEADER, header=None, names=PLT_COLUMNS,
+        usecols=["lat", "lng", "days"], dtype=PLT_DTYPES
+    )
+    df["t"] = np.round((df["days"].values - DAYS_TO_EPOCH) * 86400.0)
+    return df[["lat", "lng", "t"]]
+
+
+def haversine(
+    lat1: np.array,
+    lng1: np.array,
+    lat2: np.array,
+    lng2: np.array
+) -> np.array:
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 \
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_R * np.arcsin(np.sqrt(a))
+
+
+def detect_stay_points(
+    df: pd.DataFrame,
+    dist_th: float,
+    time_th: float = STAY_TIME,
+    max_gap: float = MAX_GAP
+) -> pd.DataFrame:
+    """
+    stay point detection on one user's points (lat, lng, t sorted by t).
+    Points are cut into segments that stay within dist_th of the segment's first
+    point (the anchor). The sweep is vectorized: each round computes the distance
+    of all points to their anchors and splits every segment at its first point
+    beyond dist_th, until no segment needs a split. Segments lasting at least
+    time_th are stay points, returned as lat, lng (centroid), arrive, leave.
+    """
+    n = df.shape[0]
+    if n == 0:
+        return pd.DataFrame(columns=["lat", "lng", "arrive", "leave"])
+    lat, lng, t = df["lat"].values, df["lng"].values, df["t"].values
+
+    brk = np.zeros(n, dtype=bool)
+    brk[0] = True
+    brk[1:] = (np.diff(t) > max_gap) \
+        | (haversine(lat[:-1], lng[:-1], lat[1:], lng[1:]) > dist_th)
+    while True:
+        seg = np.cumsum(brk) - 1
+        starts = np.flatnonzero(brk)
+        anchor = starts[seg]
+        over = np.flatnonzero(haversine(lat, lng, lat[anchor], lng[anchor]) > dist_th)
+        if over.size == 0:
+            break
+        _, first = np.unique(seg[over], return_index=True)
+        brk[over[first]] = True
+
+    ends = np.r_[starts[1:], n]
+    size = ends - starts
+    arrive, leave = t[starts], t[ends - 1]
+    stay = (leave - arrive) >= time_th
+    return pd.DataFrame({
+        "lat": (np.add.reduceat(lat, starts) / size)[stay],
+        "lng": (np.add.reduceat(lng, starts) / size)[stay],
+        "arrive": arrive[stay],
+        "leave": leave[stay],
+    })
+
+
+def _extract_user(
+    user_dir: str,
+    dist_th: float,
+    time_th: float
+) -> pd.DataFrame:
+    """
+    worker: parse all .plt files of one GeoLife user and detect stay points
+    """
+    traj_dir = os.path.join(user_dir, "Trajectory")
+    files = sorted(f for f in os.listdir(traj_dir) if f.endswith(".plt"))
+    if len(files) == 0:
+        return pd.DataFrame(columns=["user", "lat", "lng", "arrive", "leave"])
+    df = pd.concat([read_plt(os.path.join(traj_dir, f)) for f in files], ignore_index=True)  # noqa
+    df.sort_values(by="t", inplace=True, kind="mergesort")
+    stays = detect_stay_points(df, dist_th, time_th)
+    stays.insert(0, "user", os.path.basename(user_dir.rstrip(os.sep)))
+    return stays
+
+
+def grid_location(
+    lat: np.array,
+    lng: np.array,
+    cell: float = 0.001
+) -> np.array:
+    """
+    default location naming of stay points: the id of a ~100m grid cell
+    """
+    i = np.floor(np.asarray(lat) / cell).astype(np.int64)
+    j = np.floor(np.asarray(lng) / cell).astype(np.int64)
+    return ("g" + pd.Series(i).astype(str) + "_" + pd.Series(j).astype(str)).values
+
+
+def _format_12h(seconds: np.array) -> np.array:
+    """
+    seconds of the day into 12h time strings, e.g. "1:05pm" (see convert24)
+    """
+    minutes = (seconds // 60).astype(np.int64)
+    h, m = minutes // 60, minutes % 60
+    h12 = np.where(h % 12 == 0, 12, h % 12)
+    return (
+        pd.Series(h12).astype(str) + ":" + pd.Series(m).map("{:02d}".format)
+        + np.where(h < 12, "am", "pm")
+    ).values
+
+
+def stays_to_schedule(
+    stays: pd.DataFrame,
+    loc_mapper: Callable = grid_location,
+    tz_offset: float = 8
+) -> pd.DataFrame:
+    """
+    translate stay points into the raw schedule format of read_raw_schedule().
+    Stays are split at midnight and kept for weekdays (day 1-5) only, every
+    (user, ISO week) becomes one uid "<user>_<year><week>".
+    """
+    cols = ["uid", "day", "start_time", "end_time", "location"]
+    if stays.shape[0] == 0:
+        return pd.DataFrame(columns=cols)
+    stays = stays.copy()
+    stays["location"] = loc_mapper(stays["lat"].values, stays["lng"].values)
+    offset = tz_offset * 3600
+    arrive = stays["arrive"].values + offset
+    leave = stays["leave"].values + offset
+
+    # split the stays at midnight: one row per (stay, calendar day)
+    d0 = np.floor(arrive / 86400).astype(np.int64)
+    d1 = np.floor(leave / 86400).astype(np.int64)
+    rep = d1 - d0 + 1
+    idx = np.repeat(np.arange(stays.shape[0]), rep)
+    day = d0[idx] + (np.arange(idx.size) - np.repeat(np.cumsum(rep) - rep, rep))
+    start = np.maximum(arrive[idx], day * 86400.0) - day * 86400.0
+    end = np.minimum(leave[idx], day * 86400.0 + 86399.0) - day * 86400.0
+
+    dates = pd.to_datetime(day, unit="D")
+    iso = dates.isocalendar()
+    sch = pd.DataFrame({
+        "uid": stays["user"].values[idx] + "_" + (iso["year"].values * 100 + iso["week"].values).astype(str),  # noqa
+        "day": dates.dayofweek.values + 1,
+        "start": start,
+        "end": end,
+        "location": stays["location"].values[idx],
+    })
+    sch = sch[(sch["day"] <= 5) & (sch["end"] // 60 > sch["start"] // 60)]
+    sch["start_time"] = _format_12h(sch["start"].values)
+    sch["end_time"] = _format_12h(sch["end"].values)
+    sch = sch.sort_values(by=["uid", "day", "start"], kind="mergesort")
+    return sch[cols].reset_index(drop=True)
+
+
 def extract_schedule(
     sample_traj: str,
-    th: float
+    th: float,
+    time_th: float = STAY_TIME,
+    users: List[str] = None,
+    workers: int = None,
+    loc_mapper: Callable = grid_location,
+    tz_offset: float = 8
 ) -> pd.DataFrame:
-    pass
+    """
+    extract a raw schedule from sample trajectories (GeoLife "Data" directory).
+    The .plt files of every user are parsed and searched for stay points (within
+    th meters for at least time_th seconds) in a process pool. loc_mapper names
+    the stay points, e.g., by the nearest stop of a loc_dict with a
+    loc_index.LocationIndex.
+    """
+    sample_traj = Path(sample_traj)
+    if not sample_traj.is_dir():
+        raise FileNotFoundError("sample trajectory directory not found!")
+    if users is None:
+        users = sorted(p.name for p in sample_traj.iterdir() if p.joinpath("Trajectory").is_dir())  # noqa
+    user_dirs = [str(sample_traj.joinpath(u)) for u in users]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        stays = list(pool.map(
+            _extract_user, user_dirs,
+            [th] * len(user_dirs), [time_th] * len(user_dirs)
+        ))
+    stays = pd.concat(stays, ignore_index=True) if len(stays) > 0 \
+        else pd.DataFrame(columns=["user", "lat", "lng", "arrive", "leave"])
+    return stays_to_schedule(stays, loc_mapper=loc_mapper, tz_offset=tz_offset)
 
 
 def read_raw_schedule(
@@ -202,7 +407,6 @@ def generate_itinerary(
     sch_in_sec["s_right"] = sch_in_sec["start_time"].apply(lambda x: find_closest(slots, x, "right"))  # noqa
     sch_in_sec["e_right"] = sch_in_sec["end_time"].apply(lambda x: find_closest(slots, x, "right"))  # noqa
 
-    expand_to_slot(sch_in_sec.iloc[3], slots)
     sch_in_slot = pd.concat(
         [expand_to_slot(row, slots) for idx, row in sch_in_sec.iterrows()],
         axis=0
@@ -227,6 +431,76 @@ def generate_itinerary(
     return itin_df, stop_distr
 
 
+def _parse_raw_schedule(
+    raw_sch: pd.DataFrame
+) -> pd.DataFrame:
+    raw_sch = raw_sch.reset_index(drop=True)
+    raw_sch['start_time'] = raw_sch['start_time'].apply(convert24)
+    raw_sch['end_time'] = raw_sch['end_time'].apply(convert24)
+    return raw_sch
+
+
+def iter_raw_schedule(
+    file_path: str,
+    chunk_users: int = CHUNK_USERS
+) -> Iterator[pd.DataFrame]:
+    """
+    stream a raw schedule file, yield chunks of chunk_users complete users
+    (the last chunk has the remaining users). rows of a user are expected to
+    be contiguous in the file.
+    """
+    if not file_path.is_file():
+        raise FileNotFoundError("schedule file not found!")
+
+    pending = None  # complete users not yet yielded
+    carry = None  # the last user of a block may continue in the next block
+    for df in pd.read_csv(file_path, chunksize=max(chunk_users * 32, 1024)):
+        if carry is not None:
+            df = pd.concat([carry, df], ignore_index=True)
+        uid = df['uid'].values
+        last = np.flatnonzero(uid != uid[-1])
+        cut = last[-1] + 1 if last.size > 0 else 0
+        carry = df.iloc[cut:]
+        if cut == 0:
+            continue
+        if pending is None:
+            pending = df.iloc[:cut]
+        else:
+            pending = pd.concat([pending, df.iloc[:cut]], ignore_index=True)
+        codes = pd.factorize(pending['uid'])[0]
+        full = (codes[-1] + 1) // chunk_users * chunk_users
+        for s in range(0, full, chunk_users):
+            yield _parse_raw_schedule(pending[(codes >= s) & (codes < s + chunk_users)])  # noqa
+        pending = pending[codes >= full]
+    rest = [df for df in (pending, carry) if df is not None and df.shape[0] > 0]
+    if len(rest) > 0:
+        rest = pd.concat(rest, ignore_index=True)
+        codes = pd.factorize(rest['uid'])[0]
+        for s in range(0, codes[-1] + 1, chunk_users):
+            yield _parse_raw_schedule(rest[(codes >= s) & (codes < s + chunk_users)])  # noqa
+
+
+def iter_itinerary(
+    raw_sch: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+    win_t: int = T,
+    chunk_users: int = CHUNK_USERS
+) -> Iterator[Tuple[pd.DataFrame, Dict]]:
+    """
+    per-chunk version of generate_itinerary(), yield (itin_df, stop_distr) of
+    chunk_users users at a time. raw_sch is either a raw schedule, or chunks
+    of complete users, e.g., from iter_raw_schedule()
+    """
+    if isinstance(raw_sch, pd.DataFrame):
+        codes = pd.factorize(raw_sch['uid'])[0]
+        raw_sch = (
+            raw_sch[(codes >= s) & (codes < s + chunk_users)]
+            for s in range(0, codes.max() + 1 if codes.size > 0 else 0, chunk_users)  # noqa
+        )
+    for chunk in raw_sch:
+        if chunk.shape[0] > 0:
+            yield generate_itinerary(raw_sch=chunk, win_t=win_t)
+
+
 if __name__ == "__main__":
     wd = Path(__file__).parents[1].absolute()
     schedule_file = wd.joinpath('data', 'profiles', 'sample_schedule.raw.csv')
@@ -0,0 +1,469 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     shared_tables.py
+# @author   Jian Yang
+# @date     2020-09-30
+
+"""
+read-only lookup tables of the pipeline in shared memory, so that worker
+processes attach them zero-copy instead of reading (or unpickling) the net.
+SharedTables.publish() copies named numpy arrays into shared memory blocks and
+returns a picklable manifest, SharedTables.attach(manifest) maps them in a
+worker. Packers turn the pipeline structures into plain arrays:
+- pack_net(): edge ids, permission bitmasks (one bit per vClass) and a grid
+  index over the edge segments;
+- pack_stop2edges(): ped/car/bike edges of every stop as CSR;
+- pack_itinerary(): stop codes of every (user, timeslot);
+- pack_od(): an OD count matrix, e.g., from traj_stats.
+get_stop_edges_parallel() is get_taz.get_stop_edges() over a process pool
+that only attaches the packed net.
+"""
+
+from __future__ import annotations
+
+import math
+import functools
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+from get_taz import (
+    MAX_NEIGHBOR,
+    read_loc_dict_file
+)
+from net_loader import point_segment_distance
+from reachability import EDGE_KINDS
+from lazy_import import lazy_module, lazy_sumolib
+
+
+pd = lazy_module("pandas")
+sumolib = lazy_sumolib()
+
+CELL_SIZE = 100.0  # in meters, grid cell of the segment index
+
+
+@functools.lru_cache(maxsize=None)
+def _vclass_bits() -> Tuple:
+    vclasses = sorted(sumolib.net.lane.SUMO_VEHICLE_CLASSES)
+    return vclasses, {c: np.uint64(1) << np.uint64(i) for i, c in enumerate(vclasses)}  # noqa
+
+
+def __getattr__(name: str):
+    # VCLASSES and VCLASS_BIT need sumolib, which workers do not load
+    if name == "VCLASSES":
+        return _vclass_bits()[0]
+    if name == "VCLASS_BIT":
+        return _vclass_bits()[1]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+class SharedTables():
+    def __init__(
+        self,
+        manifest: Dict,
+        blocks: List,
+        owner: bool
+    ):
+        self.manifest = manifest
+        self._blocks = blocks
+        self._owner = owner
+        self._arrays = {}
+        for (name, spec), shm in zip(manifest["arrays"].items(), blocks):
+            arr = np.ndarray(spec["shape"], dtype=np.dtype(spec["dtype"]), buffer=shm.buf)  # noqa
+            if not owner:
+                arr.flags.writeable = False
+            self._arrays[name] = arr
+
+    @classmethod
+    def publish(
+        cls,
+        arrays: Dict[str, np.array],
+        meta: Dict = None
+    ) -> 'SharedTables':
+        """
+        copy arrays into new shared memory blocks, meta is passed as is
+        """
+        manifest = {"arrays": {}, "meta": dict(meta or {})}
+        blocks = []
+        try:
+            for name, arr in arrays.items():
+                arr = np.ascontiguousarray(arr)
+                if arr.dtype == object:
+                    raise TypeError("object arrays can not be shared: " + name)
+                shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+                blocks.append(shm)
+                np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+                manifest["arrays"][name] = {
+                    "shm": shm.name, "dtype": arr.dtype.str, "shape": arr.shape
+                }
+        except BaseException:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+            raise
+        return cls(manifest, blocks, owner=True)
+
+    @classmethod
+    def attach(
+        cls,
+        manifest: Dict
+    ) -> 'SharedTables':
+        blocks = [
+            shared_memory.SharedMemory(name=spec["shm"])
+            for spec in manifest["arrays"].values()
+        ]
+        return cls(manifest, blocks, owner=False)
+
+    @property
+    def meta(self) -> Dict:
+        return self.manifest["meta"]
+
+    def __getitem__(self, name: str) -> np.array:
+        return self._arrays[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._arrays
+
+    def close(self) -> None:
+        """
+        release the mapping, the owner also frees the blocks
+        """
+        self._arrays = {}
+        for shm in self._blocks:
+            shm.close()
+            if self._owner:
+                shm.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def pack_strings(
+    strings: List[str]
+) -> Tuple[np.array]:
+    """
+    strings as utf-8 bytes and offsets, string i is data[offsets[i]:offsets[i+1]]
+    """
+    enc = [str(s).encode() for s in strings]
+    offsets = np.r_[0, np.cumsum([len(b) for b in enc])].astype(np.int64)
+    return np.frombuffer(b"".join(enc), dtype=np.uint8), offsets
+
+
+def unpack_strings(
+    data: np.array,
+    offsets: np.array,
+    idx: np.array = None
+) -> List[str]:
+    buf = data.tobytes()
+    if idx is None:
+        idx = range(offsets.size - 1)
+    return [buf[offsets[i]:offsets[i + 1]].decode() for i in idx]
+
+
+def permission_mask(
+    permissions
+) -> np.uint64:
+    mask = np.uint64(0)
+    bits = _vclass_bits()[1]
+    for c in permissions:
+        mask |= bits.get(c, np.uint64(0))
+    return mask
+
+
+def pack_net(
+    net: sumolib.net,
+    includeJunctions: bool = True
+) -> Tuple[Dict]:
+    """
+    edge and segment arrays of a sumolib net (or net_loader.NetView), returns
+    (arrays, meta) for SharedTables.publish()
+    """
+    edges = net.getEdges()
+    masks = {}
+    perm = np.zeros(len(edges), dtype=np.uint64)
+    segs = []
+    for i, e in enumerate(edges):
+        for lane in e.getLanes():
+            key = frozenset(lane.getPermissions())
+            if key not in masks:
+                masks[key] = permission_mask(key)
+            perm[i] |= masks[key]
+        shape = e.getShape(includeJunctions)
+        for (x1, y1), (x2, y2) in zip(shape[:-1], shape[1:]):
+            segs.append((x1, y1, x2, y2, i))
+        if len(shape) == 1:
+            segs.append(tuple(shape[0]) + tuple(shape[0]) + (i,))
+    segs = np.array(segs, dtype=np.float64).reshape(-1, 5)
+
+    # grid index: segment ids of every cell a segment's bbox touches, as CSR
+    lo_x = np.floor(np.minimum(segs[:, 0], segs[:, 2]) / CELL_SIZE).astype(np.int64)  # noqa
+    hi_x = np.floor(np.maximum(segs[:, 0], segs[:, 2]) / CELL_SIZE).astype(np.int64)  # noqa
+    lo_y = np.floor(np.minimum(segs[:, 1], segs[:, 3]) / CELL_SIZE).astype(np.int64)  # noqa
+    hi_y = np.floor(np.maximum(segs[:, 1], segs[:, 3]) / CELL_SIZE).astype(np.int64)  # noqa
+    nx, ny = hi_x - lo_x + 1, hi_y - lo_y + 1
+    cnt = nx * ny
+    seg = np.repeat(np.arange(segs.shape[0]), cnt)
+    k = np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+    cell = _cell_key(lo_x[seg] + k // ny[seg], lo_y[seg] + k % ny[seg])
+    order = np.argsort(cell, kind="mergesort")
+    cell, seg = cell[order], seg[order]
+    first = np.r_[True, cell[1:] != cell[:-1]]
+
+    id_data, id_off = pack_strings([e.getID() for e in edges])
+    arrays = {
+        "edge_id_data": id_data,
+        "edge_id_off": id_off,
+        "edge_perm": perm,
+        "seg": segs,
+        "cell_key": cell[first],
+        "cell_ptr": np.r_[np.flatnonzero(first), cell.size].astype(np.int64),
+        "cell_seg": seg.astype(np.int64),
+    }
+    meta = {"vclasses": _vclass_bits()[0], "cell": CELL_SIZE}
+    return arrays, meta
+
+
+def _cell_key(cx: np.array, cy: np.array) -> np.array:
+    return ((cx + (1 << 31)) << 32) | (cy + (1 << 31))
+
+
+class SharedNet():
+    def __init__(
+        self,
+        tables: SharedTables
+    ):
+        """
+        read-only view on a packed net (see pack_net)
+        """
+        self.tables = tables
+        self._vbit = {c: np.uint64(1) << np.uint64(i) for i, c in enumerate(tables.meta["vclasses"])}  # noqa
+        self._cell = tables.meta["cell"]
+
+    def edge_ids(self, idx: np.array) -> List[str]:
+        return unpack_strings(self.tables["edge_id_data"], self.tables["edge_id_off"], idx)  # noqa
+
+    def allows(self, idx: np.array, vClass: str) -> np.array:
+        return (self.tables["edge_perm"][idx] & self._vbit[vClass]) != 0
+
+    def neighboring_edges(
+        self,
+        x: float,
+        y: float,
+        r: float
+    ) -> Tuple[np.array]:
+        """
+        (edge index, distance) of edges within distance r of (x, y)
+        """
+        t = self.tables
+        cx = np.arange(math.floor((x - r) / self._cell), math.floor((x + r) / self._cell) + 1)  # noqa
+        cy = np.arange(math.floor((y - r) / self._cell), math.floor((y + r) / self._cell) + 1)  # noqa
+        keys = _cell_key(np.repeat(cx, cy.size), np.tile(cy, cx.size))
+        pos = np.searchsorted(t["cell_key"], keys)
+        pos = pos[(pos < t["cell_key"].size) & (t["cell_key"][np.minimum(pos, t["cell_key"].size - 1)] == keys)]  # noqa
+        if pos.size == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        seg = np.unique(np.concatenate([
+            t["cell_seg"][t["cell_ptr"][p]:t["cell_ptr"][p + 1]] for p in pos
+        ]))
+        s = t["seg"][seg]
+        dist = point_segment_distance(x, y, s[:, 0], s[:, 1], s[:, 2], s[:, 3])
+        edge = s[:, 4].astype(np.int64)
+        near = dist < r
+        edge, dist = edge[near], dist[near]
+        # min. distance per edge
+        order = np.lexsort((dist, edge))
+        edge, dist = edge[order], dist[order]
+        first = np.r_[True, edge[1:] != edge[:-1]]
+        return edge[first], dist[first]
+
+
+def pack_stop2edges(
+    stop2edges: Dict,
+    edge_index: Dict[str, int]
+) -> Dict[str, np.array]:
+    """
+    stop names, and the edge indices of every stop as CSR, per edge kind of
+    EDGE_KINDS that all stops have (bike_edges only after
+    reachability.filter_stop2edges)
+    """
+    stops = list(stop2edges.keys())
+    data, off = pack_strings(stops)
+    arrays = {"stop_data": data, "stop_off": off}
+    kinds = [k for k in EDGE_KINDS if all(k in stop2edges[s] for s in stops)]
+    for kind in kinds:
+        lists = [[edge_index[e] for e in stop2edges[s][kind]] for s in stops]
+        arrays[kind + "_ptr"] = np.r_[0, np.cumsum([len(v) for v in lists])].astype(np.int64)  # noqa
+        arrays[kind] = np.array([i for v in lists for i in v], dtype=np.int64)
+    return arrays
+
+
+def unpack_stop2edges(
+    tables: SharedTables,
+    net: SharedNet
+) -> Dict:
+    stops = unpack_strings(tables["stop_data"], tables["stop_off"])
+    kinds = [k for k in EDGE_KINDS if k + "_ptr" in tables]
+    out = {}
+    for i, s in enumerate(stops):
+        out[s] = {}
+        for kind in kinds:
+            ptr = tables[kind + "_ptr"]
+            out[s][kind] = net.edge_ids(tables[kind][ptr[i]:ptr[i + 1]])
+    return out
+
+
+def pack_itinerary(
+    itin_df: pd.DataFrame
+) -> Dict[str, np.array]:
+    """
+    itinerary as a (user, timeslot) matrix of stop codes, -1 for null stops
+    """
+    uid_codes, uids = pd.factorize(itin_df["uid"])
+    slot_codes, slots = pd.factorize(itin_df["timeslot"], sort=True)
+    stop_codes, stops = pd.factorize(itin_df["stop"])
+    mat = np.full((len(uids), len(slots)), -1, dtype=np.int32)
+    mat[uid_codes, slot_codes] = stop_codes
+    uid_data, uid_off = pack_strings(uids)
+    stop_data, stop_off = pack_strings(stops)
+    return {
+        "itin": mat,
+        "itin_slots": np.asarray(slots, dtype=np.int64),
+        "itin_uid_data": uid_data, "itin_uid_off": uid_off,
+        "itin_stop_data": stop_data, "itin_stop_off": stop_off,
+    }
+
+
+def unpack_itinerary(
+    tables: SharedTables
+) -> pd.DataFrame:
+    mat = tables["itin"]
+    uids = unpack_strings(tables["itin_uid_data"], tables["itin_uid_off"])
+    stops = np.array(unpack_strings(tables["itin_stop_data"], tables["itin_stop_off"]) + [np.nan], dtype=object)  # noqa
+    return pd.DataFrame({
+        "uid": np.repeat(uids, mat.shape[1]),
+        "timeslot": np.tile(tables["itin_slots"], mat.shape[0]),
+        "stop": stops[mat.ravel()],  # -1 picks the trailing nan
+    })
+
+
+def pack_od(
+    od: Dict[str, int],
+    sep: str = "|"
+) -> Dict[str, np.array]:
+    """
+    OD counts {"origin|destination": n} (see traj_stats) as a dense matrix
+    """
+    pairs = [k.split(sep, 1) for k in od]
+    zones = sorted(set(z for p in pairs for z in p))
+    code = {z: i for i, z in enumerate(zones)}
+    mat = np.zeros((len(zones), len(zones)), dtype=np.float64)
+    for (o, d), n in zip(pairs, od.values()):
+        mat[code[o], code[d]] += n
+    data, off = pack_strings(zones)
+    return {"od": mat, "od_zone_data": data, "od_zone_off": off}
+
+
+_worker_net = None
+
+
+def _attach_worker(manifest: Dict) -> None:
+    global _worker_net
+    _worker_net = SharedNet(SharedTables.attach(manifest))
+
+
+def _stop_edges_worker(
+    xy: np.array,
+    radius: float,
+    max_neighbor: int
+) -> List[Tuple[np.array]]:
+    """
+    worker: get_taz.get_nearby_edges() for a batch of stops on the shared net
+    """
+    out = []
+    for x, y in xy:
+        edge, dist = _worker_net.neighboring_edges(x, y, radius)
+        if edge.size == 0:
+            out.append(None)
+            continue
+        order = np.argsort(dist, kind="mergesort")
+        edge = edge[order]
+        out.append((
+            edge[_worker_net.allows(edge, "pedestrian")][:max_neighbor],
+            edge[_worker_net.allows(edge, "passenger")][:max_neighbor],
+        ))
+    return out
+
+
+def get_stop_edges_parallel(
+    net: sumolib.net,
+    loc_dict: Dict,
+    radius: float,
+    workers: int = None,
+    batch: int = 256,
+    max_neighbor: int = MAX_NEIGHBOR
+) -> Dict:
+    """
+    same as get_taz.get_stop_edges(), workers attach the packed net from
+    shared memory instead of receiving a copy of it
+    """
+    stops = list(loc_dict.keys())
+    lng = np.array([loc_dict[s].lng for s in stops])
+    lat = np.array([loc_dict[s].lat for s in stops])
+    x, y = net.getGeoProj()(lng, lat)
+    off = net.getLocationOffset()
+    xy = np.column_stack([np.asarray(x) + off[0], np.asarray(y) + off[1]])
+
+    arrays, meta = pack_net(net)
+    ids = [e.getID() for e in net.getEdges()]
+    with SharedTables.publish(arrays, meta) as tables:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_attach_worker,
+            initargs=(tables.manifest,)
+        ) as pool:
+            batches = [xy[s:s + batch] for s in range(0, len(stops), batch)]
+            results = [r for res in pool.map(
+                _stop_edges_worker, batches,
+                [radius] * len(batches), [max_neighbor] * len(batches)
+            ) for r in res]
+
+    stop2edge = {}
+    for s, r in zip(stops, results):
+        if r is None:
+            raise ValueError("no neighboring edges found, try an larger radius of ROI")  # noqa
+        stop2edge[s] = {
+            "ped_edges": [ids[i] for i in r[0]],
+            "car_edges": [ids[i] for i in r[1]],
+        }
+    return stop2edge
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    wd = Path(__file__).parents[1].absolute()
+    net_file = wd.joinpath('data', 'map', 'notre_dame.net.xml')
+    loc_dict_file = wd.joinpath('data', 'map', 'notre_dame_loc_dict.csv')
+
+    net = sumolib.net.readNet(str(net_file))
+    loc_dict = read_loc_dict_file(file_path=loc_dict_file)
+    stop2edges = get_stop_edges_parallel(net, loc_dict, 100)
+    print(len(stop2edges))
+
+    print(0)
@@ -0,0 +1,274 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     sim_config.py
+# @author   Jian Yang
+# @date     2020-10-14
+
+"""
+generate the .sumocfg and .duarcfg files of a scenario instead of editing them
+by hand. Paths are written relative to the config file, and the simulated time
+window is taken from the generated departures (see departure_range).
+A profile trades fidelity for speed:
+- micro: microsimulation, fcd of every agent in every step (the former setup);
+- meso: mesoscopic simulation, fcd every 10s, parallel rerouting;
+- explore: mesoscopic with 5s steps, fcd of 10% of the agents every 60s.
+Every setting of a profile can be overridden, see get_profile().
+"""
+
+from __future__ import annotations
+
+import os
+import math
+from pathlib import Path
+from typing import Dict, List, Tuple
+from xml.sax.saxutils import quoteattr
+from lazy_import import lazy_module
+
+pd = lazy_module("pandas")
+
+T = 7200  # extra time (in seconds) for the last trips to arrive
+PROFILES = {
+    "micro": {
+        "meso": False,
+        "step_length": 1.0,
+        "fcd_period": 0,  # 0: every step
+        "fcd_probability": 1.0,
+        "fcd_agents": None,
+        "fcd_edges": None,
+        "routing_threads": 1,
+        "adaptation_steps": 30,
+    },
+    "meso": {
+        "meso": True,
+        "step_length": 1.0,
+        "fcd_period": 10,
+        "fcd_probability": 1.0,
+        "fcd_agents": None,
+        "fcd_edges": None,
+        "routing_threads": 4,
+        "adaptation_steps": 30,
+    },
+    "explore": {
+        "meso": True,
+        "step_length": 5.0,
+        "fcd_period": 60,
+        "fcd_probability": 0.1,
+        "fcd_agents": None,
+        "fcd_edges": None,
+        "routing_threads": 4,
+        "adaptation_steps": 6,
+    },
+}
+
+
+def get_profile(
+    name: str = "micro",
+    **overrides
+) -> Dict:
+    """
+    settings of a profile, e.g., get_profile("meso", fcd_period=30).
+    fcd_agents: ids of the only agents written to the fcd output
+    fcd_edges: ids of the only edges on which fcd points are written
+    """
+    if name not in PROFILES:
+        raise KeyError("profile " + name + " not found, choose from " + ", ".join(PROFILES))  # noqa
+    unknown = set(overrides) - set(PROFILES[name])
+    if len(unknown) > 0:
+        raise KeyError("unknown profile settings: " + ", ".join(sorted(unknown)))  # noqa
+    profile = dict(PROFILES[name])
+    profile.update(overrides)
+    return profile
+
+
+def departure_range(
+    manifest_file: str,
+    margin: float = T
+) -> Tuple[int]:
+    """
+    (begin, end) of the simulation from the trip manifest (see
+    trip_generator.write_manifest): the first departure, and the last one plus
+    margin seconds
+    """
+    depart = pd.read_csv(manifest_file, usecols=['depart'])['depart']
+    if depart.size == 0:
+        raise ValueError("no trips in " + str(manifest_file))
+    return int(math.floor(depart.min())), int(math.ceil(depart.max() + margin))
+
+
+def _rel(path: str, cfg_dir: Path) -> str:
+    # sumo resolves the paths of a config file relative to it
+    return Path(os.path.relpath(Path(path).absolute(), cfg_dir.absolute())).as_posix()  # noqa
+
+
+def _files(paths: List[str], cfg_dir: Path) -> str:
+    return ",".join(_rel(p, cfg_dir) for p in paths)
+
+
+def _write_config(
+    save_path: str,
+    sections: List[Tuple[str, List[Tuple[str, object]]]]
+) -> None:
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', "", "<configuration>"]
+    for section, options in sections:
+        options = [(k, v) for k, v in options if v is not None]
+        if len(options) == 0:
+            continue
+        lines.append("    <%s>" % section)
+        for k, v in options:
+            if isinstance(v, bool):
+                v = "true" if v else "false"
+            lines.append("        <%s value=%s/>" % (k, quoteattr(str(v))))
+        lines.append("    </%s>" % section)
+    lines.append("</configuration>")
+    with open(save_path, "w") as fd:
+        fd.write("\n".join(lines) + "\n")
+
+
+def write_sumocfg(
+    save_path: str,
+    net_file: str,
+    route_files: List[str],
+    add_files: List[str],
+    begin: int,
+    end: int,
+    fcd_file: str = None,
+    profile: Dict = None,
+    gui_settings: str = None
+) -> Dict:
+    """
+    write a .sumocfg file for the given profile (see get_profile), return the
+    profile
+    """
+    if profile is None:
+        profile = get_profile()
+    save_path = Path(save_path)
+    cfg_dir = save_path.parent
+    cfg_dir.mkdir(parents=True, exist_ok=True)
+
+    fcd_filter = []
+    if fcd_file is not None:
+        if profile["fcd_edges"] is not None:
+            # a selection file restricting the fcd output to these edges
+            edge_file = save_path.with_suffix(".fcd_edges.txt")
+            with open(edge_file, "w") as fd:
+                fd.write("".join("edge:%s\n" % e for e in profile["fcd_edges"]))  # noqa
+            fcd_filter.append(("fcd-output.filter-edges.input-file", _rel(edge_file, cfg_dir)))  # noqa
+        if profile["fcd_agents"] is not None:
+            agents = ",".join(profile["fcd_agents"])
+            fcd_filter += [
+                ("device.fcd.explicit", agents),
+                ("person-device.fcd.explicit", agents),
+                ("device.fcd.probability", 0),
+                ("person-device.fcd.probability", 0),
+            ]
+        elif profile["fcd_probability"] < 1.0:
+            fcd_filter += [
+                ("device.fcd.probability", profile["fcd_probability"]),
+                ("person-device.fcd.probability", profile["fcd_probability"]),
+            ]
+        if profile["fcd_period"] > 0:
+            fcd_filter.append(("device.fcd.period", profile["fcd_period"]))
+
+    _write_config(save_path, [
+        ("input", [
+            ("net-file", _rel(net_file, cfg_dir)),
+            ("route-files", _files(route_files, cfg_dir)),
+            ("additional-files", _files(add_files, cfg_dir) if len(add_files) > 0 else None),  # noqa
+        ]),
+        ("time", [
+            ("begin", begin),
+            ("end", end),
+            ("step-length", profile["step_length"]),
+        ]),
+        ("mesoscopic", [
+            ("mesosim", True if profile["meso"] else None),
+        ]),
+        ("routing", [
+            ("device.rerouting.adaptation-steps", profile["adaptation_steps"]),
+            ("device.rerouting.threads", profile["routing_threads"] if profile["routing_threads"] > 1 else None),  # noqa
+        ]),
+        ("gui_only", [
+            ("gui-settings-file", None if gui_settings is None else _rel(gui_settings, cfg_dir)),  # noqa
+        ]),
+        ("output", [
+            ("fcd-output", None if fcd_file is None else _rel(fcd_file, cfg_dir)),  # noqa
+            ("fcd-output.geo", True if fcd_file is not None else None),
+        ] + fcd_filter),
+    ])
+    return profile
+
+
+def write_duarcfg(
+    save_path: str,
+    net_file: str,
+    route_files: List[str],
+    add_files: List[str],
+    output_file: str,
+    profile: Dict = None,
+    alternatives: bool = False
+) -> Dict:
+    """
+    write a .duarcfg file routing route_files into output_file, with the
+    routing threads of the profile (see get_profile), return the profile
+    """
+    if profile is None:
+        profile = get_profile()
+    save_path = Path(save_path)
+    cfg_dir = save_path.parent
+    cfg_dir.mkdir(parents=True, exist_ok=True)
+    output_file = Path(output_file)
+    alt_file = None
+    if alternatives:
+        name = output_file.name[:-len(".rou.xml")] if output_file.name.endswith(".rou.xml") else output_file.stem  # noqa
+        alt_file = _rel(output_file.with_name(name + ".rou.alt.xml"), cfg_dir)
+    _write_config(save_path, [
+        ("input", [
+            ("net-file", _rel(net_file, cfg_dir)),
+            ("route-files", _files(route_files, cfg_dir)),
+            ("additional-files", _files(add_files, cfg_dir) if len(add_files) > 0 else None),  # noqa
+        ]),
+        ("output", [
+            ("output-file", _rel(output_file, cfg_dir)),
+            ("alternatives-output", alt_file),
+        ]),
+        ("processing", [
+            ("routing-threads", profile["routing_threads"] if profile["routing_threads"] > 1 else None),  # noqa
+        ]),
+        ("report", [
+            ("xml-validation", "never"),
+            ("no-step-log", True),
+        ]),
+    ])
+    return profile
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    wd = Path(__file__).parents[1].absolute()
+    trip_dir = wd.joinpath('data', 'trips')
+    begin, end = departure_range(trip_dir.joinpath('sample_trips.csv'))
+    write_sumocfg(
+        wd.joinpath('output', 'sample.meso.sumocfg'),
+        net_file=wd.joinpath('data', 'map', 'notre_dame.net.xml'),
+        route_files=[trip_dir.joinpath('sample_' + k + '.trips.xml') for k in ('persons', 'cars', 'bikes')],  # noqa
+        add_files=[trip_dir.joinpath('vtypes.add.xml')],
+        begin=begin,
+        end=end,
+        fcd_file=wd.joinpath('output', 'sample.fcd.xml'),
+        profile=get_profile("meso")
+    )
+
+    print(0)
@@ -0,0 +1,301 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     synthetic.py
+# @author   Jian Yang
+# @date     2020-09-09
+
+"""
+synthetic inputs for benchmarking and testing, no downloads needed:
+- synthetic_loc_dict(): random named stops inside a bounding box;
+- synthetic_schedule(): raw schedules in the format of read_raw_schedule();
+- write_grid_net(): a procedurally generated grid .net.xml readable by sumolib;
+- write_fcd(): a fcd-output.geo like file for post-processing benchmarks.
+"""
+
+from __future__ import annotations
+
+import math
+import numpy as np
+from typing import List, Tuple
+from lazy_import import lazy_module
+
+pd = lazy_module("pandas")
+
+
+# WSEN bbox of the default Notre Dame map (see map_builder.get_osm)
+DEFAULT_BBOX = (-86.28, 41.68, -86.22, 41.72)
+EARTH_R = 6371000.0
+
+
+def synthetic_loc_dict(
+    n_stops: int,
+    bbox: Tuple[float] = DEFAULT_BBOX,
+    seed: int = 0
+) -> pd.DataFrame:
+    """
+    random stops named s0, s1, ... in the same columns as the loc_dict csv
+    """
+    rng = np.random.RandomState(seed)
+    west, south, east, north = bbox
+    return pd.DataFrame({
+        "loc": ["s%d" % i for i in range(n_stops)],
+        "lat": np.round(rng.uniform(south, north, n_stops), 6),
+        "lng": np.round(rng.uniform(west, east, n_stops), 6),
+        "poly": "",
+    })
+
+
+def _to_12h(minutes: np.array) -> np.array:
+    """
+    minutes of the day into 12h time strings accepted by scheduler.convert24
+    """
+    h = minutes // 60
+    m = minutes % 60
+    tail = np.where(h < 12, "am", "pm")
+    h12 = np.where(h % 12 == 0, 12, h % 12)
+    return pd.Series(h12).astype(str).values + ":" \
+        + pd.Series(m).map("{:02d}".format).values + tail
+
+
+def synthetic_schedule(
+    n_users: int,
+    stops: List[str],
+    days: int = 5,
+    max_activities: int = 4,
+    seed: int = 0
+) -> pd.DataFrame:
+    """
+    generate a raw schedule (uid, day, start_time, end_time, location).
+    every user sleeps at a home stop until 7am and visits up to max_activities
+    other stops per day, all activities are non-overlapping and within the day.
+    """
+    rng = np.random.RandomState(seed)
+    stops = np.asarray(stops)
+    uids = np.array(["u%07d" % i for i in range(n_users)])
+    home = stops[rng.randint(0, len(stops), n_users)]
+
+    frames = []
+    for day in range(1, days + 1):
+        # overnight stay at home
+        frames.append(pd.DataFrame({
+            "uid": uids, "day": day,
+            "start": 0, "end": 7 * 60,
+            "location": home,
+        }))
+        # activities are laid out in max_activities equal blocks after 8am
+        n_act = rng.randint(1, max_activities + 1, n_users)
+        block = (23 * 60 - 8 * 60) // max_activities
+        for k in range(max_activities):
+            active = n_act > k
+            n = int(active.sum())
+            start = 8 * 60 + k * block + rng.randint(0, block // 2, n)
+            dur = rng.randint(20, block // 2, n)
+            frames.append(pd.DataFrame({
+                "uid": uids[active], "day": day,
+                "start": start, "end": start + dur,
+                "location": stops[rng.randint(0, len(stops), n)],
+            }))
+    sch = pd.concat(frames, axis=0, ignore_index=True)
+    sch.sort_values(by=["uid", "day", "start"], inplace=True, kind="mergesort")
+    sch["start_time"] = _to_12h(sch["start"].values)
+    sch["end_time"] = _to_12h(sch["end"].values)
+    return sch[["uid", "day", "start_time", "end_time", "location"]].reset_index(drop=True)  # noqa
+
+
+def _tmerc_param(lng: float, lat: float) -> str:
+    return (
+        "+proj=tmerc +lat_0=%.6f +lon_0=%.6f +k=1 +x_0=0 +y_0=0 " % (lat, lng)
+        + "+ellps=WGS84 +datum=WGS84 +units=m +no_defs"
+    )
+
+
+def _shape_str(pts: List[Tuple[float]]) -> str:
+    return " ".join("%.2f,%.2f" % p for p in pts)
+
+
+def grid_bbox(
+    nx: int = 10,
+    ny: int = 10,
+    spacing: float = 200.0,
+    bbox: Tuple[float] = DEFAULT_BBOX
+) -> Tuple[float]:
+    """
+    geo bounding box (WSEN) covered by the grid network of write_grid_net()
+    """
+    west, south, east, north = bbox
+    c_lng, c_lat = (west + east) / 2.0, (south + north) / 2.0
+    w, h = (nx - 1) * spacing, (ny - 1) * spacing
+    dlat = math.degrees(h / 2.0 / EARTH_R)
+    dlng = math.degrees(w / 2.0 / EARTH_R / math.cos(math.radians(c_lat)))
+    return c_lng - dlng, c_lat - dlat, c_lng + dlng, c_lat + dlat
+
+
+def write_grid_net(
+    save_path: str,
+    nx: int = 10,
+    ny: int = 10,
+    spacing: float = 200.0,
+    bbox: Tuple[float] = DEFAULT_BBOX
+) -> None:
+    """
+    write a nx*ny grid network centered in bbox. every street is two-way with
+    a sidewalk (lane 0, pedestrian only) and a road lane (lane 1, no pedestrian).
+    the projection is a transverse mercator centered in bbox, so that lon/lat
+    of loc_dict stops can be converted by sumolib (requires pyproj).
+    """
+    west, south, east, north = bbox
+    c_lng, c_lat = (west + east) / 2.0, (south + north) / 2.0
+    w, h = (nx - 1) * spacing, (ny - 1) * spacing
+    # projected coordinates have their origin at the bbox center
+    orig = grid_bbox(nx, ny, spacing, bbox)
+
+    def nid(i, j):
+        return "n%d_%d" % (i, j)
+
+    def pos(i, j):
+        return i * spacing, j * spacing
+
+    edges = []  # (id, from, to)
+    for i in range(nx):
+        for j in range(ny):
+            for di, dj in ((1, 0), (0, 1)):
+                if i + di < nx and j + dj < ny:
+                    a, b = nid(i, j), nid(i + di, j + dj)
+                    edges.append(("%sto%s" % (a, b), (i, j), (i + di, j + dj)))
+                    edges.append(("%sto%s" % (b, a), (i + di, j + dj), (i, j)))
+
+    incoming = {}
+    outgoing = {}
+    for e in edges:
+        incoming.setdefault(e[2], []).append(e)
+        outgoing.setdefault(e[1], []).append(e)
+
+    fd = open(save_path, "w")
+    fd.write('<?xml version="1.0" encoding="UTF-8"?>\n\n')
+    fd.write('<net version="1.6" junctionCornerDetail="5" limitTurnSpeed="5.50">\n\n')  # noqa
+    fd.write(
+        '    <location netOffset="%.2f,%.2f" convBoundary="0.00,0.00,%.2f,%.2f" '
+        'origBoundary="%.6f,%.6f,%.6f,%.6f" projParameter="%s"/>\n\n'
+        % (w / 2.0, h / 2.0, w, h,
+           orig[0], orig[1], orig[2], orig[3],
+           _tmerc_param(c_lng, c_lat))
+    )
+    for eid, (i0, j0), (i1, j1) in edges:
+        (x0, y0), (x1, y1) = pos(i0, j0), pos(i1, j1)
+        length = math.hypot(x1 - x0, y1 - y0)
+        # unit normal to the right of the driving direction
+        nx_, ny_ = (y1 - y0) / length, -(x1 - x0) / length
+        fd.write(
+            '    <edge id="%s" from="%s" to="%s" priority="1">\n'
+            % (eid, nid(i0, j0), nid(i1, j1))
+        )
+        for idx, (off, allow) in enumerate(((4.8, 'allow="pedestrian"'), (1.6, 'disallow="pedestrian"'))):  # noqa
+            fd.write(
+                '        <lane id="%s_%d" index="%d" %s speed="13.89" length="%.2f" width="3.20" shape="%s"/>\n'  # noqa
+                % (eid, idx, idx, allow, length,
+                   _shape_str([(x0 + off * nx_, y0 + off * ny_), (x1 + off * nx_, y1 + off * ny_)]))  # noqa
+            )
+        fd.write('    </edge>\n')
+    fd.write('\n')
+    for i in range(nx):
+        for j in range(ny):
+            x, y = pos(i, j)
+            inc = " ".join(
+                "%s_%d" % (e[0], k) for e in incoming.get((i, j), []) for k in (0, 1)
+            )
+            fd.write(
+                '    <junction id="%s" type="priority" x="%.2f" y="%.2f" incLanes="%s" intLanes="" shape="%s"/>\n'  # noqa
+                % (nid(i, j), x, y, inc,
+                   _shape_str([(x - 8, y - 8), (x + 8, y - 8), (x + 8, y + 8), (x - 8, y + 8)]))  # noqa
+            )
+    fd.write('\n')
+    for node, inc in incoming.items():
+        for e_in in inc:
+            for e_out in outgoing.get(node, []):
+                uturn = e_out[2] == e_in[1]
+                if uturn:
+                    continue
+                for k in (0, 1):
+                    fd.write(
+                        '    <connection from="%s" to="%s" fromLane="%d" toLane="%d" dir="s" state="M"/>\n'  # noqa
+                        % (e_in[0], e_out[0], k, k)
+                    )
+    fd.write('\n</net>\n')
+    fd.close()
+
+
+def write_fcd(
+    save_path: str,
+    n_agents: int,
+    n_steps: int,
+    begin: float = 0.0,
+    bbox: Tuple[float] = DEFAULT_BBOX,
+    seed: int = 0
+) -> int:
+    """
+    write a fcd-output.geo like file of random walks for n_agents persons and
+    vehicles over n_steps seconds, return the number of points written
+    """
+    rng = np.random.RandomState(seed)
+    west, south, east, north = bbox
+    lng = rng.uniform(west, east, n_agents)
+    lat = rng.uniform(south, north, n_agents)
+    is_person = np.arange(n_agents) % 2 == 0
+    ids = np.where(
+        is_person,
+        ["p%d" % i for i in range(n_agents)],
+        ["c_%d_0" % i for i in range(n_agents)]
+    )
+    speed = np.where(is_person, 1.3, 10.0)
+    angle = rng.uniform(0, 360, n_agents)
+    pos = np.zeros(n_agents)
+
+    n_points = 0
+    fd = open(save_path, "w")
+    fd.write('<?xml version="1.0" encoding="UTF-8"?>\n\n')
+    fd.write('<fcd-export>\n')
+    for step in range(n_steps):
+        fd.write('    <timestep time="%.2f">\n' % (begin + step))
+        angle = np.mod(angle + rng.normal(0, 10, n_agents), 360)
+        rad = np.radians(angle)
+        lng += speed * np.sin(rad) / EARTH_R / np.cos(np.radians(lat)) * 180 / np.pi
+        lat += speed * np.cos(rad) / EARTH_R * 180 / np.pi
+        pos += speed
+        for k in range(n_agents):
+            if is_person[k]:
+                fd.write(
+                    '        <person id="%s" x="%.6f" y="%.6f" angle="%.6f" speed="%.6f" pos="%.6f" edge="e%d" slope="0.000000"/>\n'  # noqa
+                    % (ids[k], lng[k], lat[k], angle[k], speed[k], pos[k], k)
+                )
+            else:
+                fd.write(
+                    '        <vehicle id="%s" x="%.6f" y="%.6f" angle="%.6f" type="tc0" speed="%.6f" pos="%.6f" lane="e%d_1" slope="0.000000"/>\n'  # noqa
+                    % (ids[k], lng[k], lat[k], angle[k], speed[k], pos[k], k)
+                )
+        n_points += n_agents
+        fd.write('    </timestep>\n')
+    fd.write('</fcd-export>\n')
+    fd.close()
+    return n_points
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    loc_df = synthetic_loc_dict(20)
+    sch = synthetic_schedule(10, loc_df["loc"].tolist())
+    print(sch.head(10))
+    write_grid_net("/tmp/grid.net.xml", 5, 5)
+    print(0)
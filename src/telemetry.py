@@ -0,0 +1,364 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     telemetry.py
+# @author   Jian Yang
+# @date     2020-10-05
+
+"""
+live telemetry of sumo runs.
+SumoMonitor starts sumo with its step log enabled (--step-log.period,
+--duration-log.statistics) and parses the log while the simulation runs:
+    Step #3600.00 (12ms ~= 83.33*RT, ~2500.00UPS, vehicles TOT 812 ACT 30 BUF 2)
+Every interval seconds a snapshot (simulation time, steps/s, real time factor,
+active and pending vehicles, teleports, rss of sumo, eta) is appended to a
+rolling jsonl metrics file and kept for progress(). The statistics sumo prints
+at the end of the run are parsed into summary(), e.g., to be added to the run
+report (see run.run_sumo).
+
+Usage:
+    monitor = SumoMonitor([sumo, "-c", cfg_file], metrics_file="sumo.metrics.jsonl")
+    monitor.start()
+    while monitor.running():
+        print(monitor.progress())
+        time.sleep(60)
+    ret = monitor.wait()
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+import subprocess
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from typing import Callable, Dict, List
+try:
+    import psutil
+except ImportError:
+    # rss is read from /proc, None where it does not exist
+    psutil = None
+
+logging.basicConfig(format='telemetry:%(levelname)s: %(message)s')
+
+INTERVAL = 10.0  # seconds between two metrics snapshots
+STEP_LOG_PERIOD = 100  # simulation steps between two step log lines
+MAX_BYTES = 16 << 20  # size of the metrics file before it is rotated
+
+STEP_RE = re.compile(
+    r"Step #(?P<time>[\d.]+)"
+    r"(?: \((?P<ms>\d+)ms ~= (?P<rtf>[\d.]+|inf)\*RT, ~(?P<ups>[\d.]+|inf)UPS)?"
+)
+VEH_RE = re.compile(r"vehicles TOT (?P<tot>\d+) ACT (?P<act>\d+) BUF (?P<buf>\d+)")  # noqa
+PERSON_RE = re.compile(r"persons TOT (?P<tot>\d+) ACT (?P<act>\d+)")
+TELEPORT_RE = re.compile(r"Teleporting vehicle")
+STAT_RE = re.compile(r"^\s*(?P<key>[A-Za-z][\w .()-]*?)\s*:\s*(?P<value>-?[\d.]+)")  # noqa
+
+
+def rss_mb(pid: int) -> float:
+    """
+    current resident set size (in MB) of a running process, None if unknown
+    """
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss / 1024.0 / 1024.0
+        except psutil.Error:
+            return None
+    try:
+        with open("/proc/%d/status" % pid) as fd:
+            for line in fd:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def cfg_time_range(cfg_file: str) -> tuple:
+    """
+    (begin, end) of a .sumocfg file in seconds, None where not set
+    """
+    begin, end = None, None
+    root = ET.parse(str(cfg_file)).getroot()
+    for node in root.iter():
+        if node.tag == "begin":
+            begin = float(node.get("value"))
+        elif node.tag == "end":
+            end = float(node.get("value"))
+    return begin, end
+
+
+def _to_float(s: str) -> float:
+    return None if s is None else float(s)
+
+
+class SumoMonitor():
+    def __init__(
+        self,
+        cmd: List[str],
+        metrics_file: str = None,
+        interval: float = INTERVAL,
+        step_log_period: int = STEP_LOG_PERIOD,
+        begin: float = None,
+        end: float = None,
+        time_budget: float = None,
+        max_bytes: int = MAX_BYTES,
+        on_progress: Callable[[Dict], None] = None
+    ):
+        """
+        cmd: sumo command line, e.g., [sumo, "-c", cfg_file]; begin and end are
+        read from the -c file if not given and are needed for the eta
+        metrics_file: jsonl file the snapshots are appended to, rotated to
+        <metrics_file>.1 once it is larger than max_bytes
+        time_budget: wall time (in seconds) the run should fit into, a warning
+        is logged once the projected wall time exceeds it
+        on_progress: called with every snapshot, e.g., to kill() the run
+        """
+        self.cmd = [str(c) for c in cmd] + [
+            "--step-log.period", str(step_log_period),
+            "--duration-log.statistics", "true",
+        ]
+        if begin is None and "--begin" in self.cmd:
+            # e.g., a run resumed from a saved state
+            begin = float(self.cmd[self.cmd.index("--begin") + 1])
+        if (begin is None or end is None) and "-c" in self.cmd:
+            cfg_begin, cfg_end = cfg_time_range(self.cmd[self.cmd.index("-c") + 1])  # noqa
+            begin = cfg_begin if begin is None else begin
+            end = cfg_end if end is None else end
+        self.begin = 0.0 if begin is None else begin
+        self.end = end
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.time_budget = time_budget
+        self.max_bytes = max_bytes
+        self.on_progress = on_progress
+
+        self.proc = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._threads = []
+        self._state = {
+            "sim_time": None,
+            "steps": 0,
+            "rtf": None,
+            "ups": None,
+            "vehicles": None,
+            "active": None,
+            "pending": None,
+            "persons": None,
+            "active_persons": None,
+            "teleports": 0,
+        }
+        self._stats = {}
+        self._section = None
+        self._snapshots = []
+        self._peak_rss = None
+        self._over_budget = False
+        self._t0 = None
+        self._last = None
+
+    def start(self) -> "SumoMonitor":
+        self._t0 = time.perf_counter()
+        self.proc = subprocess.Popen(
+            self.cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        self._threads = [
+            threading.Thread(target=self._read, daemon=True),
+            threading.Thread(target=self._sample, daemon=True),
+        ]
+        for th in self._threads:
+            th.start()
+        return self
+
+    def running(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def wait(self) -> int:
+        """
+        wait for sumo to exit, write the last snapshot and return its exit code
+        """
+        ret = self.proc.wait()
+        self._done.set()
+        for th in self._threads:
+            th.join()
+        self._snapshot()
+        return ret
+
+    def kill(self) -> None:
+        if self.running():
+            self.proc.kill()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.kill()
+        self.wait()
+
+    def _read(self) -> None:
+        """
+        parse the output of sumo, step log lines are ended by \\r
+        """
+        buf = b""
+        for block in iter(lambda: self.proc.stdout.read1(1 << 16), b""):
+            lines = re.split(rb"[\r\n]", buf + block)
+            buf = lines.pop()
+            for line in lines:
+                self._parse(line.decode(errors="replace"))
+        self._parse(buf.decode(errors="replace"))
+        self.proc.stdout.close()
+
+    def _parse(self, line: str) -> None:
+        if len(line.strip()) == 0:
+            return
+        m = STEP_RE.search(line)
+        if m is not None:
+            update = {
+                "sim_time": float(m.group("time")),
+                "rtf": _to_float(m.group("rtf")),
+                "ups": _to_float(m.group("ups")),
+            }
+            m = VEH_RE.search(line)
+            if m is not None:
+                update["vehicles"] = int(m.group("tot"))
+                update["active"] = int(m.group("act"))
+                update["pending"] = int(m.group("buf"))
+            m = PERSON_RE.search(line)
+            if m is not None:
+                update["persons"] = int(m.group("tot"))
+                update["active_persons"] = int(m.group("act"))
+            with self._lock:
+                self._state.update(update)
+                self._state["steps"] += 1
+            return
+        if TELEPORT_RE.search(line) is not None:
+            with self._lock:
+                self._state["teleports"] += 1
+            return
+        # end of run statistics, e.g., "Vehicles:" followed by " Inserted: 812"
+        if line.rstrip().endswith(":") and not line.startswith(" "):
+            self._section = line.split()[0].rstrip(":").lower()
+            return
+        m = STAT_RE.match(line)
+        if m is not None and self._section is not None:
+            key = m.group("key").strip().lower().replace(" ", "_")
+            with self._lock:
+                self._stats.setdefault(self._section, {})[key] = float(m.group("value"))  # noqa
+
+    def _sample(self) -> None:
+        while not self._done.wait(self.interval):
+            self._snapshot()
+
+    def _snapshot(self) -> Dict:
+        now = time.perf_counter()
+        rss = rss_mb(self.proc.pid) if self.running() else None
+        with self._lock:
+            snap = dict(self._state)
+        snap["wall_time"] = round(now - self._t0, 3)
+        snap["rss_mb"] = rss
+        if rss is not None:
+            self._peak_rss = rss if self._peak_rss is None else max(self._peak_rss, rss)  # noqa
+
+        # simulated seconds per wall second, overall and since the last snapshot
+        sim_t = snap["sim_time"]
+        snap["speed"] = None
+        snap["recent_speed"] = None
+        snap["eta"] = None
+        if sim_t is not None and now > self._t0:
+            snap["speed"] = (sim_t - self.begin) / (now - self._t0)
+            if self._last is not None and self._last[1] is not None and now > self._last[0]:  # noqa
+                snap["recent_speed"] = (sim_t - self._last[1]) / (now - self._last[0])  # noqa
+            if self.end is not None and snap["speed"] > 0:
+                snap["eta"] = max(0.0, self.end - sim_t) / snap["speed"]
+        self._last = (now, sim_t)
+
+        if self.time_budget is not None and snap["eta"] is not None \
+                and not self._over_budget \
+                and snap["wall_time"] + snap["eta"] > self.time_budget:
+            self._over_budget = True
+            logging.warning(
+                "projected wall time %.0fs exceeds the budget of %.0fs"
+                % (snap["wall_time"] + snap["eta"], self.time_budget)
+            )
+        snap["over_budget"] = self._over_budget
+        self._snapshots.append(snap)
+        self._write(snap)
+        if self.on_progress is not None:
+            self.on_progress(snap)
+        return snap
+
+    def _write(self, snap: Dict) -> None:
+        if self.metrics_file is None:
+            return
+        path = Path(self.metrics_file)
+        if path.is_file() and path.stat().st_size > self.max_bytes:
+            os.replace(path, str(path) + ".1")
+        with open(path, "a") as fd:
+            fd.write(json.dumps(snap) + "\n")
+
+    def progress(self) -> Dict:
+        """
+        the latest snapshot, taken now if none was taken yet
+        """
+        if len(self._snapshots) == 0:
+            return self._snapshot()
+        return self._snapshots[-1]
+
+    def summary(self) -> Dict:
+        """
+        end of run summary, e.g., for StageRecord.extra
+        """
+        with self._lock:
+            state = dict(self._state)
+            stats = {k: dict(v) for k, v in self._stats.items()}
+        speeds = [s["recent_speed"] for s in self._snapshots if s["recent_speed"] is not None]  # noqa
+        wall = self._snapshots[-1]["wall_time"] if len(self._snapshots) > 0 else None  # noqa
+        return {
+            "returncode": None if self.proc is None else self.proc.returncode,
+            "wall_time": wall,
+            "sim_time": state["sim_time"],
+            "step_logs": state["steps"],
+            "vehicles": state["vehicles"],
+            "persons": state["persons"],
+            "teleports": int(stats.get("vehicles", {}).get("teleports", state["teleports"])),  # noqa
+            "peak_rss_mb": self._peak_rss,
+            "mean_speed": None if len(speeds) == 0 else sum(speeds) / len(speeds),  # noqa
+            "min_speed": None if len(speeds) == 0 else min(speeds),
+            "statistics": stats,
+        }
+
+
+if __name__ == "__main__":
+    """
+    The main is used for debugging only
+    """
+    import sys
+    logging.getLogger().setLevel(logging.INFO)
+    wd = Path(__file__).parents[1].absolute()
+    sumo = os.path.join(os.environ.get("SUMO_HOME", ""), "bin", "sumo")
+    monitor = SumoMonitor(
+        [sumo, "-c", wd.joinpath('exp', 'notre_dame.sumocfg')],
+        metrics_file=wd.joinpath('output', 'notre_dame.metrics.jsonl'),
+        interval=5.0
+    )
+    monitor.start()
+    while monitor.running():
+        time.sleep(5.0)
+        print(monitor.progress(), file=sys.stderr)
+    monitor.wait()
+    print(json.dumps(monitor.summary(), indent=2))
+
+    print(0)
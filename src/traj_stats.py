@@ -0,0 +1,642 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     traj_stats.py
+# @author   Jian Yang
+# @date     2020-09-25
+
+"""
+streaming trajectory statistics, to validate synthetic traces against real
+ones (e.g., GeoLife). One pass over chunks of points (time, id, x, y) yields:
+- distributions of point speeds, trip lengths, trip durations and dwell times
+  (per mode and "all"), as fixed-bin histograms plus t-digest like sketches;
+- mode shares (trips per mode) and origin-destination counts between zones.
+Every aggregate is mergeable, so partitions of agents (files, GeoLife users)
+can be processed in parallel and combined, and saved as json.
+Trips are cut by dwells (no movement for at least dwell_min seconds) and by
+signal gaps longer than max_gap.
+
+Usage:
+    python traj_stats.py -f output/notre_dame.fcd.xml -r data/geolife/Data -o report.json
+"""
+
+import sys
+import json
+import optparse
+import numpy as np
+import pandas as pd
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List
+from fcd import (
+    CHUNK_SIZE,
+    iter_fcd_chunks
+)
+from scheduler import (
+    haversine,
+    read_plt,
+    grid_location
+)
+
+
+V_STOP = 0.5  # steps slower than this (in m/s) are stationary
+DWELL_MIN = 300.0  # min. stationary time (in seconds) that ends a trip
+MAX_GAP = 600.0  # a signal gap longer than this (in seconds) ends a trip
+ZONE_CELL = 0.01  # grid cell (in degrees) of OD zones
+COMPRESSION = 100
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+BINS = {
+    "speed": np.arange(0.0, 50.5, 0.5),
+    "trip_length": np.r_[0.0, np.logspace(1, 6, 101)],
+    "trip_duration": np.r_[0.0, np.logspace(1, 5.5, 91)],
+    "dwell_time": np.r_[0.0, np.logspace(2, 6, 81)],
+}
+
+optParser = optparse.OptionParser()
+optParser.add_option("-f", "--fcd", default=None, help="synthetic fcd xml (fcd-output.geo)")  # noqa
+optParser.add_option("--csv", default=None, help="synthetic points as csv, e.g., from gps_noise.py")  # noqa
+optParser.add_option(
+    "-r", "--reference", default=None,
+    help="reference GeoLife Data directory, or saved statistics json"
+)
+optParser.add_option("-o", "--output", default="report.json", help="comparison report json")  # noqa
+optParser.add_option("--save-stats", default=None, help="save the synthetic statistics json")  # noqa
+optParser.add_option("-w", "--workers", type="int", default=None, help="processes for GeoLife users")  # noqa
+optParser.add_option("--zone-cell", type="float", default=ZONE_CELL, help="OD grid cell in degrees")  # noqa
+
+
+class QuantileSketch():
+    def __init__(
+        self,
+        compression: int = COMPRESSION
+    ):
+        """
+        mergeable quantile sketch of weighted centroids (t-digest like): the
+        scale function k(q) = compression / (2 pi) * asin(2q - 1) keeps the
+        centroids small at the tails and at most ~compression/2 in total
+        """
+        self.compression = compression
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.min = np.inf
+        self.max = -np.inf
+        self._buf = []
+        self._n_buf = 0
+
+    def add(
+        self,
+        values: np.array
+    ) -> None:
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self._buf.append(values)
+        self._n_buf += values.size
+        if self._n_buf > 20 * self.compression:
+            self._compress()
+
+    def _compress(self) -> None:
+        if self._n_buf > 0:
+            vals = np.concatenate(self._buf)
+            self.means = np.r_[self.means, vals]
+            self.weights = np.r_[self.weights, np.ones(vals.size)]
+            self._buf, self._n_buf = [], 0
+        if self.means.size <= 1:
+            return
+        order = np.argsort(self.means, kind="mergesort")
+        m, w = self.means[order], self.weights[order]
+        cum = np.cumsum(w)
+        q_mid = (cum - w / 2.0) / cum[-1]
+        k = self.compression / (2.0 * np.pi) * np.arcsin(2.0 * q_mid - 1.0)
+        group = np.floor(k - k[0]).astype(np.int64)
+        group = np.r_[0, np.cumsum(np.diff(group) != 0)]
+        ws = np.bincount(group, weights=w)
+        self.means = np.bincount(group, weights=m * w) / ws
+        self.weights = ws
+
+    def merge(
+        self,
+        other: 'QuantileSketch'
+    ) -> None:
+        other._compress()
+        if other.means.size == 0:
+            return
+        self.means = np.r_[self.means, other.means]
+        self.weights = np.r_[self.weights, other.weights]
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+
+    def count(self) -> float:
+        return self.weights.sum() + self._n_buf
+
+    def quantile(
+        self,
+        q: List[float]
+    ) -> np.array:
+        self._compress()
+        if self.means.size == 0:
+            return np.full(len(q), np.nan)
+        cum = np.cumsum(self.weights)
+        mid = cum - self.weights / 2.0
+        x = np.r_[0.0, mid, cum[-1]]
+        y = np.r_[self.min, self.means, self.max]
+        return np.interp(np.asarray(q) * cum[-1], x, y)
+
+    def to_dict(self) -> Dict:
+        self._compress()
+        return {
+            "compression": self.compression,
+            "means": self.means.tolist(),
+            "weights": self.weights.tolist(),
+            "min": None if self.means.size == 0 else float(self.min),
+            "max": None if self.means.size == 0 else float(self.max),
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> 'QuantileSketch':
+        sk = cls(d["compression"])
+        sk.means = np.asarray(d["means"], dtype=np.float64)
+        sk.weights = np.asarray(d["weights"], dtype=np.float64)
+        if sk.means.size > 0:
+            sk.min, sk.max = d["min"], d["max"]
+        return sk
+
+
+class Distribution():
+    def __init__(
+        self,
+        edges: np.array,
+        compression: int = COMPRESSION
+    ):
+        """
+        histogram over fixed bin edges (values outside fall into the first or
+        last bin), a quantile sketch and the sum for the mean
+        """
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(self.edges.size - 1, dtype=np.int64)
+        self.sum = 0.0
+        self.sketch = QuantileSketch(compression)
+
+    def add(
+        self,
+        values: np.array
+    ) -> None:
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+        idx = np.clip(np.searchsorted(self.edges, values, side="right") - 1, 0, self.counts.size - 1)  # noqa
+        self.counts += np.bincount(idx, minlength=self.counts.size)
+        self.sum += values.sum()
+        self.sketch.add(values)
+
+    def merge(
+        self,
+        other: 'Distribution'
+    ) -> None:
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("histograms with different bins can not be merged!")
+        self.counts += other.counts
+        self.sum += other.sum
+        self.sketch.merge(other.sketch)
+
+    @property
+    def n(self) -> int:
+        return int(self.counts.sum())
+
+    def summary(self) -> Dict:
+        n = self.n
+        return {
+            "count": n,
+            "mean": self.sum / n if n > 0 else None,
+            "quantiles": dict(zip(
+                ["p%d" % round(q * 100) for q in QUANTILES],
+                [None if np.isnan(v) else float(v) for v in self.sketch.quantile(QUANTILES)]  # noqa
+            )),
+        }
+
+    def to_dict(self) -> Dict:
+        return {
+            "edges": self.edges.tolist(),
+            "counts": self.counts.tolist(),
+            "sum": self.sum,
+            "sketch": self.sketch.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> 'Distribution':
+        dist = cls(d["edges"], d["sketch"]["compression"])
+        dist.counts = np.asarray(d["counts"], dtype=np.int64)
+        dist.sum = d["sum"]
+        dist.sketch = QuantileSketch.from_dict(d["sketch"])
+        return dist
+
+
+def fcd_mode(
+    ids: np.array
+) -> np.array:
+    """
+    mode of sumo agents by id, see trip_generator: c_* car, b_* bike, p* person
+    """
+    ids = pd.Series(ids).astype(str)
+    return np.select(
+        [ids.str.startswith("c_"), ids.str.startswith("b_"), ids.str.startswith("p")],  # noqa
+        ["car", "bike", "walk"], default="unknown"
+    )
+
+
+class TrajStats():
+    def __init__(
+        self,
+        geo: bool = True,
+        v_stop: float = V_STOP,
+        dwell_min: float = DWELL_MIN,
+        max_gap: float = MAX_GAP,
+        mode_fn: Callable = fcd_mode,
+        zone_fn: Callable = None
+    ):
+        """
+        geo: x/y are lng/lat, else meters
+        mode_fn: maps agent ids to modes
+        zone_fn: maps (lat, lng) of trip ends to OD zones, default a grid
+        """
+        self.geo = geo
+        self.v_stop = v_stop
+        self.dwell_min = dwell_min
+        self.max_gap = max_gap
+        self.mode_fn = mode_fn
+        self.zone_fn = zone_fn if zone_fn is not None \
+            else partial(grid_location, cell=ZONE_CELL)
+        self.dists = {}
+        self.modes = {}
+        self.od = {}
+        # open per agent state: last point and the current trip/stop
+        self._last = None
+        self._state = {}
+
+    def _dist(self, name: str, mode: str) -> Distribution:
+        key = name + "/" + mode
+        if key not in self.dists:
+            self.dists[key] = Distribution(BINS[name])
+        return self.dists[key]
+
+    def _add(self, name: str, mode: np.array, values: np.array) -> None:
+        mode = np.asarray(mode)
+        values = np.asarray(values, dtype=np.float64)
+        self._dist(name, "all").add(values)
+        for m in np.unique(mode):
+            self._dist(name, m).add(values[mode == m])
+
+    def update(
+        self,
+        chunk: pd.DataFrame
+    ) -> None:
+        """
+        add a chunk of points (time, id, x, y), later chunks must not contain
+        earlier points of an agent
+        """
+        pts = pd.DataFrame({
+            "id": chunk["id"].astype(str).values,
+            "time": chunk["time"].values.astype(np.float64),
+            "x": chunk["x"].values.astype(np.float64),
+            "y": chunk["y"].values.astype(np.float64),
+        })
+        if self._last is not None:
+            pts = pd.concat([self._last, pts], ignore_index=True)
+        pts.sort_values(["id", "time"], inplace=True, kind="mergesort")
+        ids = pts["id"].values
+        t, x, y = pts["time"].values, pts["x"].values, pts["y"].values
+        last = np.r_[ids[1:] != ids[:-1], True]
+        self._last = pts[last]
+        if ids.size < 2:
+            return
+
+        same = ids[1:] == ids[:-1]
+        dt = np.diff(t)
+        if self.geo:
+            d = haversine(y[:-1], x[:-1], y[1:], x[1:])
+        else:
+            d = np.hypot(np.diff(x), np.diff(y))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            v = np.where(dt > 0, d / dt, 0.0)
+        # step states: 0 gap, 1 stationary, 2 moving
+        state = np.where(dt > self.max_gap, 0, np.where(v < self.v_stop, 1, 2))
+        steps = np.flatnonzero(same)
+        codes, uniq = pd.factorize(ids)
+        modes = np.asarray(self.mode_fn(uniq))
+        mode_of = dict(zip(uniq, modes))
+
+        moving = steps[state[steps] == 2]
+        self._add("speed", modes[codes[moving]], v[moving])
+
+        # runs of equal state per agent, handled by the per agent state machine
+        s_ids, s_state = ids[steps + 1], state[steps]
+        brk = np.r_[True, (s_ids[1:] != s_ids[:-1]) | (s_state[1:] != s_state[:-1]) | (steps[1:] != steps[:-1] + 1)]  # noqa
+        starts = np.flatnonzero(brk)
+        ends = np.r_[starts[1:], steps.size] - 1
+        run_d = np.add.reduceat(d[steps], starts) if starts.size > 0 else np.zeros(0)  # noqa
+        p0, p1 = steps[starts], steps[ends] + 1
+        trips, dwells = [], []
+        for a, s, i0, i1, rd in zip(s_ids[starts], s_state[starts], p0, p1, run_d):  # noqa
+            self._run(a, s, t[i0], x[i0], y[i0], t[i1], x[i1], y[i1], rd, trips, dwells)  # noqa
+        self._emit(trips, dwells, mode_of)
+
+    def _run(self, a, s, t0, x0, y0, t1, x1, y1, dist, trips, dwells) -> None:
+        """
+        one run of steps of agent a, from point 0 to point 1
+        """
+        st = self._state.get(a)
+        if st is None:
+            # trip start (t, x, y), trip length, stop start (t, x, y, length)
+            st = self._state[a] = [None, 0.0, None, 0.0]
+        if s == 0:
+            self._close_stop(st, t0, dwells, a)
+            self._close_trip(st, t0, x0, y0, trips, a)
+            return
+        if s == 2:
+            self._close_stop(st, t0, dwells, a)
+            if st[0] is None:
+                st[0], st[1] = (t0, x0, y0), 0.0
+            st[1] += dist
+            return
+        # stationary
+        if st[2] is None:
+            st[2], st[3] = (t0, x0, y0), 0.0
+        st[3] += dist
+        if st[0] is not None:
+            st[1] += dist
+            if t1 - st[2][0] >= self.dwell_min:
+                # the trip ended where the dwell started
+                st[1] -= st[3]
+                self._close_trip(st, *st[2], trips, a)
+
+    def _close_stop(self, st, t, dwells, a) -> None:
+        if st[2] is not None:
+            if t - st[2][0] >= self.dwell_min:
+                dwells.append((a, t - st[2][0]))
+            st[2], st[3] = None, 0.0
+
+    def _close_trip(self, st, t, x, y, trips, a) -> None:
+        if st[0] is not None:
+            t0, x0, y0 = st[0]
+            trips.append((a, st[1], t - t0, x0, y0, x, y))
+            st[0], st[1] = None, 0.0
+
+    def _emit(self, trips, dwells, mode_of) -> None:
+        if len(dwells) > 0:
+            a, dur = zip(*dwells)
+            self._add("dwell_time", [mode_of.get(i, "unknown") for i in a], dur)
+        if len(trips) == 0:
+            return
+        df = pd.DataFrame(trips, columns=["id", "length", "duration", "x0", "y0", "x1", "y1"])  # noqa
+        mode = np.array([mode_of.get(i, "unknown") for i in df["id"]])
+        self._add("trip_length", mode, df["length"].values)
+        self._add("trip_duration", mode, df["duration"].values)
+        for m, n in zip(*np.unique(mode, return_counts=True)):
+            self.modes[m] = self.modes.get(m, 0) + int(n)
+        o = self.zone_fn(df["y0"].values, df["x0"].values)
+        d = self.zone_fn(df["y1"].values, df["x1"].values)
+        for key, n in pd.Series(pd.Series(o).astype(str) + "|" + pd.Series(d).astype(str)).value_counts().items():  # noqa
+            self.od[key] = self.od.get(key, 0) + int(n)
+
+    def finalize(self) -> 'TrajStats':
+        """
+        close open trips and stops at the last point of every agent
+        """
+        trips, dwells = [], []
+        if self._last is not None:
+            for a, t, x, y in zip(*[self._last[c].values for c in ["id", "time", "x", "y"]]):  # noqa
+                st = self._state.get(a)
+                if st is None:
+                    continue
+                if st[2] is not None and st[0] is not None:
+                    st[1] -= st[3]
+                    self._close_trip(st, *st[2], trips, a)
+                self._close_stop(st, t, dwells, a)
+                self._close_trip(st, t, x, y, trips, a)
+            mode_of = dict(zip(self._last["id"], self.mode_fn(self._last["id"].values)))  # noqa
+            self._emit(trips, dwells, mode_of)
+        self._last = None
+        self._state = {}
+        return self
+
+    def merge(
+        self,
+        other: 'TrajStats'
+    ) -> 'TrajStats':
+        """
+        merge the aggregates of a finalized partition
+        """
+        for key, dist in other.dists.items():
+            if key in self.dists:
+                self.dists[key].merge(dist)
+            else:
+                self.dists[key] = dist
+        for m, n in other.modes.items():
+            self.modes[m] = self.modes.get(m, 0) + n
+        for k, n in other.od.items():
+            self.od[k] = self.od.get(k, 0) + n
+        return self
+
+    def summary(self) -> Dict:
+        total = sum(self.modes.values())
+        return {
+            "distributions": {k: d.summary() for k, d in sorted(self.dists.items())},  # noqa
+            "mode_share": {m: n / total for m, n in sorted(self.modes.items())},
+            "trips": total,
+            "od_pairs": len(self.od),
+        }
+
+    def to_dict(self) -> Dict:
+        return {
+            "dists": {k: d.to_dict() for k, d in self.dists.items()},
+            "modes": self.modes,
+            "od": self.od,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict, **kwargs) -> 'TrajStats':
+        stats = cls(**kwargs)
+        stats.dists = {k: Distribution.from_dict(v) for k, v in d["dists"].items()}  # noqa
+        stats.modes = dict(d["modes"])
+        stats.od = dict(d["od"])
+        return stats
+
+
+def stats_from_chunks(
+    chunks: Iterable[pd.DataFrame],
+    **kwargs
+) -> TrajStats:
+    stats = TrajStats(**kwargs)
+    for chunk in chunks:
+        stats.update(chunk)
+    return stats.finalize()
+
+
+def stats_from_fcd(
+    fcd_file: str,
+    chunk_size: int = CHUNK_SIZE,
+    **kwargs
+) -> TrajStats:
+    return stats_from_chunks(iter_fcd_chunks(fcd_file, chunk_size), **kwargs)
+
+
+def stats_from_csv(
+    csv_file: str,
+    chunk_size: int = CHUNK_SIZE,
+    **kwargs
+) -> TrajStats:
+    """
+    points as csv with time, id, x and y columns sorted by time
+    """
+    chunks = pd.read_csv(csv_file, usecols=["time", "id", "x", "y"], chunksize=chunk_size)  # noqa
+    return stats_from_chunks(chunks, **kwargs)
+
+
+def _geolife_user(
+    user_dir: str,
+    zone_cell: float
+) -> Dict:
+    """
+    worker: statistics of one GeoLife user, as dict
+    """
+    traj_dir = Path(user_dir).joinpath("Trajectory")
+    stats = TrajStats(
+        mode_fn=lambda ids: np.full(len(ids), "unknown"),
+        zone_fn=partial(grid_location, cell=zone_cell)
+    )
+    files = sorted(traj_dir.glob("*.plt"))
+    if len(files) > 0:
+        df = pd.concat([read_plt(f) for f in files], ignore_index=True)
+        stats.update(pd.DataFrame({
+            "time": df["t"].values, "id": Path(user_dir).name,
+            "x": df["lng"].values, "y": df["lat"].values
+        }))
+    return stats.finalize().to_dict()
+
+
+def stats_from_geolife(
+    data_dir: str,
+    users: List[str] = None,
+    workers: int = None,
+    zone_cell: float = ZONE_CELL
+) -> TrajStats:
+    """
+    statistics of GeoLife users (one partition per user) in a process pool
+    """
+    data_dir = Path(data_dir)
+    if not data_dir.is_dir():
+        raise FileNotFoundError("GeoLife data directory not found!")
+    if users is None:
+        users = sorted(p.name for p in data_dir.iterdir() if p.joinpath("Trajectory").is_dir())  # noqa
+    stats = TrajStats(zone_fn=partial(grid_location, cell=zone_cell))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for d in pool.map(
+            _geolife_user, [str(data_dir.joinpath(u)) for u in users],
+            [zone_cell] * len(users)
+        ):
+            stats.merge(TrajStats.from_dict(d))
+    return stats
+
+
+def _hist_distance(a: Distribution, b: Distribution) -> Dict:
+    pa = a.counts / max(a.n, 1)
+    pb = b.counts / max(b.n, 1)
+    m = (pa + pb) / 2.0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        js = 0.5 * np.nansum(np.where(pa > 0, pa * np.log2(pa / m), 0.0)) \
+            + 0.5 * np.nansum(np.where(pb > 0, pb * np.log2(pb / m), 0.0))
+    return {
+        "ks": float(np.abs(np.cumsum(pa) - np.cumsum(pb)).max()),
+        "js": float(js),
+    }
+
+
+def compare(
+    synthetic: TrajStats,
+    reference: TrajStats,
+    top: int = 10
+) -> Dict:
+    """
+    comparison report of two statistics: per distribution the summaries and
+    histogram distances (KS, Jensen-Shannon), mode shares and OD similarity
+    """
+    report = {"distributions": {}}
+    for key in sorted(set(synthetic.dists) | set(reference.dists)):
+        a, b = synthetic.dists.get(key), reference.dists.get(key)
+        entry = {
+            "synthetic": None if a is None else a.summary(),
+            "reference": None if b is None else b.summary(),
+        }
+        if a is not None and b is not None and a.n > 0 and b.n > 0:
+            entry.update(_hist_distance(a, b))
+        report["distributions"][key] = entry
+
+    ms_a, ms_b = synthetic.summary()["mode_share"], reference.summary()["mode_share"]  # noqa
+    report["mode_share"] = {
+        m: {"synthetic": ms_a.get(m, 0.0), "reference": ms_b.get(m, 0.0)}
+        for m in sorted(set(ms_a) | set(ms_b))
+    }
+
+    od = pd.DataFrame({
+        "synthetic": pd.Series(synthetic.od, dtype=np.float64),
+        "reference": pd.Series(reference.od, dtype=np.float64),
+    }).fillna(0.0)
+    if od.shape[0] > 0:
+        pa = od["synthetic"] / max(od["synthetic"].sum(), 1.0)
+        pb = od["reference"] / max(od["reference"].sum(), 1.0)
+        norm = np.sqrt((pa ** 2).sum() * (pb ** 2).sum())
+        report["od"] = {
+            "pairs": {"synthetic": int((od["synthetic"] > 0).sum()), "reference": int((od["reference"] > 0).sum())},  # noqa
+            "total_variation": float(0.5 * np.abs(pa - pb).sum()),
+            "cosine": float((pa * pb).sum() / norm) if norm > 0 else None,
+            "top_synthetic": od["synthetic"].nlargest(top).astype(int).to_dict(),
+            "top_reference": od["reference"].nlargest(top).astype(int).to_dict(),
+        }
+    return report
+
+
+def main(args=None) -> int:
+    options, args = optParser.parse_args(args=args)
+    if options.fcd is None and options.csv is None:
+        optParser.error("either --fcd or --csv is required")
+    zone_fn = partial(grid_location, cell=options.zone_cell)
+    if options.fcd is not None:
+        synthetic = stats_from_fcd(options.fcd, zone_fn=zone_fn)
+    else:
+        synthetic = stats_from_csv(options.csv, zone_fn=zone_fn)
+    if options.save_stats:
+        with open(options.save_stats, "w") as fd:
+            json.dump(synthetic.to_dict(), fd)
+
+    if options.reference is None:
+        report = synthetic.summary()
+    else:
+        ref = Path(options.reference)
+        if ref.is_dir():
+            reference = stats_from_geolife(ref, workers=options.workers, zone_cell=options.zone_cell)  # noqa
+        else:
+            with open(ref) as fd:
+                reference = TrajStats.from_dict(json.load(fd))
+        report = compare(synthetic, reference)
+    with open(options.output, "w") as fd:
+        json.dump(report, fd, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,367 @@
+# !/usr/bin/env python
+# ConTraG, Contextual Trajectory Generator; see https://
+# Copyright (C) 2020-2020 University of Notre Dame and others.
+# This program and the accompanying materials are made available under the
+# terms of the Eclipse Public License 2.0 which is available at
+# https://www.eclipse.org/legal/epl-2.0/
+# This Source Code may also be made available under the following Secondary
+# Licenses when the conditions for such availability set forth in the Eclipse
+# Public License 2.0 are satisfied: GNU General Public License, version 2
+# or later which is available at
+# https://www.gnu.org/licenses/old-licenses/gpl-2.0-standalone.html
+# SPDX-License-Identifier: EPL-2.0 OR GPL-2.0-or-later
+
+# @file     traj_store.py
+# @author   Jian Yang
+# @date     2020-09-28
+
+"""
+memory-mapped trajectory store built from simulation output (see fcd.py).
+Points are stored column-wise (one raw binary file per column) and sorted by
+(time bucket, spatial cell), so that every (bucket, cell) pair is a contiguous
+block of rows. Two small indexes are kept in memory:
+- the block index: sorted block keys and their first rows;
+- the agent index: the time buckets each agent has points in (CSR).
+Queries only read the blocks they need and return dicts of numpy arrays:
+- within(lat, lng, radius, t0, t1): points near a location in a time range;
+- trajectory(agent, t0, t1): points of one agent sorted by time;
+- user_trajectory(uid, day): points of all agents of a user on a day.
+The store is built in one pass, fcd chunks are sorted by time, so only the
+last (possibly incomplete) time bucket of a chunk is carried over.
+
+Usage:
+    python traj_store.py -f output/notre_dame.fcd.xml -d output/notre_dame.store
+"""
+
+import os
+import sys
+import json
+import optparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Dict, Iterable, List
+from fcd import (
+    CHUNK_SIZE,
+    iter_fcd_chunks
+)
+
+
+EARTH_R = 6371000.0
+TIME_BUCKET = 300.0  # in seconds
+CELL_SIZE = 200.0  # in meters
+DAY = 86400
+COLUMNS = {
+    "time": np.float64,
+    "x": np.float64,
+    "y": np.float64,
+    "speed": np.float32,
+    "agent": np.int32,
+    "kind": np.int8,  # 0 person, 1 vehicle
+}
+KINDS = ["person", "vehicle"]
+_CELL_BITS = 21
+_CELL_OFF = 1 << (_CELL_BITS - 1)
+
+optParser = optparse.OptionParser()
+optParser.add_option("-f", "--fcd", help="fcd xml file (fcd-output.geo)")
+optParser.add_option("-d", "--store-dir", help="directory of the store")
+optParser.add_option("--bucket", type="float", default=TIME_BUCKET, help="time bucket in seconds")  # noqa
+optParser.add_option("--cell", type="float", default=CELL_SIZE, help="spatial cell in meters")  # noqa
+optParser.add_option("--chunk-size", type="int", default=CHUNK_SIZE, help="points per fcd chunk")  # noqa
+
+
+class _Projection():
+    """
+    local equirectangular projection of lng/lat into meters
+    """
+    def __init__(self, lat0: float, lng0: float):
+        self.lat0, self.lng0 = lat0, lng0
+        self._cos = np.cos(np.radians(lat0))
+
+    def __call__(self, lng, lat):
+        x = np.radians(np.asarray(lng) - self.lng0) * self._cos * EARTH_R
+        y = np.radians(np.asarray(lat) - self.lat0) * EARTH_R
+        return x, y
+
+
+def _block_key(
+    bucket: np.array,
+    cx: np.array,
+    cy: np.array
+) -> np.array:
+    return (bucket.astype(np.int64) << (2 * _CELL_BITS)) \
+        | ((cx.astype(np.int64) + _CELL_OFF) << _CELL_BITS) \
+        | (cy.astype(np.int64) + _CELL_OFF)
+
+
+def build_store(
+    chunks: Iterable[pd.DataFrame],
+    store_dir: str,
+    bucket: float = TIME_BUCKET,
+    cell: float = CELL_SIZE
+) -> 'TrajStore':
+    """
+    build a store from chunks of fcd points (time, id, kind, x, y, speed)
+    sorted by time, x/y are lng/lat
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    files = {c: open(store_dir.joinpath(c + ".bin"), "wb") for c in COLUMNS}
+    agents = {}
+    block_keys, block_starts, pairs = [], [], []
+    proj = None
+    n_rows = 0
+    last_bucket = -1
+    carry = None
+
+    def flush(df: pd.DataFrame) -> None:
+        nonlocal n_rows
+        order = np.argsort(df["key"].values, kind="mergesort")
+        df = df.iloc[order]
+        for c, dtype in COLUMNS.items():
+            files[c].write(df[c].values.astype(dtype).tobytes())
+        keys = df["key"].values
+        first = np.r_[True, keys[1:] != keys[:-1]]
+        block_keys.append(keys[first])
+        block_starts.append(np.flatnonzero(first) + n_rows)
+        pairs.append(np.unique(
+            (df["agent"].values.astype(np.int64) << 32) | df["bucket"].values
+        ))
+        n_rows += df.shape[0]
+
+    for chunk in chunks:
+        if chunk.shape[0] == 0:
+            continue
+        if proj is None:
+            proj = _Projection(float(chunk["y"].mean()), float(chunk["x"].mean()))  # noqa
+        codes, uniq = pd.factorize(chunk["id"].values)
+        remap = np.array([agents.setdefault(a, len(agents)) for a in uniq], dtype=np.int32)  # noqa
+        mx, my = proj(chunk["x"].values, chunk["y"].values)
+        b = np.floor(chunk["time"].values / bucket).astype(np.int64)
+        df = pd.DataFrame({
+            "time": chunk["time"].values,
+            "x": chunk["x"].values,
+            "y": chunk["y"].values,
+            "speed": chunk["speed"].values if "speed" in chunk else 0.0,
+            "agent": remap[codes],
+            "kind": (chunk["kind"].values == "vehicle").astype(np.int8),
+            "bucket": b,
+            "key": _block_key(b, np.floor(mx / cell), np.floor(my / cell)),
+        })
+        if carry is not None:
+            df = pd.concat([carry, df], ignore_index=True)
+        if df["bucket"].min() <= last_bucket:
+            raise ValueError("points have to be sorted by time!")
+        # the last bucket may continue in the next chunk
+        top = df["bucket"].max()
+        done = df["bucket"].values < top
+        if done.any():
+            flush(df[done])
+            last_bucket = top - 1
+        carry = df[~done]
+    if carry is not None and carry.shape[0] > 0:
+        flush(carry)
+    for fd in files.values():
+        fd.close()
+
+    pairs = np.unique(np.concatenate(pairs)) if len(pairs) > 0 else np.zeros(0, dtype=np.int64)  # noqa
+    agent_of_pair = (pairs >> 32).astype(np.int64)
+    np.save(store_dir.joinpath("block_keys.npy"), np.concatenate(block_keys) if n_rows > 0 else np.zeros(0, dtype=np.int64))  # noqa
+    np.save(store_dir.joinpath("block_starts.npy"), np.concatenate(block_starts) if n_rows > 0 else np.zeros(0, dtype=np.int64))  # noqa
+    np.save(store_dir.joinpath("agent_ptr.npy"), np.r_[0, np.cumsum(np.bincount(agent_of_pair, minlength=len(agents)))])  # noqa
+    np.save(store_dir.joinpath("agent_buckets.npy"), (pairs & 0xffffffff).astype(np.int32))  # noqa
+    meta = {
+        "rows": n_rows,
+        "bucket": bucket,
+        "cell": cell,
+        "lat0": None if proj is None else proj.lat0,
+        "lng0": None if proj is None else proj.lng0,
+        "columns": {c: np.dtype(d).str for c, d in COLUMNS.items()},
+        "agents": sorted(agents, key=agents.get),
+    }
+    with open(store_dir.joinpath("meta.json"), "w") as fd:
+        json.dump(meta, fd)
+    return TrajStore(store_dir)
+
+
+def build_store_from_fcd(
+    fcd_file: str,
+    store_dir: str,
+    bucket: float = TIME_BUCKET,
+    cell: float = CELL_SIZE,
+    chunk_size: int = CHUNK_SIZE
+) -> 'TrajStore':
+    return build_store(iter_fcd_chunks(fcd_file, chunk_size), store_dir, bucket, cell)  # noqa
+
+
+class TrajStore():
+    def __init__(
+        self,
+        store_dir: str
+    ):
+        store_dir = Path(store_dir)
+        if not store_dir.joinpath("meta.json").is_file():
+            raise FileNotFoundError("trajectory store not found!")
+        with open(store_dir.joinpath("meta.json")) as fd:
+            meta = json.load(fd)
+        self.n = meta["rows"]
+        self.bucket = meta["bucket"]
+        self.cell = meta["cell"]
+        self.agents = np.array(meta["agents"], dtype=object)
+        self._agent_code = {a: i for i, a in enumerate(meta["agents"])}
+        self._proj = None if meta["lat0"] is None else _Projection(meta["lat0"], meta["lng0"])  # noqa
+        self.columns = {}
+        for c, dtype in meta["columns"].items():
+            path = store_dir.joinpath(c + ".bin")
+            if self.n == 0 or os.path.getsize(path) == 0:
+                self.columns[c] = np.zeros(0, dtype=dtype)
+            else:
+                self.columns[c] = np.memmap(path, dtype=dtype, mode="r", shape=(self.n,))  # noqa
+        self._keys = np.load(store_dir.joinpath("block_keys.npy"))
+        self._starts = np.r_[np.load(store_dir.joinpath("block_starts.npy")), self.n]  # noqa
+        self._agent_ptr = np.load(store_dir.joinpath("agent_ptr.npy"))
+        self._agent_buckets = np.load(store_dir.joinpath("agent_buckets.npy"))
+
+    def _rows(
+        self,
+        lo: np.array,
+        hi: np.array
+    ) -> np.array:
+        """
+        row indices of the block ranges [lo, hi)
+        """
+        lo, hi = np.asarray(lo), np.asarray(hi)
+        keep = hi > lo
+        lo, hi = lo[keep], hi[keep]
+        if lo.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        cnt = hi - lo
+        return np.repeat(lo - np.r_[0, np.cumsum(cnt)[:-1]], cnt) + np.arange(cnt.sum())  # noqa
+
+    def _bucket_rows(
+        self,
+        buckets: np.array
+    ) -> np.array:
+        """
+        row ranges (lo, hi) of whole time buckets
+        """
+        buckets = np.asarray(buckets, dtype=np.int64)
+        lo = np.searchsorted(self._keys, buckets << (2 * _CELL_BITS))
+        hi = np.searchsorted(self._keys, (buckets + 1) << (2 * _CELL_BITS))
+        return self._starts[lo], self._starts[hi]
+
+    def _take(
+        self,
+        rows: np.array
+    ) -> Dict:
+        out = {c: np.asarray(col[rows]) for c, col in self.columns.items()}
+        out["id"] = self.agents[out["agent"]] if rows.size > 0 else np.zeros(0, dtype=object)  # noqa
+        return out
+
+    def _time_buckets(self, t0: float, t1: float) -> np.array:
+        return np.arange(int(np.floor(t0 / self.bucket)), int(np.floor(t1 / self.bucket)) + 1)  # noqa
+
+    def within(
+        self,
+        lat: float,
+        lng: float,
+        radius: float,
+        t0: float,
+        t1: float
+    ) -> Dict:
+        """
+        all points within radius (in meters) of (lat, lng) with t0 <= time < t1
+        """
+        if self._proj is None:
+            return self._take(np.zeros(0, dtype=np.int64))
+        qx, qy = self._proj(lng, lat)
+        cx0, cx1 = int(np.floor((qx - radius) / self.cell)), int(np.floor((qx + radius) / self.cell))  # noqa
+        cy0, cy1 = int(np.floor((qy - radius) / self.cell)), int(np.floor((qy + radius) / self.cell))  # noqa
+        b, cx, cy = np.meshgrid(
+            self._time_buckets(t0, t1), np.arange(cx0, cx1 + 1), np.arange(cy0, cy1 + 1),  # noqa
+            indexing="ij"
+        )
+        keys = np.unique(_block_key(b.ravel(), cx.ravel(), cy.ravel()))
+        pos = np.searchsorted(self._keys, keys)
+        hit = (pos < self._keys.size) & (self._keys[np.minimum(pos, self._keys.size - 1)] == keys)  # noqa
+        rows = self._rows(self._starts[pos[hit]], self._starts[pos[hit] + 1])
+        t = np.asarray(self.columns["time"][rows])
+        px, py = self._proj(self.columns["x"][rows], self.columns["y"][rows])
+        keep = (t >= t0) & (t < t1) & (np.hypot(px - qx, py - qy) <= radius)
+        return self._take(rows[keep])
+
+    def trajectory(
+        self,
+        agent: str,
+        t0: float = None,
+        t1: float = None
+    ) -> Dict:
+        """
+        points of one agent with t0 <= time < t1, sorted by time
+        """
+        code = self._agent_code.get(agent)
+        if code is None:
+            return self._take(np.zeros(0, dtype=np.int64))
+        buckets = self._agent_buckets[self._agent_ptr[code]:self._agent_ptr[code + 1]]  # noqa
+        if t0 is not None:
+            buckets = buckets[buckets >= np.floor(t0 / self.bucket)]
+        if t1 is not None:
+            buckets = buckets[buckets <= np.floor(t1 / self.bucket)]
+        lo, hi = self._bucket_rows(buckets)
+        rows = self._rows(lo, hi)
+        t = np.asarray(self.columns["time"][rows])
+        keep = np.asarray(self.columns["agent"][rows]) == code
+        if t0 is not None:
+            keep &= t >= t0
+        if t1 is not None:
+            keep &= t < t1
+        rows = rows[keep]
+        rows = rows[np.argsort(t[keep], kind="mergesort")]
+        return self._take(rows)
+
+    def agents_of_user(
+        self,
+        uid: str
+    ) -> List[str]:
+        """
+        person and vehicle ids of a user, see trip_generator
+        """
+        uid = str(uid)
+        return [
+            a for a in self.agents
+            if a == "p" + uid or a.startswith("c_" + uid + "_") or a.startswith("b_" + uid + "_")  # noqa
+        ]
+
+    def user_trajectory(
+        self,
+        uid: str,
+        day: int = None
+    ) -> Dict:
+        """
+        points of all agents of a user, on day (1-based, as in the raw schedule)
+        if given, sorted by time
+        """
+        t0, t1 = (None, None) if day is None else ((day - 1) * DAY, day * DAY)
+        parts = [self.trajectory(a, t0, t1) for a in self.agents_of_user(uid)]
+        if len(parts) == 0:
+            return self._take(np.zeros(0, dtype=np.int64))
+        out = {c: np.concatenate([p[c] for p in parts]) for c in parts[0]}
+        order = np.argsort(out["time"], kind="mergesort")
+        return {c: v[order] for c, v in out.items()}
+
+
+def main(args=None) -> int:
+    options, args = optParser.parse_args(args=args)
+    if options.fcd is None or options.store_dir is None:
+        optParser.error("--fcd and --store-dir are required")
+    store = build_store_from_fcd(
+        options.fcd, options.store_dir, options.bucket, options.cell,
+        options.chunk_size
+    )
+    print("%d points of %d agents" % (store.n, len(store.agents)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,17 +20,16 @@ generate trip files from formatted itinerary for the given users.
 TODO: expand it into large scale by using flow definitions
 """
 
+from __future__ import annotations
+
 import os, sys
-import pandas as pd
+import io
+import queue
+import logging
+import threading
 import numpy as np
-if 'SUMO_HOME' in os.environ:
-    tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
-    sys.path.append(tools)
-else:
-    sys.exit("please declare environment variable 'SUMO_HOME'")
-import sumolib
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Iterable, Iterator, Tuple
 from get_taz import (
     read_loc_dict_file,
     get_stop_edges
@@ -39,10 +38,48 @@ from scheduler import (
     read_raw_schedule,
     generate_itinerary
 )
+from profiler import StageProfiler
+from lazy_import import lazy_module, lazy_sumolib
+from reachability import Reachability
+from edge_balancer import EdgeBalancer
+from checkpoint import (
+    PART,
+    ShardCheckpoint,
+    atomic_open,
+    concat_files
+)
 
+pd = lazy_module("pandas")
+sumolib = lazy_sumolib()
+
+logging.basicConfig(format='trip_generator:%(levelname)s: %(message)s')
 
 R = 100
 T = 7200
+TIME_E = 432000
+QUEUE_SIZE = 2  # chunks buffered between the streaming stages
+MODES = ['walk', 'bike', 'car']
+MODE_PREF = {
+    'j001': [0.7, 0, 0.3],
+    'a001': [0.6, 0.4, 0],
+    'e001': [0.95, 0.05, 0],
+    'e002': [0.75, 0.25, 0],
+    'e003': [1, 0, 0],
+    'e004': [0.5, 0.5, 0],
+    'e006': [0.7, 0, 0.3],
+    'e007': [0.7, 0, 0.3],
+    'j004': [0.5, 0.2, 0.3],
+    'j005': [0.6, 0.1, 0.3],
+    's002': [0.3, 0.7, 0],
+    's003': [0.4, 0.6, 0],
+    0: [0.3, 0.7, 0],
+    1: [0.4, 0.6, 0]
+}
+DEFAULT_MODE_PREF = [0.6, 0.2, 0.2]
+MANIFEST_COLUMNS = [
+    'uid', 'pid', 'vid', 'mode', 'src', 'dst', 'timeslot', 'depart',
+    'src_edge', 'dst_edge'
+]
 
 
 def read_intinerary(
@@ -147,24 +184,8 @@ def get_mode(
     #     0: {'walk': 0.9, 'car': 0.1},
     #     1: {'walk': 0.2, 'car': 0.8}
     # }
-    pref = {
-        'j001': [0.7, 0, 0.3],
-        'a001': [0.6, 0.4, 0],
-        'e001': [0.95, 0.05, 0],
-        'e002': [0.75, 0.25, 0],
-        'e003': [1, 0, 0],
-        'e004': [0.5, 0.5, 0],
-        'e006': [0.7, 0, 0.3],
-        'e007': [0.7, 0, 0.3],
-        'j004': [0.5, 0.2, 0.3],
-        'j005': [0.6, 0.1, 0.3],
-        's002': [0.3, 0.7, 0],
-        's003': [0.4, 0.6, 0],
-        0: [0.3, 0.7, 0],
-        1: [0.4, 0.6, 0]
-    }
-
-    return np.random.choice(['walk', 'bike', 'car'], 1, p=pref[uid])
+    # users without a known preference (e.g., synthetic profiles) use the default
+    return np.random.choice(MODES, 1, p=MODE_PREF.get(uid, DEFAULT_MODE_PREF))
 
 
 def get_edge_from_taz(
@@ -200,150 +221,534 @@ def get_depart_time(
     return "{:.2f}".format(t)
 
 
-def generate_trips(
+def _draw_edges(
+    stops: np.array,
+    walk: np.array,
+    stop2edges: Dict,
+    bike: np.array = None
+) -> np.array:
+    """
+    bulk version of get_edge_from_taz(): one random edge per stop, a ped edge
+    where walk is True, else a car edge (falling back to ped edges). Where bike
+    is True, a bike edge if stop2edges has them (see
+    reachability.filter_stop2edges), else a car edge.
+    None if the stop has no such edge.
+    """
+    if len(stops) == 0:
+        return np.array([], dtype=object)
+    if bike is None:
+        bike = np.zeros(len(stops), dtype=bool)
+    codes, uniq = pd.factorize(stops)
+    flat = []
+    off = [[], [], []]  # ped, car, bike pools
+    length = [[], [], []]
+    for taz in uniq:
+        if taz not in stop2edges:
+            raise KeyError("taz " + str(taz) + " not found in taz files.")
+        ped = list(stop2edges[taz]['ped_edges'])
+        car = list(stop2edges[taz]['car_edges'])
+        bik = list(stop2edges[taz].get('bike_edges', car))
+        for k, pool in enumerate((ped, car if len(car) > 0 else ped, bik if len(bik) > 0 else ped)):  # noqa
+            off[k].append(len(flat))
+            length[k].append(len(pool))
+            flat += pool
+    flat = np.array(flat + [None], dtype=object)
+    kind = np.where(walk, 0, np.where(bike, 2, 1))
+    off = np.choose(kind, [np.take(o, codes) for o in off])
+    length = np.choose(kind, [np.take(n, codes) for n in length])
+    pick = off + np.floor(np.random.uniform(size=len(codes)) * length).astype(np.int64)  # noqa
+    # empty pools point to the trailing None
+    pick[length == 0] = len(flat) - 1
+    return flat[pick]
+
+
+def _balance_edges(
+    balancer: EdgeBalancer,
+    stops: np.array,
+    times: np.array,
+    bike: np.array
+) -> np.array:
+    """
+    balanced departure edges (see EdgeBalancer.draw), from the bike edges of
+    the stop where bike is True
+    """
+    edges = np.full(len(stops), None, dtype=object)
+    edges[~bike] = balancer.draw(stops[~bike], times[~bike])
+    edges[bike] = balancer.draw(stops[bike], times[bike], kind='bike_edges')
+    return edges
+
+
+def compute_transitions(
     itin_df: pd.DataFrame,
-    stop_distr: Dict,
+    win_t: int = T
+) -> pd.DataFrame:
+    """
+    all stop changes of all users as (uid, timeslot, src, dst), where the user
+    leaves src for dst within [timeslot, timeslot + win_t).
+    itin_df has to be sorted by uid and timeslot.
+    """
+    uid = itin_df['uid'].values
+    ts = itin_df['timeslot'].values
+    stop = itin_df['stop'].values
+    change = (uid[1:] == uid[:-1]) \
+        & (ts[1:] == ts[:-1] + win_t) \
+        & (ts[:-1] + win_t < TIME_E) \
+        & (stop[1:] != stop[:-1])
+    idx = np.flatnonzero(change)
+    return pd.DataFrame({
+        'uid': uid[idx],
+        'timeslot': ts[idx],
+        'src': stop[idx],
+        'dst': stop[idx + 1],
+    })
+
+
+def draw_trips(
+    trans: pd.DataFrame,
     net: sumolib.net,
     stop2edges: Dict,
-    save_dir: str,
-    prefix: str = 'sample'
-) -> None:
-    # open xml file, write header
-    pt_path = save_dir.joinpath(prefix + "_persons.trips.xml")
-    ct_path = save_dir.joinpath(prefix + "_cars.trips.xml")
-    bt_path = save_dir.joinpath(prefix + "_bikes.trips.xml")
-    pt_f = open(pt_path, "w")
-    ct_f = open(ct_path, "w")
-    bt_f = open(bt_path, "w")
-    sumolib.xml.writeHeader(pt_f, script=None, root="routes", schemaPath="routes_file.xsd")  # noqa
-    sumolib.xml.writeHeader(ct_f, script=None, root="routes", schemaPath="routes_file.xsd")  # noqa
-    sumolib.xml.writeHeader(bt_f, script=None, root="routes", schemaPath="routes_file.xsd")  # noqa
-
-    for uid, itin in itin_df.groupby('uid'):
-        itin = itin.drop(['uid', 'duration'], axis=1).set_index('timeslot')
-        # fillna
-        itin = fill_null_stop(df=itin, stop_distr=stop_distr[uid], eta=2)
-        # iterate over one user
-        pid = 'p' + str(uid)
-        type_p = get_type(uid, None)
-        type_c = 'tc0'
-        type_b = 'tb0'
-        trip_0 = True
-        edge_stack = []
-        for idx, row in itin.iterrows():
-            if idx + T < 432000 and row['stop'] != itin.loc[idx+T]['stop']:
-                src, dst = row['stop'], itin.loc[idx+T]['stop']
-                if trip_0:
-                    trip_0 = False
-                    depart = get_depart_time(start=idx, delta=T)
-                    pt_f.write(
-                        '    <person id="%s" depart="%s" type="%s">\n'
-                        % (pid, depart, type_p)
-                    )
-                else:
-                    depart = get_depart_time(start=idx, delta=T)
-                    pt_f.write(
-                        ' '*8 + '<stop until="%s"/>\n'
-                        % depart
-                    )
-                # TODO: handle the case where multi-mode is needed, e.g., home to office include drive and walk
-                mode = get_mode(uid=uid, src=src, dst=dst)
-                if len(edge_stack) > 0:
-                    src_edge = edge_stack.pop()
-                else:
-                    src_edge = get_edge_from_taz(src, mode, stop2edges)
-                dst_edge = get_edge_from_taz(dst, mode, stop2edges)
-                edge_stack.append(dst_edge)
-                if mode == 'walk':
-                    pt_f.write(
-                        ' '*8 + '<walk from="%s" to="%s"/>\n'
-                        % (src_edge, dst_edge)
-                    )
-                elif mode == 'car':
-                    car_id = "c_" + str(uid) + '_' + str(idx)
-                    if src_edge is None:
-                        # TODO: add policy for this!
-                        raise ValueError("Not a valid source edge")
-                    if not net.getEdge(src_edge).allows('passenger'):  # caused by previous dst
-                        via_edge = get_edge_from_taz(src, 'car', stop2edges)
-                        pt_f.write(
-                            ' '*8 + '<walk from="%s" to="%s"/>\n'
-                            % (src_edge, via_edge)
-                        )
-                        pt_f.write(
-                            ' '*8 + '<ride from="%s" to="%s" lines="%s"/>\n'
-                            % (via_edge, dst_edge, car_id)
-                        )
-                        ct_f.write(
-                            '    <trip id="%s" type="%s" depart="triggered" from="%s" to="%s"/>\n'  # noqa
-                            % (car_id, type_c, via_edge, dst_edge)
-                        )
-                    else:
-                        pt_f.write(
-                            ' '*8 + '<ride from="%s" to="%s" lines="%s"/>\n'
-                            % (src_edge, dst_edge, car_id)
-                        )
-                        ct_f.write(
-                            '    <trip id="%s" type="%s" depart="triggered" from="%s" to="%s"/>\n'  # noqa
-                            % (car_id, type_c, src_edge, dst_edge)
-                        )
-                elif mode == 'bike':
-                    bike_id = "b_" + str(uid) + '_' + str(idx)
-                    if src_edge is None:
-                        # TODO: add policy for this!
-                        raise ValueError("Not a valid source edge")
-                    if not net.getEdge(src_edge).allows('passenger'):  # caused by previous dst
-                        via_edge = get_edge_from_taz(src, 'bike', stop2edges)
-                        pt_f.write(
-                            ' '*8 + '<walk from="%s" to="%s"/>\n'
-                            % (src_edge, via_edge)
-                        )
-                        pt_f.write(
-                            ' '*8 + '<ride from="%s" to="%s" lines="%s"/>\n'
-                            % (via_edge, dst_edge, bike_id)
-                        )
-                        ct_f.write(
-                            '    <trip id="%s" type="%s" depart="triggered" from="%s" to="%s"/>\n'  # noqa
-                            % (bike_id, type_c, via_edge, dst_edge)
-                        )
-                    else:
-                        pt_f.write(
-                            ' '*8 + '<ride from="%s" to="%s" lines="%s"/>\n'
-                            % (src_edge, dst_edge, bike_id)
-                        )
-                        bt_f.write(
-                            '    <trip id="%s" type="%s" depart="triggered" from="%s" to="%s"/>\n'  # noqa
-                            % (bike_id, type_b, src_edge, dst_edge)
-                        )
-                else:
-                    raise ValueError("Not a valid transport mode: " + mode)
-                # assign to specific type id (comes from a dict of {uid: type})
-                # set depart range(idx, next idx)
-                # write person xml
-                # if not walk, write car/bike xml
-
+    win_t: int = T,
+    reach: Reachability = None,
+    balancer: EdgeBalancer = None
+) -> pd.DataFrame:
+    """
+    draw depart time, mode and edges of all transitions in bulk, same rules as
+    get_depart_time(), get_mode() and get_edge_from_taz(): every trip of a user
+    starts at the edge the previous one ended, a car/bike trip starting at an
+    edge its vehicle may not use walks to a via edge of the source stop first.
+    adds columns depart, mode, vid, src_edge, dst_edge, via_edge.
+    with reach, a car/bike trip also walks to a via edge if its source edge is
+    outside the giant passenger/bicycle component (see reachability.py).
+    users with a trip lacking a source, destination or via edge are dropped.
+    with balancer, the edges cars and bikes depart from (the source of a first
+    trip, the destination of a ride followed by a ride of the same vehicle
+    class, via edges) are spread over the car edges of the stop by lane
+    capacity (see edge_balancer.py), the departures of dropped users are
+    released again.
+    """
+    n = trans.shape[0]
+    uid = trans['uid'].values
+    first = np.ones(n, dtype=bool)
+    first[1:] = uid[1:] != uid[:-1]
+
+    depart = trans['timeslot'].values.astype(np.float64) + np.random.uniform(0, win_t, n)  # noqa
+
+    codes, uniq = pd.factorize(uid)
+    cum = np.cumsum([MODE_PREF.get(u, DEFAULT_MODE_PREF) for u in uniq], axis=1)
+    cum = cum.reshape(len(uniq), len(MODES))
+    u = np.random.uniform(size=n)
+    mode = (u[:, None] >= cum[codes]).sum(axis=1)
+    mode = np.array(MODES, dtype=object)[np.minimum(mode, len(MODES) - 1)]
+    walk = mode == 'walk'
+
+    ride = ~walk
+    bike = mode == 'bike'
+    dst_edge = _draw_edges(trans['dst'].values, walk, stop2edges, bike)
+    balanced = []  # (trips, edges, times) of the departures counted by balancer
+    dst_dep = np.zeros(n, dtype=bool)
+    if balancer is not None:
+        # the next ride of the user departs where this one arrives, if it uses
+        # the same vehicle class (else it may walk to a via edge, see below)
+        dst_dep[:-1] = ride[:-1] & ride[1:] & ~first[1:] & (bike[:-1] == bike[1:])  # noqa
+        dst_edge[dst_dep] = _balance_edges(balancer, trans['dst'].values[dst_dep], depart[1:][dst_dep[:-1]], bike[dst_dep])  # noqa
+    src_edge = np.empty(n, dtype=object)
+    src_edge[1:] = dst_edge[:-1]
+    src_edge[first] = _draw_edges(trans['src'].values[first], walk[first], stop2edges, bike[first])  # noqa
+    if balancer is not None:
+        dep = first & ride
+        src_edge[dep] = _balance_edges(balancer, trans['src'].values[dep], depart[dep], bike[dep])  # noqa
+        balanced.append((dep, src_edge[dep], depart[dep]))
+
+    # each ride is checked for the vClass of its vehicle
+    allowed = {}
+    for vclass, rides in (('passenger', ride & ~bike), ('bicycle', bike)):
+        if reach is None:
+            allowed[vclass] = {
+                e: net.getEdge(e).allows(vclass)
+                for e in set(src_edge[rides]) if e is not None
+            }
+        else:
+            allowed[vclass] = {
+                e: reach.in_giant(e, vclass)
+                for e in set(src_edge[rides]) if e is not None
+            }
+    need_via = ride & ~np.array([
+        allowed['bicycle' if b else 'passenger'].get(e, True) if r else True
+        for e, r, b in zip(src_edge, ride, bike)
+    ], dtype=bool)
+    via_edge = np.full(n, None, dtype=object)
+    if balancer is not None:
+        via_edge[need_via] = _balance_edges(balancer, trans['src'].values[need_via], depart[need_via], bike[need_via])  # noqa
+        balanced.append((need_via, via_edge[need_via], depart[need_via]))
+        # the next ride departs from its via edge instead
+        moved = dst_dep & np.r_[need_via[1:], False]
+        balancer.release(dst_edge[moved], depart[1:][moved[:-1]])
+        dst_dep &= ~moved
+        balanced.append((dst_dep, dst_edge[dst_dep], depart[1:][dst_dep[:-1]]))
+    else:
+        via_edge[need_via] = _draw_edges(
+            trans['src'].values[need_via], np.zeros(need_via.sum(), dtype=bool), stop2edges, bike[need_via]  # noqa
+        )
+
+    bad = pd.isna(src_edge) | pd.isna(dst_edge) | (need_via & pd.isna(via_edge))  # noqa
+    if bad.any():
+        # trips of a user are chained, drop all trips of the affected users
+        drop = np.isin(uid, np.unique(uid[bad]))
+        # the dropped departures no longer take their edges
+        for rows, edges, times in balanced:
+            balancer.release(edges[drop[rows]], times[drop[rows]])
+        logging.warning(
+            "dropped %d trips of %d users without a valid edge"
+            % (drop.sum(), len(np.unique(uid[bad])))
+        )
+        trans = trans[~drop]
+        uid, mode, walk, depart = uid[~drop], mode[~drop], walk[~drop], depart[~drop]  # noqa
+        src_edge, dst_edge, via_edge = src_edge[~drop], dst_edge[~drop], via_edge[~drop]  # noqa
+
+    vid = pd.Series(np.where(mode == 'car', 'c_', 'b_')) \
+        + pd.Series(uid).astype(str) + '_' \
+        + pd.Series(trans['timeslot'].values).astype(str)
+    vid = np.where(walk, None, vid.values)
+
+    trips = trans.copy()
+    trips['depart'] = depart
+    trips['mode'] = mode
+    trips['vid'] = vid
+    trips['src_edge'] = src_edge
+    trips['dst_edge'] = dst_edge
+    trips['via_edge'] = via_edge
+    return trips
+
+
+def write_trips(
+    trips: pd.DataFrame,
+    pt_f,
+    ct_f,
+    bt_f
+) -> int:
+    """
+    serialize drawn trips (see draw_trips) into opened person, car and bike
+    trip files, return the number of trips written
+    """
+    type_c = 'tc0'
+    type_b = 'tb0'
+    n = trips.shape[0]
+    uid = trips['uid'].values
+    first = np.ones(n, dtype=bool)
+    first[1:] = uid[1:] != uid[:-1]
+    rows = zip(
+        first, uid, trips['depart'].values, trips['mode'].values,
+        trips['vid'].values, trips['src_edge'].values,
+        trips['dst_edge'].values, trips['via_edge'].values
+    )
+    for k, (is_first, u, depart, mode, vid, src_edge, dst_edge, via_edge) in enumerate(rows):  # noqa
+        if is_first:
+            if k > 0:
+                pt_f.write('    </person>\n')
+            pt_f.write(
+                '    <person id="%s" depart="%.2f" type="%s">\n'
+                % ('p' + str(u), depart, get_type(u, None))
+            )
+        else:
+            pt_f.write(' '*8 + '<stop until="%.2f"/>\n' % depart)
+        if mode == 'walk':
+            pt_f.write(
+                ' '*8 + '<walk from="%s" to="%s"/>\n'
+                % (src_edge, dst_edge)
+            )
+            continue
+        v_f, v_type = (ct_f, type_c) if mode == 'car' else (bt_f, type_b)
+        if via_edge is not None:  # caused by previous dst
+            pt_f.write(
+                ' '*8 + '<walk from="%s" to="%s"/>\n'
+                % (src_edge, via_edge)
+            )
+            src_edge = via_edge
+        pt_f.write(
+            ' '*8 + '<ride from="%s" to="%s" lines="%s"/>\n'
+            % (src_edge, dst_edge, vid)
+        )
+        v_f.write(
+            '    <trip id="%s" type="%s" depart="triggered" from="%s" to="%s"/>\n'  # noqa
+            % (vid, v_type, src_edge, dst_edge)
+        )
+    if n > 0:
         pt_f.write('    </person>\n')
+    return n
 
-        print(0)
 
-    # policy of whether to add a trip
+def write_manifest(
+    trips: pd.DataFrame,
+    save_path: str,
+    append: bool = False
+) -> None:
+    """
+    write drawn trips (see draw_trips) as csv of MANIFEST_COLUMNS, one row per
+    trip with the ids used in the trip files, see annotate.py
+    """
+    df = trips.assign(
+        pid='p' + trips['uid'].astype(str),
+        depart=trips['depart'].round(2)
+    )
+    df.to_csv(
+        save_path, columns=MANIFEST_COLUMNS, mode='a' if append else 'w',
+        header=not append, index=False
+    )
+
 
-    # policy of deciding mode of transport
+def _fill_itinerary(
+    itin_df: pd.DataFrame,
+    stop_distr: Dict,
+    profiler: StageProfiler
+) -> pd.DataFrame:
+    """
+    fillna of every user, return the itinerary sorted by uid and timeslot
+    """
+    itin_df = itin_df.sort_values(['uid', 'timeslot'], kind='mergesort')
+    stops = []
+    for uid, itin in itin_df.groupby('uid', sort=True):
+        with profiler.sample("generate_trips", uid):
+            itin = itin.drop(['uid', 'duration'], axis=1).set_index('timeslot')
+            itin = fill_null_stop(df=itin, stop_distr=stop_distr[uid], eta=2)
+            stops.append(itin['stop'].values)
+    if len(stops) > 0:
+        itin_df = itin_df.assign(stop=np.concatenate(stops))
+    return itin_df
 
-    # choose depart based on randomness method, call a func here
 
-    # choose from and to using stop2edges
+def _open_trip_files(
+    save_dir: str,
+    prefix: str
+) -> Tuple:
+    """
+    open the person, car and bike trip files as .part files, they replace the
+    trip files in _close_trip_files() only if all trips were written
+    """
+    files = []
+    for kind in ("persons", "cars", "bikes"):
+        path = save_dir.joinpath(prefix + "_" + kind + ".trips.xml")
+        fd = open(str(path) + PART, "w")
+        sumolib.xml.writeHeader(fd, script=None, root="routes", schemaPath="routes_file.xsd")  # noqa
+        files.append(fd)
+    return tuple(files)
+
+
+def _close_trip_files(
+    files: Tuple,
+    commit: bool = True
+) -> None:
+    for fd in files:
+        if commit:
+            fd.write("</routes>\n")
+        fd.close()
+        if commit:
+            os.replace(fd.name, fd.name[:-len(PART)])
+        else:
+            os.remove(fd.name)
+
+
+def prefetch(
+    iterable: Iterable,
+    maxsize: int = QUEUE_SIZE
+) -> Iterator:
+    """
+    run iterable in a background thread, at most maxsize items are buffered in
+    between. exceptions of the producer are raised in the consumer.
+    """
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+        finally:
+            # stop nested pipelines from this thread, not from the gc
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    th = threading.Thread(target=produce, daemon=True)
+    th.start()
+    try:
+        while True:
+            item, err = q.get()
+            if item is done:
+                if err is not None:
+                    raise err
+                break
+            yield item
+    finally:
+        # the consumer may stop early, release the producer
+        stop.set()
+        if th is not threading.current_thread():
+            th.join()
 
-    # write xml files
 
-    # close files
-    pt_f.write("</routes>\n")
-    pt_f.close()
-    ct_f.write("</routes>\n")
-    ct_f.close()
-    bt_f.write("</routes>\n")
-    bt_f.close()
-    pass
+def generate_trips(
+    itin_df: pd.DataFrame,
+    stop_distr: Dict,
+    net: sumolib.net,
+    stop2edges: Dict,
+    save_dir: str,
+    prefix: str = 'sample',
+    profiler: StageProfiler = None,
+    reach: Reachability = None,
+    balancer: EdgeBalancer = None
+) -> int:
+    """
+    write person, car and bike trip files and the trip manifest (see
+    write_manifest), return the number of trips written.
+    null stops are filled per user, then the transitions of all users are
+    computed and drawn in bulk (compute_transitions, draw_trips).
+    if a profiler is given, per-user fill timings are sampled under "generate_trips"
+    """
+    if profiler is None:
+        profiler = StageProfiler(enabled=False)
+    itin_df = _fill_itinerary(itin_df, stop_distr, profiler)
+    # TODO: handle the case where multi-mode is needed, e.g., home to office include drive and walk
+    trips = draw_trips(compute_transitions(itin_df), net, stop2edges, reach=reach, balancer=balancer)  # noqa
+
+    files = _open_trip_files(save_dir, prefix)
+    try:
+        n_trips = write_trips(trips, *files)
+    except BaseException:
+        _close_trip_files(files, commit=False)
+        raise
+    _close_trip_files(files)
+    with atomic_open(save_dir.joinpath(prefix + "_trips.csv")) as fd:
+        write_manifest(trips, fd)
+    return n_trips
+
+
+def generate_trips_stream(
+    itin_chunks: Iterable[Tuple[pd.DataFrame, Dict]],
+    net: sumolib.net,
+    stop2edges: Dict,
+    save_dir: str,
+    prefix: str = 'sample',
+    profiler: StageProfiler = None,
+    queue_size: int = QUEUE_SIZE,
+    reach: Reachability = None,
+    checkpoint_dir: str = None,
+    seed: int = None,
+    balancer: EdgeBalancer = None
+) -> int:
+    """
+    streaming version of generate_trips() over (itin_df, stop_distr) chunks of
+    complete users, e.g., from scheduler.iter_itinerary(). itineraries, trip
+    drawing and writing run as a pipeline with bounded queues, so that at most
+    a few chunks are held in memory. return the number of trips written.
+    checkpoint_dir: if given, every chunk is written as a shard there (see
+    checkpoint.ShardCheckpoint) and a rerun skips the completed shards; the
+    chunks have to be the same, e.g., the same chunk_users.
+    seed: if given, the random numbers of chunk k are seeded by (seed, k), so
+    that a resumed run draws the same trips
+    balancer: see draw_trips(), its departure counts are saved with every
+    shard and restored on resume
+    """
+    if profiler is None:
+        profiler = StageProfiler(enabled=False)
+    ckpt = None if checkpoint_dir is None else ShardCheckpoint(checkpoint_dir)
+
+    def draw(chunks):
+        usage_file = None
+        for k, (itin_df, stop_distr) in enumerate(chunks):
+            first_uid = str(itin_df['uid'].values[0]) if itin_df.shape[0] > 0 else None  # noqa
+            if ckpt is not None and ckpt.done(k) is not None:
+                if ckpt.done(k)['first_uid'] != first_uid:
+                    raise ValueError(
+                        "chunk %d does not match the checkpoint in %s" % (k, checkpoint_dir)  # noqa
+                    )
+                usage_file = ckpt.path(k, "usage.npz")
+                yield k, first_uid, None
+                continue
+            if balancer is not None and usage_file is not None:
+                # departures of the completed shards
+                balancer.load(usage_file)
+                usage_file = None
+            if seed is not None:
+                np.random.seed([seed, k])
+            itin_df = _fill_itinerary(itin_df, stop_distr, profiler)
+            trips = draw_trips(compute_transitions(itin_df), net, stop2edges, reach=reach, balancer=balancer)  # noqa
+            if balancer is not None and ckpt is not None:
+                # written before the shard is committed
+                balancer.save(ckpt.path(k, "usage.npz"))
+            yield k, first_uid, trips
+
+    pipeline = prefetch(draw(prefetch(itin_chunks, queue_size)), queue_size)
+    try:
+        return _write_pipeline(pipeline, ckpt, save_dir, prefix)
+    finally:
+        pipeline.close()
+
+
+def _write_pipeline(
+    pipeline: Iterator,
+    ckpt: ShardCheckpoint,
+    save_dir: str,
+    prefix: str
+) -> int:
+    manifest_path = save_dir.joinpath(prefix + "_trips.csv")
+    if ckpt is not None:
+        names = ("persons.xml", "cars.xml", "bikes.xml")
+        for k, first_uid, trips in pipeline:
+            if trips is None:
+                continue
+            with atomic_open(ckpt.path(k, names[0])) as pt_f, \
+                    atomic_open(ckpt.path(k, names[1])) as ct_f, \
+                    atomic_open(ckpt.path(k, names[2])) as bt_f:
+                n = write_trips(trips, pt_f, ct_f, bt_f)
+            with atomic_open(ckpt.path(k, "trips.csv")) as fd:
+                write_manifest(trips, fd, append=True)
+            ckpt.commit(k, {"first_uid": first_uid, "trips": n})
+        # assemble the final files from all shards
+        header = io.StringIO()
+        sumolib.xml.writeHeader(header, script=None, root="routes", schemaPath="routes_file.xsd")  # noqa
+        for kind, name in zip(("persons", "cars", "bikes"), names):
+            concat_files(
+                ckpt.paths(name),
+                save_dir.joinpath(prefix + "_" + kind + ".trips.xml"),
+                header=header.getvalue(), footer="</routes>\n"
+            )
+        concat_files(
+            ckpt.paths("trips.csv"), manifest_path,
+            header=",".join(MANIFEST_COLUMNS) + "\n"
+        )
+        return sum(info["trips"] for info in ckpt.shards.values())
+
+    n_trips = 0
+    n_chunks = 0
+    files = _open_trip_files(save_dir, prefix)
+    manifest_part = str(manifest_path) + PART
+    try:
+        for k, first_uid, trips in pipeline:
+            n_trips += write_trips(trips, *files)
+            write_manifest(trips, manifest_part, append=n_chunks > 0)
+            n_chunks += 1
+    except BaseException:
+        _close_trip_files(files, commit=False)
+        if os.path.exists(manifest_part):
+            os.remove(manifest_part)
+        raise
+    _close_trip_files(files)
+    if n_chunks == 0:
+        pd.DataFrame(columns=MANIFEST_COLUMNS).to_csv(manifest_part, index=False)
+    os.replace(manifest_part, manifest_path)
+    return n_trips
 
 
 if __name__ == "__main__":